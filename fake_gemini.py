@@ -0,0 +1,941 @@
+"""Local stand-in for the Gemini API, for load tests and benchmarks without a network.
+
+FakeClient mimics the parts of google-genai's Client that the engine uses
+(client.models.generate_content and generate_content_stream, client.caches
+create/get/update/delete, client.batches create/get/cancel). It returns
+synthetic images and text with configurable latency, error rate and payload
+size. Requests with a response_schema get JSON shaped by the schema: an array
+of objects yields one object per attached image, with the first required
+string field set to the text part just before that image. The same backend
+can also be served over HTTP, so the real SDK can be
+pointed at it with a base_url:
+
+    python fake_gemini.py --port 8089 --latency-ms 1200 --error-rate 0.05
+    GEMINI_BACKEND=http://127.0.0.1:8089 streamlit run streamlit_app.py
+
+Set GEMINI_BACKEND=fake to use the in-process client instead. The FAKE_GEMINI_*
+environment variables configure the backend either way.
+"""
+import argparse
+import base64
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import PIL.Image
+
+from image_encoder import FORMAT_MIME_TYPES
+
+# Distinct synthetic images rendered per backend; requests map onto them by prompt hash
+PAYLOAD_VARIANTS = 8
+
+# Rough token accounting used for usage_metadata
+CHARS_PER_TOKEN = 4
+INPUT_IMAGE_TOKENS = 258
+# Smallest cached content the API accepts
+MIN_CACHE_TOKENS = 1024
+OUTPUT_IMAGE_TOKENS = 1290
+
+# Share of the sampled latency spent before the first streamed chunk
+STREAM_FIRST_CHUNK_SHARE = 0.3
+
+# Errors come back faster than successful calls
+ERROR_LATENCY_SHARE = 0.1
+
+# Batch jobs sit pending, then run, then finish after this many seconds
+BATCH_PENDING_SHARE = 0.2
+
+ERROR_STATUSES = {
+    400: "INVALID_ARGUMENT",
+    404: "NOT_FOUND",
+    408: "DEADLINE_EXCEEDED",
+    429: "RESOURCE_EXHAUSTED",
+    500: "INTERNAL",
+    503: "UNAVAILABLE",
+    504: "DEADLINE_EXCEEDED",
+}
+
+WORDS = (
+    "the image shows a subject in soft natural light with a balanced composition "
+    "detailed textures warm tones clear focus background elements colour palette "
+    "foreground depth contrast mood style lighting quality framing scene object person"
+).split()
+
+
+class FakeAPIError(Exception):
+    """Injected failure shaped like google.genai.errors.APIError (code, status, response.headers)"""
+
+    def __init__(self, code, message, retry_after=None):
+        super().__init__(f"{code} {ERROR_STATUSES.get(code, 'UNKNOWN')}. {message}")
+        self.code = code
+        self.status = ERROR_STATUSES.get(code, "UNKNOWN")
+        self.message = message
+        self.response = FakeHTTPResponse({'retry-after': str(retry_after)} if retry_after is not None else {})
+
+
+class FakeHTTPResponse:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class FakeGeminiBackend:
+    """Synthetic responses with seeded latency, error and payload behaviour"""
+
+    def __init__(self, latency_ms=800, latency_sigma=0.5, error_rate=0.0, error_codes=(429, 503),
+                 retry_after=None, image_edge=1024, image_format="PNG", text_bytes=2000,
+                 stream_chunks=8, batch_seconds=5.0, seed=0):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.retry_after = retry_after
+        self.image_edge = image_edge
+        self.image_format = image_format
+        self.text_bytes = text_bytes
+        self.stream_chunks = max(1, stream_chunks)
+        self.batch_seconds = batch_seconds
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.payloads = {}
+        self.cached_contents = {}
+        self.batches = {}
+        self.counters = {'calls': 0, 'errors': 0, 'images': 0, 'bytes_out': 0, 'cached_tokens': 0}
+
+    @classmethod
+    def from_env(cls):
+        """Backend configured from FAKE_GEMINI_* environment variables"""
+        env = os.environ.get
+        retry_after = env("FAKE_GEMINI_RETRY_AFTER")
+        return cls(
+            latency_ms=float(env("FAKE_GEMINI_LATENCY_MS", "800")),
+            latency_sigma=float(env("FAKE_GEMINI_LATENCY_SIGMA", "0.5")),
+            error_rate=float(env("FAKE_GEMINI_ERROR_RATE", "0")),
+            error_codes=[int(c) for c in env("FAKE_GEMINI_ERROR_CODES", "429,503").split(",") if c.strip()],
+            retry_after=float(retry_after) if retry_after else None,
+            image_edge=int(env("FAKE_GEMINI_IMAGE_EDGE", "1024")),
+            image_format=env("FAKE_GEMINI_IMAGE_FORMAT", "PNG"),
+            text_bytes=int(env("FAKE_GEMINI_TEXT_BYTES", "2000")),
+            stream_chunks=int(env("FAKE_GEMINI_STREAM_CHUNKS", "8")),
+            batch_seconds=float(env("FAKE_GEMINI_BATCH_SECONDS", "5")),
+            seed=int(env("FAKE_GEMINI_SEED", "0")),
+        )
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        """Snapshot of calls served, injected errors and bytes returned"""
+        with self.lock:
+            return dict(self.counters)
+
+    def _sample(self):
+        """Latency in seconds (log-normal around latency_ms) and an injected error code, if any"""
+        with self.lock:
+            self.counters['calls'] += 1
+            latency = self.latency_ms / 1000 * math.exp(self.rng.gauss(0, self.latency_sigma)) if self.latency_sigma else self.latency_ms / 1000
+            fail = bool(self.error_codes) and self.rng.random() < self.error_rate
+            code = self.rng.choice(self.error_codes) if fail else None
+        return latency, code
+
+    def _fail(self, code, latency):
+        self._count('errors')
+        time.sleep(latency * ERROR_LATENCY_SHARE)
+        raise FakeAPIError(code, "Injected by fake_gemini", self.retry_after)
+
+    def _payload(self, prompt):
+        """Encoded synthetic image for a prompt; renders are reused across requests"""
+        index = int(hashlib.sha256(prompt.encode('utf-8')).hexdigest(), 16) % PAYLOAD_VARIANTS
+        with self.lock:
+            cached = self.payloads.get(index)
+        if cached:
+            return cached
+
+        # Noise does not compress, so payload size tracks image_edge like a detailed photo would
+        rng = random.Random(self.seed * PAYLOAD_VARIANTS + index)
+        pixels = rng.randbytes(self.image_edge * self.image_edge * 3)
+        image = PIL.Image.frombytes('RGB', (self.image_edge, self.image_edge), pixels)
+        buf = io.BytesIO()
+        image.save(buf, format=self.image_format)
+        payload = (buf.getvalue(), FORMAT_MIME_TYPES[self.image_format])
+        with self.lock:
+            self.payloads[index] = payload
+        return payload
+
+    def _text(self, prompt):
+        rng = random.Random(prompt)
+        words = []
+        length = 0
+        while length < self.text_bytes:
+            word = rng.choice(WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return " ".join(words).capitalize() + "."
+
+    def _usage(self, prompt, image_count, text, with_image, cached_tokens=0):
+        # Like the real API, prompt tokens include the cached prefix
+        prompt_tokens = len(prompt) // CHARS_PER_TOKEN + INPUT_IMAGE_TOKENS * image_count
+        candidate_tokens = len(text) // CHARS_PER_TOKEN + (OUTPUT_IMAGE_TOKENS if with_image else 0)
+        usage = {
+            'prompt_token_count': prompt_tokens,
+            'candidates_token_count': candidate_tokens,
+            'total_token_count': prompt_tokens + candidate_tokens,
+        }
+        if cached_tokens:
+            usage['cached_content_token_count'] = cached_tokens
+        return usage
+
+    def create_cache(self, model, text, ttl_seconds, display_name=None):
+        """Store a cached prompt prefix and return its metadata dict; prefixes below MIN_CACHE_TOKENS raise a 400"""
+        token_count = len(text) // CHARS_PER_TOKEN
+        if token_count < MIN_CACHE_TOKENS:
+            raise FakeAPIError(
+                400, f"Cached content is too small. total_token_count={token_count}, min_total_token_count={MIN_CACHE_TOKENS}"
+            )
+        now = datetime.now(timezone.utc)
+        entry = {
+            'name': f"cachedContents/{uuid.uuid4().hex[:16]}",
+            'model': model if model.startswith('models/') else f"models/{model}",
+            'display_name': display_name,
+            'text': text,
+            'create_time': now,
+            'update_time': now,
+            'expire_time': now + timedelta(seconds=ttl_seconds),
+            'token_count': token_count,
+        }
+        with self.lock:
+            self.cached_contents[entry['name']] = entry
+        return entry
+
+    def get_cache(self, name):
+        """Metadata for a live cache entry; expired or unknown names raise a 404"""
+        with self.lock:
+            entry = self.cached_contents.get(name)
+            if entry is not None and entry['expire_time'] <= datetime.now(timezone.utc):
+                del self.cached_contents[name]
+                entry = None
+        if entry is None:
+            raise FakeAPIError(404, f"CachedContent not found (or expired): {name}")
+        return entry
+
+    def update_cache(self, name, ttl_seconds):
+        """Push a cache entry's expiry to ttl_seconds from now"""
+        entry = self.get_cache(name)
+        now = datetime.now(timezone.utc)
+        with self.lock:
+            entry['update_time'] = now
+            entry['expire_time'] = now + timedelta(seconds=ttl_seconds)
+        return entry
+
+    def delete_cache(self, name):
+        self.get_cache(name)
+        with self.lock:
+            self.cached_contents.pop(name, None)
+
+    def expand(self, cached_content, prompt):
+        """Prompt with the cached prefix prepended, and the number of tokens it was served from cache"""
+        if not cached_content:
+            return prompt, 0
+        entry = self.get_cache(cached_content)
+        self._count('cached_tokens', entry['token_count'])
+        return entry['text'] + "\n" + prompt, entry['token_count']
+
+    def create_batch(self, model, requests, display_name=None):
+        """Queue (prompt, image_count, wants_image, metadata) requests as a batch job; it completes after batch_seconds"""
+        now = datetime.now(timezone.utc)
+        job = {
+            'name': f"batches/{uuid.uuid4().hex[:16]}",
+            'model': model if model.startswith('models/') else f"models/{model}",
+            'display_name': display_name,
+            'requests': requests,
+            'responses': None,
+            'state': 'JOB_STATE_PENDING',
+            'create_time': now,
+            'update_time': now,
+            'end_time': None,
+        }
+        with self.lock:
+            self.batches[job['name']] = job
+        return job
+
+    def get_batch(self, name):
+        """Batch job advanced to its current state; requests are answered when it finishes"""
+        with self.lock:
+            job = self.batches.get(name)
+        if job is None:
+            raise FakeAPIError(404, f"Batch not found: {name}")
+
+        elapsed = (datetime.now(timezone.utc) - job['create_time']).total_seconds()
+        if job['state'] == 'JOB_STATE_PENDING' and elapsed >= self.batch_seconds * BATCH_PENDING_SHARE:
+            job['state'] = 'JOB_STATE_RUNNING'
+            job['update_time'] = datetime.now(timezone.utc)
+        if job['state'] == 'JOB_STATE_RUNNING' and elapsed >= self.batch_seconds:
+            responses = []
+            for prompt, image_count, wants_image, metadata in job['requests']:
+                # Batch work is scheduled offline, so no per-request latency is simulated
+                fail = bool(self.error_codes) and self.rng.random() < self.error_rate
+                with self.lock:
+                    self.counters['calls'] += 1
+                if fail:
+                    self._count('errors')
+                    code = self.rng.choice(self.error_codes)
+                    responses.append({'metadata': metadata, 'error': {'code': code, 'message': "Injected by fake_gemini"}})
+                    continue
+                parts, usage = self._answer(prompt, image_count, wants_image)
+                responses.append({'metadata': metadata, 'parts': parts, 'usage': usage})
+            with self.lock:
+                job['responses'] = responses
+                job['state'] = 'JOB_STATE_SUCCEEDED'
+                job['update_time'] = job['end_time'] = datetime.now(timezone.utc)
+        return job
+
+    def cancel_batch(self, name):
+        job = self.get_batch(name)
+        with self.lock:
+            if job['state'] in ('JOB_STATE_PENDING', 'JOB_STATE_RUNNING'):
+                job['state'] = 'JOB_STATE_CANCELLED'
+                job['update_time'] = job['end_time'] = datetime.now(timezone.utc)
+        return job
+
+    def _fill(self, schema, seed, label=None):
+        """Synthetic value matching a JSON schema; label fills the first required string property"""
+        kind = str(schema.get('type') or 'STRING').upper()
+        if kind == 'ARRAY':
+            return [self._fill(schema.get('items') or {}, seed)]
+        if kind == 'OBJECT':
+            properties = schema.get('properties') or {}
+            required = schema.get('required') or list(properties)
+            value = {}
+            for name, prop in properties.items():
+                is_label = label is not None and required and name == required[0]
+                value[name] = label if is_label else self._fill(prop, f"{seed}:{name}")
+            return value
+        rng = random.Random(seed)
+        if kind in ('INTEGER', 'NUMBER'):
+            return rng.randint(0, 100)
+        if kind == 'BOOLEAN':
+            return rng.random() < 0.5
+        return self._text(seed)
+
+    def structured(self, schema, prompt, labels):
+        """JSON text for a response schema; arrays of objects get one entry per labelled image"""
+        if str(schema.get('type') or '').upper() == 'ARRAY' and labels:
+            value = [self._fill(schema.get('items') or {}, f"{prompt}:{label}", label) for label in labels]
+        else:
+            value = self._fill(schema, prompt)
+        return json.dumps(value)
+
+    def respond(self, prompt, image_count, wants_image, cached_tokens=0, schema=None, labels=None):
+        """Sleep for a sampled latency, then return (parts, usage) or raise FakeAPIError; parts are ('text', str) or ('image', bytes, mime_type)"""
+        latency, code = self._sample()
+        if code:
+            self._fail(code, latency)
+        time.sleep(latency)
+        return self._answer(prompt, image_count, wants_image, cached_tokens, schema, labels)
+
+    def _answer(self, prompt, image_count, wants_image, cached_tokens=0, schema=None, labels=None):
+        if wants_image:
+            data, mime_type = self._payload(prompt)
+            text = "Here is the generated image."
+            parts = [('text', text), ('image', data, mime_type)]
+            self._count('images')
+            self._count('bytes_out', len(data))
+        else:
+            text = self.structured(schema, prompt, labels) if schema else self._text(prompt)
+            parts = [('text', text)]
+            self._count('bytes_out', len(text))
+        return parts, self._usage(prompt, image_count, text, wants_image, cached_tokens)
+
+    def respond_stream(self, prompt, image_count, cached_tokens=0):
+        """Yield (text, usage) chunks spread over a sampled latency; errors raise before the first chunk"""
+        latency, code = self._sample()
+        if code:
+            self._fail(code, latency)
+
+        text = self._text(prompt)
+        self._count('bytes_out', len(text))
+        size = math.ceil(len(text) / self.stream_chunks)
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        gap = latency * (1 - STREAM_FIRST_CHUNK_SHARE) / max(1, len(chunks) - 1)
+
+        time.sleep(latency * STREAM_FIRST_CHUNK_SHARE)
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(gap)
+            last = i == len(chunks) - 1
+            yield chunk, self._usage(prompt, image_count, text, False, cached_tokens) if last else None
+
+
+def wants_image_output(modalities, has_safety_settings, response_mime_type):
+    """Image requests ask for the Image modality or, like edits and face swaps, only set safety settings"""
+    if modalities:
+        return any(str(m).lower() == 'image' for m in modalities)
+    return bool(has_safety_settings) and not response_mime_type
+
+
+# In-process client
+
+class FakeImage:
+    def __init__(self, image_bytes, mime_type):
+        self.image_bytes = image_bytes
+        self.mime_type = mime_type
+
+
+class FakeBlob:
+    def __init__(self, data, mime_type):
+        self.data = data
+        self.mime_type = mime_type
+
+
+class FakePart:
+    def __init__(self, text=None, image_bytes=None, mime_type=None):
+        self.text = text
+        self.inline_data = FakeBlob(image_bytes, mime_type) if image_bytes is not None else None
+
+    def as_image(self):
+        if self.inline_data is None:
+            return None
+        return FakeImage(self.inline_data.data, self.inline_data.mime_type)
+
+
+class FakeUsage:
+    def __init__(self, prompt_token_count, candidates_token_count, total_token_count, cached_content_token_count=None):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = total_token_count
+        self.cached_content_token_count = cached_content_token_count
+
+
+class FakeResponse:
+    def __init__(self, parts, usage=None):
+        self.parts = parts
+        self.usage_metadata = FakeUsage(**usage) if usage else None
+
+    @property
+    def text(self):
+        texts = [part.text for part in self.parts if part.text]
+        return "".join(texts) if texts else None
+
+
+def _schema_dict(schema):
+    """response_schema from a config as a plain dict, or None"""
+    if schema is None:
+        return None
+    if hasattr(schema, 'model_dump'):
+        return schema.model_dump(mode='json', exclude_none=True)
+    return schema
+
+
+def _image_labels(items):
+    """Text part immediately before each attached image, in order"""
+    labels = []
+    last_text = ""
+    for item in items:
+        if isinstance(item, str):
+            last_text = item
+        elif getattr(item, 'parts', None):
+            for label in _image_labels(item.parts):
+                labels.append(label)
+        elif getattr(item, 'text', None):
+            last_text = item.text
+        elif getattr(item, 'inline_data', None) is not None or isinstance(item, PIL.Image.Image):
+            labels.append(last_text)
+            last_text = ""
+    return labels
+
+
+def _summarize_contents(contents):
+    """Prompt text and attached image count from str / Part / list contents"""
+    items = contents if isinstance(contents, (list, tuple)) else [contents]
+    texts = []
+    image_count = 0
+    for item in items:
+        if isinstance(item, str):
+            texts.append(item)
+        elif getattr(item, 'parts', None):
+            text, count = _summarize_contents(item.parts)
+            texts.append(text)
+            image_count += count
+        elif getattr(item, 'text', None):
+            texts.append(item.text)
+        elif getattr(item, 'inline_data', None) is not None or isinstance(item, PIL.Image.Image):
+            image_count += 1
+    return "\n".join(texts), image_count
+
+
+def _with_system_instruction(config, prompt):
+    """Prompt with the config's system instruction, if any, in front as the model would read it"""
+    system_instruction = getattr(config, 'system_instruction', None)
+    if not system_instruction:
+        return prompt
+    return "\n".join(filter(None, [_summarize_contents(system_instruction)[0], prompt]))
+
+
+class FakeModels:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def generate_content(self, model, contents, config=None):
+        prompt, image_count = _summarize_contents(contents)
+        prompt = _with_system_instruction(config, prompt)
+        prompt, cached_tokens = self.backend.expand(getattr(config, 'cached_content', None), prompt)
+        wants_image = config is not None and wants_image_output(
+            getattr(config, 'response_modalities', None),
+            getattr(config, 'safety_settings', None),
+            getattr(config, 'response_mime_type', None),
+        )
+        schema = _schema_dict(getattr(config, 'response_schema', None))
+        labels = _image_labels(contents if isinstance(contents, (list, tuple)) else [contents]) if schema else None
+        parts, usage = self.backend.respond(prompt, image_count, wants_image, cached_tokens, schema, labels)
+        return _fake_response(parts, usage)
+
+    def generate_content_stream(self, model, contents, config=None):
+        prompt, image_count = _summarize_contents(contents)
+        prompt = _with_system_instruction(config, prompt)
+        prompt, cached_tokens = self.backend.expand(getattr(config, 'cached_content', None), prompt)
+        for text, usage in self.backend.respond_stream(prompt, image_count, cached_tokens):
+            yield FakeResponse([FakePart(text=text)], usage)
+
+
+class FakeCachedContent:
+    def __init__(self, entry):
+        self.name = entry['name']
+        self.model = entry['model']
+        self.display_name = entry['display_name']
+        self.create_time = entry['create_time']
+        self.update_time = entry['update_time']
+        self.expire_time = entry['expire_time']
+        self.usage_metadata = FakeCacheUsage(entry['token_count'])
+
+
+class FakeCacheUsage:
+    def __init__(self, total_token_count):
+        self.total_token_count = total_token_count
+
+
+def _ttl_seconds(ttl):
+    """Seconds from a "3600s" duration string"""
+    return float(str(ttl).rstrip('s'))
+
+
+class FakeCaches:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create(self, model, config=None):
+        text, _ = _summarize_contents(getattr(config, 'contents', None) or [])
+        system_instruction = getattr(config, 'system_instruction', None)
+        if system_instruction:
+            text = "\n".join(filter(None, [_summarize_contents(system_instruction)[0], text]))
+        entry = self.backend.create_cache(
+            model, text, _ttl_seconds(getattr(config, 'ttl', None) or '3600s'), getattr(config, 'display_name', None)
+        )
+        return FakeCachedContent(entry)
+
+    def get(self, name, config=None):
+        return FakeCachedContent(self.backend.get_cache(name))
+
+    def update(self, name, config=None):
+        return FakeCachedContent(self.backend.update_cache(name, _ttl_seconds(getattr(config, 'ttl', None) or '3600s')))
+
+    def delete(self, name, config=None):
+        self.backend.delete_cache(name)
+
+
+class FakeJobError:
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+
+
+class FakeInlinedResponse:
+    def __init__(self, response, metadata=None, error=None):
+        self.response = response
+        self.metadata = metadata
+        self.error = error
+
+
+class FakeBatchDestination:
+    def __init__(self, inlined_responses):
+        self.inlined_responses = inlined_responses
+
+
+class FakeBatchJob:
+    def __init__(self, job):
+        self.name = job['name']
+        self.display_name = job['display_name']
+        self.model = job['model']
+        self.state = job['state']
+        self.create_time = job['create_time']
+        self.update_time = job['update_time']
+        self.end_time = job['end_time']
+        self.error = None
+        self.dest = None
+        if job['responses'] is not None:
+            self.dest = FakeBatchDestination([
+                FakeInlinedResponse(None, item['metadata'], FakeJobError(**item['error']))
+                if 'error' in item else
+                FakeInlinedResponse(_fake_response(item['parts'], item['usage']), item['metadata'])
+                for item in job['responses']
+            ])
+
+    def done(self):
+        return self.state not in ('JOB_STATE_PENDING', 'JOB_STATE_RUNNING')
+
+
+def _fake_response(parts, usage):
+    return FakeResponse([
+        FakePart(text=part[1]) if part[0] == 'text' else FakePart(image_bytes=part[1], mime_type=part[2])
+        for part in parts
+    ], usage)
+
+
+class FakeBatches:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create(self, model, src, config=None):
+        requests = []
+        for request in src:
+            prompt, image_count = _summarize_contents(request.contents)
+            request_config = request.config
+            wants_image = request_config is not None and wants_image_output(
+                getattr(request_config, 'response_modalities', None),
+                getattr(request_config, 'safety_settings', None),
+                getattr(request_config, 'response_mime_type', None),
+            )
+            requests.append((prompt, image_count, wants_image, request.metadata))
+        return FakeBatchJob(self.backend.create_batch(model, requests, getattr(config, 'display_name', None)))
+
+    def get(self, name, config=None):
+        return FakeBatchJob(self.backend.get_batch(name))
+
+    def cancel(self, name, config=None):
+        self.backend.cancel_batch(name)
+
+
+class FakeClient:
+    """Drop-in for genai.Client where only client.models, client.caches and client.batches are used"""
+
+    def __init__(self, backend=None):
+        self.backend = backend or FakeGeminiBackend.from_env()
+        self.models = FakeModels(self.backend)
+        self.caches = FakeCaches(self.backend)
+        self.batches = FakeBatches(self.backend)
+
+
+# HTTP server speaking the REST generateContent API
+
+def _json_image_labels(contents):
+    labels = []
+    last_text = ""
+    for content in contents:
+        for part in content.get('parts', []):
+            if 'text' in part:
+                last_text = part['text']
+            elif 'inlineData' in part or 'fileData' in part:
+                labels.append(last_text)
+                last_text = ""
+    return labels
+
+
+def _contents_summary(contents):
+    texts = []
+    image_count = 0
+    for content in contents:
+        for part in content.get('parts', []):
+            if 'text' in part:
+                texts.append(part['text'])
+            elif 'inlineData' in part or 'fileData' in part:
+                image_count += 1
+    return "\n".join(texts), image_count
+
+
+def _request_summary(body):
+    """Prompt text, attached image count and whether an image is wanted, from a generateContent body"""
+    prompt, image_count = _contents_summary(body.get('contents', []))
+    system_instruction = body.get('systemInstruction')
+    if system_instruction:
+        prompt = "\n".join(filter(None, [_contents_summary([system_instruction])[0], prompt]))
+    generation_config = body.get('generationConfig', {})
+    wants_image = wants_image_output(
+        generation_config.get('responseModalities'),
+        body.get('safetySettings'),
+        generation_config.get('responseMimeType'),
+    )
+    return prompt, image_count, wants_image
+
+
+def _usage_json(usage):
+    result = {
+        'promptTokenCount': usage['prompt_token_count'],
+        'candidatesTokenCount': usage['candidates_token_count'],
+        'totalTokenCount': usage['total_token_count'],
+    }
+    if usage.get('cached_content_token_count'):
+        result['cachedContentTokenCount'] = usage['cached_content_token_count']
+    return result
+
+
+# The REST API reports batch states with a BATCH_ prefix
+BATCH_STATE_JSON = {
+    'JOB_STATE_PENDING': 'BATCH_STATE_PENDING',
+    'JOB_STATE_RUNNING': 'BATCH_STATE_RUNNING',
+    'JOB_STATE_SUCCEEDED': 'BATCH_STATE_SUCCEEDED',
+    'JOB_STATE_CANCELLED': 'BATCH_STATE_CANCELLED',
+}
+
+
+def _batch_json(job):
+    metadata = {
+        '@type': 'type.googleapis.com/google.ai.generativelanguage.v1main.GenerateContentBatch',
+        'model': job['model'],
+        'displayName': job['display_name'] or "",
+        'state': BATCH_STATE_JSON[job['state']],
+        'createTime': _timestamp_json(job['create_time']),
+        'updateTime': _timestamp_json(job['update_time']),
+    }
+    if job['end_time']:
+        metadata['endTime'] = _timestamp_json(job['end_time'])
+    if job['responses'] is not None:
+        inlined = []
+        for item in job['responses']:
+            entry = {'metadata': item['metadata']} if item['metadata'] else {}
+            if 'error' in item:
+                entry['error'] = item['error']
+            else:
+                entry['response'] = _response_json(item['parts'], item['usage'])
+            inlined.append(entry)
+        metadata['output'] = {'inlinedResponses': {'inlinedResponses': inlined}}
+    return {'name': job['name'], 'metadata': metadata, 'done': job['state'] not in ('JOB_STATE_PENDING', 'JOB_STATE_RUNNING')}
+
+
+def _timestamp_json(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def _cache_json(entry):
+    return {
+        'name': entry['name'],
+        'model': entry['model'],
+        'displayName': entry['display_name'] or "",
+        'createTime': _timestamp_json(entry['create_time']),
+        'updateTime': _timestamp_json(entry['update_time']),
+        'expireTime': _timestamp_json(entry['expire_time']),
+        'usageMetadata': {'totalTokenCount': entry['token_count']},
+    }
+
+
+def _response_json(parts, usage):
+    json_parts = []
+    for part in parts:
+        if part[0] == 'text':
+            json_parts.append({'text': part[1]})
+        else:
+            json_parts.append({'inlineData': {'mimeType': part[2], 'data': base64.b64encode(part[1]).decode('ascii')}})
+    response = {'candidates': [{'content': {'role': 'model', 'parts': json_parts}, 'finishReason': 'STOP', 'index': 0}]}
+    if usage:
+        response['usageMetadata'] = _usage_json(usage)
+    return response
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    """Handles POST .../models/{model}:generateContent, :streamGenerateContent and :batchGenerateContent plus .../cachedContents and .../batches"""
+
+    backend = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, error):
+        headers = {'Retry-After': error.response.headers['retry-after']} if error.response.headers else None
+        self._send_json(error.code, {'error': {'code': error.code, 'message': error.message, 'status': error.status}}, headers)
+
+    def _send_event(self, text, usage):
+        event = json.dumps(_response_json([('text', text)], usage))
+        self.wfile.write(f"data: {event}\r\n\r\n".encode('utf-8'))
+        self.wfile.flush()
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            return json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send_json(400, {'error': {'code': 400, 'message': 'Invalid JSON', 'status': 'INVALID_ARGUMENT'}})
+            return None
+
+    def _resource_name(self, collection):
+        """{collection}/{id} from the request path, or None for other paths"""
+        path = self.path.split('?', 1)[0]
+        marker = f'/{collection}/'
+        return f'{collection}/' + path.split(marker, 1)[1] if marker in path else None
+
+    def _cache_name(self):
+        return self._resource_name('cachedContents')
+
+    def _cache_call(self, fn, *args, render=_cache_json):
+        try:
+            entry = fn(*args)
+        except FakeAPIError as e:
+            self._send_error(e)
+            return
+        self._send_json(200, render(entry) if entry else {})
+
+    def do_GET(self):
+        name = self._cache_name()
+        batch_name = self._resource_name('batches')
+        if name:
+            self._cache_call(self.backend.get_cache, name)
+        elif batch_name:
+            self._cache_call(self.backend.get_batch, batch_name, render=_batch_json)
+        else:
+            self._send_json(404, {'error': {'code': 404, 'message': f'Unknown path {self.path}', 'status': 'NOT_FOUND'}})
+
+    def do_PATCH(self):
+        body = self._read_json()
+        name = self._cache_name()
+        if body is None:
+            return
+        if name:
+            self._cache_call(self.backend.update_cache, name, _ttl_seconds(body.get('ttl', '3600s')))
+        else:
+            self._send_json(404, {'error': {'code': 404, 'message': f'Unknown path {self.path}', 'status': 'NOT_FOUND'}})
+
+    def do_DELETE(self):
+        name = self._cache_name()
+        if name:
+            self._cache_call(self.backend.delete_cache, name)
+        else:
+            self._send_json(404, {'error': {'code': 404, 'message': f'Unknown path {self.path}', 'status': 'NOT_FOUND'}})
+
+    def do_POST(self):
+        path = self.path.split('?', 1)[0]
+        body = self._read_json()
+        if body is None:
+            return
+
+        if path.endswith(':batchGenerateContent'):
+            batch = body.get('batch', {})
+            requests = []
+            for item in batch.get('inputConfig', {}).get('requests', {}).get('requests', []):
+                prompt, image_count, wants_image = _request_summary(item.get('request', {}))
+                requests.append((prompt, image_count, wants_image, item.get('metadata')))
+            model = path.rsplit('/models/', 1)[-1].split(':', 1)[0]
+            self._cache_call(self.backend.create_batch, model, requests, batch.get('displayName'), render=_batch_json)
+            return
+        if path.endswith(':cancel') and self._resource_name('batches'):
+            self._cache_call(self.backend.cancel_batch, self._resource_name('batches')[:-len(':cancel')], render=lambda job: {})
+            return
+
+        if path.endswith('/cachedContents'):
+            text, _ = _contents_summary(body.get('contents', []))
+            system_instruction = body.get('systemInstruction')
+            if system_instruction:
+                text = "\n".join(filter(None, [_contents_summary([system_instruction])[0], text]))
+            self._cache_call(
+                self.backend.create_cache,
+                body.get('model', ''), text, _ttl_seconds(body.get('ttl', '3600s')), body.get('displayName')
+            )
+            return
+
+        prompt, image_count, wants_image = _request_summary(body)
+        try:
+            prompt, cached_tokens = self.backend.expand(body.get('cachedContent'), prompt)
+        except FakeAPIError as e:
+            self._send_error(e)
+            return
+        if path.endswith(':generateContent'):
+            schema = body.get('generationConfig', {}).get('responseSchema')
+            labels = _json_image_labels(body.get('contents', [])) if schema else None
+            try:
+                parts, usage = self.backend.respond(prompt, image_count, wants_image, cached_tokens, schema, labels)
+            except FakeAPIError as e:
+                self._send_error(e)
+                return
+            self._send_json(200, _response_json(parts, usage))
+        elif path.endswith(':streamGenerateContent'):
+            stream = self.backend.respond_stream(prompt, image_count, cached_tokens)
+            try:
+                first = next(stream)
+            except FakeAPIError as e:
+                self._send_error(e)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+            self._send_event(*first)
+            for text, usage in stream:
+                self._send_event(text, usage)
+        else:
+            self._send_json(404, {'error': {'code': 404, 'message': f'Unknown path {path}', 'status': 'NOT_FOUND'}})
+
+
+def make_server(backend=None, host="127.0.0.1", port=8089):
+    """HTTP server for the backend; call serve_forever() on the result"""
+    handler = type('BoundFakeGeminiHandler', (FakeGeminiHandler,), {'backend': backend or FakeGeminiBackend.from_env()})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    defaults = FakeGeminiBackend.from_env()
+    parser = argparse.ArgumentParser(description="Serve a fake Gemini API for offline testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=defaults.latency_ms, help="median call latency")
+    parser.add_argument("--latency-sigma", type=float, default=defaults.latency_sigma, help="log-normal spread; 0 for fixed latency")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="fraction of calls that fail")
+    parser.add_argument("--error-codes", default=",".join(map(str, defaults.error_codes)), help="comma-separated HTTP codes to inject")
+    parser.add_argument("--retry-after", type=float, default=defaults.retry_after, help="Retry-After seconds sent with errors")
+    parser.add_argument("--image-edge", type=int, default=defaults.image_edge, help="generated image size in pixels")
+    parser.add_argument("--image-format", default=defaults.image_format, choices=["PNG", "JPEG", "WEBP"])
+    parser.add_argument("--text-bytes", type=int, default=defaults.text_bytes, help="length of analysis text")
+    parser.add_argument("--batch-seconds", type=float, default=defaults.batch_seconds, help="time for a batch job to finish")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    args = parser.parse_args(argv)
+
+    backend = FakeGeminiBackend(
+        latency_ms=args.latency_ms,
+        latency_sigma=args.latency_sigma,
+        error_rate=args.error_rate,
+        error_codes=[int(c) for c in args.error_codes.split(",") if c.strip()],
+        retry_after=args.retry_after,
+        image_edge=args.image_edge,
+        image_format=args.image_format,
+        text_bytes=args.text_bytes,
+        batch_seconds=args.batch_seconds,
+        seed=args.seed,
+    )
+    server = make_server(backend, args.host, args.port)
+    print(f"Fake Gemini API listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
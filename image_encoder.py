@@ -0,0 +1,42 @@
+"""Image re-encoding helpers that run inside worker processes.
+
+Streamlit executes streamlit_app.py as a script, so functions defined there
+cannot be pickled into a ProcessPoolExecutor. Anything submitted to the
+encoder pool lives in this importable module instead.
+"""
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import PIL.Image
+
+FORMAT_MIME_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+def create_encoder_pool(max_workers=None):
+    """Process pool for encode_image_bytes whose workers are not forked from the app"""
+    # Forking a threaded server copies held locks, SQLite connections and HTTP clients into the workers
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+
+def quality_from_setting(setting):
+    """Map the 1-10 "Image quality" setting onto a JPEG/WEBP quality value"""
+    return max(10, min(95, int(setting) * 10))
+
+
+def encode_image_bytes(data, fmt, quality):
+    """Re-encode image bytes into the requested format and quality"""
+    image = PIL.Image.open(io.BytesIO(data))
+
+    if fmt == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    buf = io.BytesIO()
+    if fmt == "PNG":
+        # PNG is lossless, so quality does not apply
+        image.save(buf, format="PNG")
+    else:
+        image.save(buf, format=fmt, quality=quality)
+    return buf.getvalue()
@@ -1,12 +1,52 @@
 import streamlit as st
 import os
-from google import genai
-from google.genai import types
-import PIL.Image
 import io
 from datetime import datetime
 import json
 import base64
+import math
+import uuid
+import hashlib
+import threading
+import time
+from image_encoder import create_encoder_pool, quality_from_setting
+from studio_metrics import MetricsRegistry, cache_collector, gateway_collector, serve_metrics
+from studio_store import HISTORY_PAGE_SIZE, BlobStore, HistoryStore, JobManager
+from studio_engine import (
+    ASPECT_RATIOS,
+    BACKGROUND_OPTIONS,
+    BATCH_MAX_IN_FLIGHT,
+    BATCH_REQUESTS_PER_MINUTE,
+    BATCH_SERVER_REQUESTS_PER_MINUTE,
+    BODY_MODIFICATIONS,
+    BULK_DONE_STATES,
+    BULK_POLL_SECONDS,
+    CLOTHING_OPTIONS,
+    FACE_ENHANCEMENT,
+    FACIAL_EXPRESSIONS,
+    GEMINI_BACKEND,
+    PACK_MAX_IMAGES,
+    POSE_OPTIONS,
+    STYLE_PRESETS,
+    UPLOAD_MAX_EDGE,
+    BulkJobStore,
+    CallLog,
+    DecodedImageCache,
+    EncodedImage,
+    QuotaManager,
+    RateLimiter,
+    ResultCache,
+    Studio,
+    create_client,
+    encode_results,
+    enhance_prompt,
+    format_bytes,
+    latency_timeline,
+    make_thumbnail,
+    prepare_image_bytes,
+    summarize_calls,
+    write_results_zip,
+)
 
 # Page config
 st.set_page_config(
@@ -76,471 +116,334 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# Initialize session state
-def init_session_state():
-    if 'generation_history' not in st.session_state:
-        st.session_state.generation_history = []
-    if 'edit_history' not in st.session_state:
-        st.session_state.edit_history = []
-    if 'analysis_history' not in st.session_state:
-        st.session_state.analysis_history = []
-
-init_session_state()
-
 @st.cache_resource
 def get_client():
-    """Initialize Gemini client with error handling"""
+    """Initialize Gemini client (or the GEMINI_BACKEND stand-in) with error handling"""
     try:
-        api_key = st.secrets["GOOGLE_API_KEY"]
-        return genai.Client(api_key=api_key)
+        api_key = st.secrets["GOOGLE_API_KEY"] if GEMINI_BACKEND == "live" else None
+        return create_client(api_key)
     except Exception as e:
         st.error(f"Failed to initialize AI client: {str(e)}")
         st.stop()
 
-MODEL_ID = "gemini-2.5-flash-image-preview"
-
-# Style and content options
-STYLE_PRESETS = {
-    "Photorealistic": "ultra-realistic, high-definition, professional photography, sharp details",
-    "Digital Art": "digital painting, concept art, detailed illustration, vibrant colors",
-    "Cartoon Style": "cartoon, animated style, colorful and fun, playful",
-    "Oil Painting": "classical oil painting, artistic brushstrokes, textured canvas",
-    "Sketch": "pencil sketch, hand-drawn, artistic lines, monochrome",
-    "Vintage": "vintage style, retro aesthetic, aged look, nostalgic",
-    "Cyberpunk": "neon lights, futuristic, cyberpunk aesthetic, dark atmosphere",
-    "Minimalist": "clean, simple, minimalist design, elegant simplicity"
-}
+@st.cache_resource
+def get_studio():
+    """Process-wide engine so caches, breaker state and metrics span all sessions"""
+    return Studio(get_client(), call_log=CallLog(HISTORY_DB_PATH), quota=QuotaManager(HISTORY_DB_PATH))
 
-ASPECT_RATIOS = {
-    "Square (1:1)": "square format, equal dimensions",
-    "Portrait (3:4)": "portrait orientation, vertical composition",
-    "Landscape (4:3)": "landscape orientation, horizontal composition", 
-    "Wide (16:9)": "wide format, cinematic composition"
-}
+@st.cache_resource
+def get_rate_limiter():
+    """Process-wide ceiling shared by every batch; each batch also gets its own limiter at the rate its user picked"""
+    return RateLimiter(BATCH_SERVER_REQUESTS_PER_MINUTE)
 
-CLOTHING_OPTIONS = {
-    "Business Formal": "professional business suit, formal corporate attire, executive styling",
-    "Casual Wear": "comfortable jeans and t-shirt, relaxed everyday clothing",
-    "Elegant Evening": "sophisticated evening dress, formal party attire, glamorous",
-    "Traditional Indian": "beautiful traditional Indian clothing, saree, kurta, cultural dress",
-    "Wedding Attire": "elegant wedding dress, formal wedding suit, bridal styling",
-    "Sportswear": "athletic wear, gym clothes, sports uniform, active lifestyle",
-    "Winter Wear": "warm winter coat, cozy sweater, seasonal layered clothing",
-    "Beach Wear": "summer beach outfit, light breezy clothing, vacation style",
-    "Vintage Style": "retro vintage clothing from past decades, classic fashion",
-    "Designer Fashion": "high-end designer clothing, luxury fashion, couture styling"
-}
+# Budget for decoded upload pixels kept in memory across reruns
+UPLOAD_CACHE_MAX_BYTES = int(os.environ.get("UPLOAD_CACHE_MAX_MB", "256")) * 1024 * 1024
 
-POSE_OPTIONS = {
-    "Confident Standing": "confident upright posture, hands on hips, strong authoritative stance",
-    "Relaxed Casual": "relaxed natural pose, comfortable casual body language",
-    "Professional Portrait": "professional headshot pose, business appropriate, executive presence",
-    "Dynamic Action": "energetic dynamic pose, movement and life, active positioning",
-    "Sitting Elegant": "graceful sitting position, elegant refined posture",
-    "Walking Forward": "confident walking stride, forward motion, purposeful movement",
-    "Arms Crossed": "confident pose with arms crossed, assertive professional stance",
-    "Waving Hello": "friendly waving gesture, welcoming approachable pose",
-    "Thinking Pose": "thoughtful pose, hand on chin, contemplative positioning",
-    "Victory Pose": "celebratory victory stance, arms raised, triumphant gesture"
-}
+@st.cache_resource
+def get_upload_cache():
+    """Process-wide decoded upload cache shared by all sessions"""
+    return DecodedImageCache(UPLOAD_CACHE_MAX_BYTES)
 
-FACIAL_EXPRESSIONS = {
-    "Natural Smile": "genuine natural smile, warm and friendly expression",
-    "Confident Look": "confident serious expression, professional authoritative demeanor", 
-    "Joyful Laugh": "happy laughing expression, pure joy and happiness",
-    "Thoughtful": "contemplative thoughtful expression, intelligent focused look",
-    "Surprised": "surprised expression, wide eyes, astonished look",
-    "Peaceful": "calm peaceful expression, serene tranquil look"
-}
+def prepare_upload(uploaded_file, max_edge=UPLOAD_MAX_EDGE):
+    """Normalize and decode an upload once; reruns and other sessions reuse it by content hash"""
+    data = uploaded_file.getvalue()
+    key = (hashlib.sha256(data).hexdigest(), max_edge)
+    
+    return get_upload_cache().get_or_create(key, lambda: prepare_image_bytes(data, max_edge))
 
-BACKGROUND_OPTIONS = {
-    "Smart Remove": "completely remove background, create transparent PNG",
-    "Studio Professional": "professional studio lighting, clean neutral backdrop",
-    "Modern Office": "contemporary office environment, professional workspace",
-    "Outdoor Natural": "beautiful outdoor natural setting, parks or landscapes",
-    "Urban City": "modern city environment, urban professional setting",
-    "Home Lifestyle": "cozy home interior, comfortable living space",
-    "Product Studio": "e-commerce white background, clean product photography",
-    "Fantasy World": "magical fantasy environment, creative artistic backdrop",
-    "Seasonal Theme": "seasonal environment, holiday or weather-themed backdrop"
-}
+# Persistent operation history
+HISTORY_DB_PATH = os.environ.get("HISTORY_DB_PATH", os.path.join(".cache", "history.db"))
 
-FACE_ENHANCEMENT = {
-    "Skin Perfection": "smooth flawless skin, remove blemishes naturally, even skin tone",
-    "Eye Enhancement": "brighter sparkling eyes, natural eye enhancement", 
-    "Smile Improvement": "perfect natural smile, teeth whitening, confident expression",
-    "Hair Styling": "perfect hairstyle, natural hair enhancement, styled look",
-    "Overall Beauty": "natural beauty enhancement, subtle professional improvement",
-    "Age Adjustment": "youthful appearance, age-appropriate enhancement"
-}
+@st.cache_resource
+def get_history_store():
+    """Process-wide history store; SQLite WAL lets readers proceed during writes"""
+    return HistoryStore(HISTORY_DB_PATH)
 
-BODY_MODIFICATIONS = {
-    "Fitness Transform": "athletic toned body, fit healthy appearance, natural muscle definition",
-    "Posture Improvement": "confident straight posture, professional body language",
-    "Height Enhancement": "taller proportional appearance, elegant stature",
-    "Body Proportions": "balanced natural body proportions, harmonious physique",
-    "Clothing Fit": "perfectly fitted clothing, tailored professional appearance"
-}
+# Content-addressed storage for images referenced by history rows
+BLOB_STORE_DIR = os.environ.get("BLOB_STORE_DIR", os.path.join(".cache", "blobs"))
 
-def enhance_prompt(base_prompt, style, aspect_ratio, quality_boost=True):
-    """Enhance user prompt with style and technical improvements"""
-    enhanced = base_prompt
-    
-    if style != "None":
-        enhanced = f"{enhanced}, {STYLE_PRESETS[style]}"
-    
-    if aspect_ratio != "Default":
-        enhanced = f"{enhanced}, {ASPECT_RATIOS[aspect_ratio]}"
-    
-    if quality_boost:
-        enhanced = f"{enhanced}, high quality, detailed, professional, sharp focus, well-composed"
-    
-    return enhanced
+@st.cache_resource
+def get_blob_store():
+    """Process-wide image blob store shared by all sessions; history rows drop images it evicts to stay in budget"""
+    store = BlobStore(BLOB_STORE_DIR, HISTORY_DB_PATH)
+    store.add_evict_listener(get_history_store().drop_images)
+    return store
+
+def current_session_id():
+    """Stable id for this browser session, used to count active sessions"""
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    return st.session_state.session_id
 
+# Query parameter carrying an anonymous visitor's id
+VISITOR_PARAM = "visitor"
 
+def current_visitor_id():
+    """Anonymous id kept in the page URL, so unlike the session it survives reloads and bookmarks"""
+    if 'visitor_id' not in st.session_state:
+        try:
+            st.session_state.visitor_id = uuid.UUID(st.query_params.get(VISITOR_PARAM)).hex
+        except (TypeError, ValueError):
+            st.session_state.visitor_id = uuid.uuid4().hex
+    if st.query_params.get(VISITOR_PARAM) != st.session_state.visitor_id:
+        st.query_params[VISITOR_PARAM] = st.session_state.visitor_id
+    return st.session_state.visitor_id
 
-def generate_image(prompt, num_variants=1):
-    """Generate image(s) from text prompt"""
+def current_user_email():
+    """Signed-in user's email when Streamlit auth is configured, else None"""
     try:
-        client = get_client()
-        results = []
-        
-        for i in range(num_variants):
-            response = client.models.generate_content(
-                model=MODEL_ID,
-                contents=prompt,
-                config=types.GenerateContentConfig(
-                    safety_settings=[
-                        types.SafetySetting(
-                            category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                            threshold=types.HarmBlockThreshold.BLOCK_NONE,
-                        )
-                    ],
-                    response_modalities=['Text', 'Image']
-                )
-            )
-            
-            for part in response.parts:
-                if hasattr(part, 'as_image') and part.as_image():
-                    gemini_image = part.as_image()
-                    
-                    if gemini_image and hasattr(gemini_image, 'image_bytes'):
-                        # Convert the image_bytes to a PIL Image
-                        img_bytes = io.BytesIO(gemini_image.image_bytes)
-                        pil_image = PIL.Image.open(img_bytes)
-                        results.append(pil_image)
-                        break
-        
-        return results, "Images generated successfully!"
-    except Exception as e:
-        return [], f"Generation error: {str(e)}"
-        
+        user = getattr(st, 'user', None) or getattr(st, 'experimental_user', None)
+        return user.get('email') if user is not None else None
+    except Exception:
+        return None
 
+def current_user_id():
+    """Signed-in user's email when Streamlit auth is configured, otherwise the visitor id from the page URL"""
+    return current_user_email() or f"visitor-{current_visitor_id()}"
 
-def face_swap_images(source_image, target_image, options):
-    """Advanced face swap between two images"""
-    try:
-        client = get_client()
-        
-        prompt = f"""
-        Perform a precise face swap operation:
-        
-        TASK: Take the face from the first image and naturally place it on the person in the second image
-        
-        REQUIREMENTS:
-        - Keep target person's exact body, clothing, pose, and background
-        - Swap only the facial features (eyes, nose, mouth, face shape)
-        - Match skin tone and lighting naturally
-        - Preserve target's hairstyle unless specified
-        - Ensure proper face size and angle alignment
-        - Create seamless, realistic integration
-        - Maintain image quality and resolution
-        
-        QUALITY SETTINGS:
-        - Blend mode: {options.get('blend_quality', 'natural')}
-        - Skin tone matching: {options.get('skin_match', 'automatic')}
-        - Hair preservation: {options.get('preserve_hair', True)}
-        - Expression: {options.get('expression', 'keep target expression')}
-        
-        Make it look completely natural and professional.
-        """
-        
-        response = client.models.generate_content(
-            model=MODEL_ID,
-            contents=[prompt, source_image, target_image],
-            config=types.GenerateContentConfig(
-                safety_settings=[
-                    types.SafetySetting(
-                        category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                        threshold=types.HarmBlockThreshold.BLOCK_NONE,
-                    )
-                ]
-            )
-        )
-        
-        for part in response.parts:
-            if hasattr(part, 'as_image') and part.as_image():
-                gemini_image = part.as_image()
-                
-                if gemini_image and hasattr(gemini_image, 'image_bytes'):
-                    # Convert the image_bytes to a PIL Image
-                    img_bytes = io.BytesIO(gemini_image.image_bytes)
-                    pil_image = PIL.Image.open(img_bytes)
-                    return pil_image, "Face swap completed successfully!"
-        
-        return None, "Face swap failed to generate result"
-    except Exception as e:
-        return None, f"Face swap error: {str(e)}"
+# Budget holder shared by everyone who is not signed in
+ANONYMOUS_QUOTA_ID = "anonymous"
 
+def current_quota_id():
+    """Whose budget model calls are charged to; visitor ids are chosen by the browser, so anonymous visitors share one budget"""
+    return current_user_email() or ANONYMOUS_QUOTA_ID
 
+def save_to_history(item_type, data, images=None, user_id=None, history_store=None, blob_store=None):
+    """Save operations to history, keeping any output images in the blob store; worker threads pass the stores in"""
+    blob_store = blob_store or get_blob_store()
+    image_digests = [blob_store.put(image) for image in images or []]
+    (history_store or get_history_store()).add(user_id or current_user_id(), item_type, data, image_digests)
 
-def advanced_edit_image(input_image, edit_type, options):
-    """Enhanced editing with all transformation capabilities"""
-    try:
-        client = get_client()
-        
-        # Build specific prompts for different edit types
-        if edit_type == "outfit_change":
-            prompt = f"Change the person's clothing to {options['clothing']}, keep same person, face, pose and background. {options.get('additional', '')}"
-            
-        elif edit_type == "pose_change":
-            prompt = f"Modify the person's pose to {options['pose']} with {options['expression']} facial expression. Keep same person, clothing, and background."
-            
-        elif edit_type == "face_enhancement":
-            prompt = f"Enhance the person's face: {options['enhancement']}. Keep everything else exactly the same. Make it look natural and professional."
-            
-        elif edit_type == "body_modification":
-            prompt = f"Modify the person's body: {options['modification']}. Keep face, clothing style, and background the same. Make it look natural and realistic."
-            
-        elif edit_type == "background_change":
-            prompt = f"Change the background to {options['background']}. Keep the person(s) exactly the same with proper lighting and shadows."
-            
-        elif edit_type == "object_control":
-            if options['action'] == 'remove':
-                prompt = f"Remove {options['object']} from the image. Fill the space naturally with appropriate background."
-            elif options['action'] == 'add':
-                prompt = f"Add {options['object']} to the image in a natural way that fits the scene and lighting."
-            else:
-                prompt = f"Replace {options['old_object']} with {options['new_object']} naturally in the scene."
-                
-        elif edit_type == "complete_makeover":
-            prompt = f"Complete transformation: change clothing to {options['clothing']}, modify pose to {options['pose']}, enhance face with {options['face_enhancement']}, expression to {options['expression']}. Keep same person and background."
-            
-        elif edit_type == "style_transfer":
-            prompt = f"Transform this image to {options['style']} style while maintaining all subjects and composition."
-            
-        else:  # custom edit
-            prompt = options.get('custom_prompt', 'Enhance this image professionally')
-        
-        response = client.models.generate_content(
-            model=MODEL_ID,
-            contents=[prompt, input_image],
-            config=types.GenerateContentConfig(
-                safety_settings=[
-                    types.SafetySetting(
-                        category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                        threshold=types.HarmBlockThreshold.BLOCK_NONE,
-                    )
-                ]
-            )
-        )
-        
-        for part in response.parts:
-            if hasattr(part, 'as_image') and part.as_image():
-                gemini_image = part.as_image()
-                
-                if gemini_image and hasattr(gemini_image, 'image_bytes'):
-                    # Convert the image_bytes to a PIL Image
-                    img_bytes = io.BytesIO(gemini_image.image_bytes)
-                    pil_image = PIL.Image.open(img_bytes)
-                    return pil_image, "Image transformation completed successfully!"
-        
-        return None, "No edited image generated"
-    except Exception as e:
-        return None, f"Editing error: {str(e)}"
+def show_history_images(item):
+    """Re-display stored outputs for a history row with download buttons"""
+    blob_store = get_blob_store()
+    cols = st.columns(min(3, len(item['images'])))
+    for i, digest in enumerate(item['images']):
+        with cols[i % 3]:
+            image = blob_store.get(digest)
+            if image is None:
+                st.caption("🗑️ Image no longer stored")
+                continue
+            st.image(thumbnail(image), caption=f"Image {i+1}")
+            create_download_link(image, f"history_{item['id']}_{i+1}")
 
+def paginated_history(item_type, key_prefix, search_label):
+    """Search box and pager for one history list; returns the page of items and its offset"""
+    store = get_history_store()
+    user_id = current_user_id()
+    
+    search = st.text_input(search_label, key=f"{key_prefix}_search")
+    total = store.count(user_id, item_type, search)
+    pages = max(1, math.ceil(total / HISTORY_PAGE_SIZE))
+    
+    page_key = f"{key_prefix}_page"
+    if st.session_state.get(page_key, 1) > pages:
+        st.session_state[page_key] = 1
+    page = st.number_input("Page:", min_value=1, max_value=pages, key=page_key) if pages > 1 else 1
+    
+    offset = (page - 1) * HISTORY_PAGE_SIZE
+    items = store.list(user_id, item_type, HISTORY_PAGE_SIZE, offset, search)
+    if items:
+        st.caption(f"Showing {offset + 1}–{offset + len(items)} of {total}")
+    return items, offset
 
-def analyze_image_content(image, analysis_type):
-    """Comprehensive image analysis and intelligence"""
-    try:
-        client = get_client()
-        
-        analysis_prompts = {
-            "complete": """
-            Provide comprehensive analysis of this image in the following structured format:
-            
-            CONTENT_ANALYSIS:
-            - Objects: List all objects, people, animals visible
-            - Scene_Type: Indoor/outdoor, location, environment
-            - Activities: What people are doing, actions happening
-            - Mood: Overall atmosphere and feeling
-            
-            TECHNICAL_QUALITY:
-            - Resolution_Score: Rate image sharpness (1-10)
-            - Lighting_Quality: Assess lighting quality (1-10) 
-            - Composition_Score: Photography composition (1-10)
-            - Color_Balance: Color accuracy and harmony (1-10)
-            - Professional_Rating: Overall professional quality (1-10)
-            
-            PEOPLE_ANALYSIS:
-            - Count: Number of people visible
-            - Demographics: Age groups, gender distribution
-            - Emotions: Facial expressions, mood analysis
-            - Clothing: Outfit styles, formality level
-            - Body_Language: Pose, confidence, energy
-            
-            BUSINESS_INTELLIGENCE:
-            - Commercial_Value: Business usage potential (1-10)
-            - Target_Audience: Who this appeals to
-            - Marketing_Effectiveness: Social media potential (1-10)
-            - Brand_Elements: Any logos, brands, products visible
-            - Usage_Recommendations: Best platforms, contexts
-            
-            IMPROVEMENT_SUGGESTIONS:
-            - Technical_Fixes: Specific quality improvements
-            - Composition_Tips: Framing and layout suggestions  
-            - Enhancement_Ideas: Creative improvement options
-            
-            KEYWORDS: 10 relevant tags for this image
-            """,
-            
-            "text_extraction": """
-            Extract and analyze ALL visible text in this image:
-            
-            EXTRACTED_TEXT:
-            [Provide all visible text exactly as it appears, maintaining formatting]
-            
-            TEXT_ANALYSIS:
-            - Language: Primary language(s) detected
-            - Text_Type: (document, sign, handwritten, printed, display, etc.)
-            - Structure: (paragraph, list, table, form, receipt, etc.)
-            - Quality_Score: Text clarity and readability (1-10)
-            - Business_Document_Type: (invoice, receipt, business card, form, etc.)
-            
-            STRUCTURED_DATA:
-            [If receipt/invoice: extract line items, totals, dates]
-            [If business card: extract name, phone, email, company]
-            [If form: extract field names and values]
-            [If table: organize data in rows and columns]
-            
-            KEYWORDS: Key terms and important phrases found
-            SUMMARY: Brief description of text content
-            
-            If no text is visible, clearly state "NO TEXT DETECTED"
-            """,
-            
-            "people_demographics": """
-            Analyze all people in this image:
-            
-            PEOPLE_COUNT: Exact number of people visible
-            
-            DEMOGRAPHICS:
-            - Age_Groups: Estimated age ranges for each person
-            - Gender_Distribution: Gender breakdown
-            - Ethnicity_Diversity: Cultural/ethnic representation
-            
-            FACIAL_ANALYSIS:
-            - Expressions: Each person's facial expression
-            - Emotions: Mood and emotional state
-            - Eye_Contact: Where people are looking
-            - Confidence_Level: Body language assessment
-            
-            CLOTHING_ANALYSIS:
-            - Outfit_Styles: Describe each person's clothing
-            - Formality_Level: Casual to formal rating (1-10)
-            - Color_Coordination: How well outfits work together
-            - Fashion_Era: Modern, vintage, traditional styling
-            
-            SOCIAL_DYNAMICS:
-            - Group_Interaction: How people relate to each other
-            - Professional_Suitability: Business usage appropriateness (1-10)
-            - Social_Media_Ready: Instagram/LinkedIn readiness (1-10)
-            """,
-            
-            "technical_quality": """
-            Technical photography analysis:
-            
-            IMAGE_QUALITY:
-            - Resolution: Image sharpness and detail (1-10)
-            - Exposure: Brightness and contrast balance (1-10) 
-            - Focus: Subject sharpness and depth (1-10)
-            - Noise_Level: Grain and digital noise (1-10)
-            
-            COMPOSITION:
-            - Rule_of_Thirds: Composition adherence (1-10)
-            - Balance: Visual weight distribution (1-10)
-            - Framing: Subject framing quality (1-10)
-            - Leading_Lines: Use of visual guides (1-10)
-            
-            LIGHTING:
-            - Lighting_Direction: Where light comes from
-            - Lighting_Quality: Soft/hard light assessment (1-10)
-            - Shadow_Detail: Shadow quality and placement (1-10)
-            - Color_Temperature: Warm/cool light balance
-            
-            COLOR_ANALYSIS:
-            - Color_Harmony: How colors work together (1-10)
-            - Saturation: Color intensity appropriateness (1-10)
-            - Contrast: Light/dark balance (1-10)
-            - Dominant_Colors: Primary colors in image
-            
-            PROFESSIONAL_ASSESSMENT:
-            - Commercial_Readiness: Ready for business use (1-10)
-            - Improvement_Priority: What to fix first
-            - Strengths: What's working well
-            - Technical_Recommendations: Specific fixes needed
-            """
-        }
-        
-        prompt = analysis_prompts.get(analysis_type, analysis_prompts["complete"])
-        
-        response = client.models.generate_content(
-            model=MODEL_ID,
-            contents=[prompt, image]
-        )
-        
-        analysis_text = ""
-        for part in response.parts:
-            if part.text:
-                analysis_text += part.text
-        
-        return analysis_text
-        
-    except Exception as e:
-        return f"Analysis error: {str(e)}"
-
-def save_to_history(item_type, data):
-    """Save operations to history"""
-    history_item = {
-        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        'type': item_type,
-        'data': data
-    }
+def create_download_link(image, filename, key=None):
+    """Create download button for images, reusing encoded bytes when available"""
+    if isinstance(image, EncodedImage):
+        data, mime_type, extension = image.data, image.mime_type, image.extension
+    else:
+        buf = io.BytesIO()
+        image.save(buf, format='PNG')
+        data, mime_type, extension = buf.getvalue(), "image/png", "png"
     
-    if item_type == 'generation':
-        st.session_state.generation_history.insert(0, history_item)
-        if len(st.session_state.generation_history) > 20:
-            st.session_state.generation_history.pop()
-    elif item_type == 'edit':
-        st.session_state.edit_history.insert(0, history_item)
-        if len(st.session_state.edit_history) > 20:
-            st.session_state.edit_history.pop()
-    else:  # analysis
-        st.session_state.analysis_history.insert(0, history_item)
-        if len(st.session_state.analysis_history) > 20:
-            st.session_state.analysis_history.pop()
-
-def create_download_link(image, filename):
-    """Create download button for images"""
-    buf = io.BytesIO()
-    image.save(buf, format='PNG')
     return st.download_button(
         f"📥 Download {filename}",
+        data,
+        f"{filename}.{extension}",
+        mime_type,
+        key=key
+    )
+
+# Preview sizes (longest edge) for on-screen display; downloads keep full resolution
+THUMBNAIL_GRID_EDGE = 384
+THUMBNAIL_COMPARE_EDGE = 640
+THUMBNAIL_SINGLE_EDGE = 1024
+THUMBNAIL_CACHE_TTL_SECONDS = 6 * 60 * 60
+THUMBNAIL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+@st.cache_resource
+def get_thumbnail_cache():
+    """Preview bytes keyed by (image hash, edge), shared by all sessions"""
+    return ResultCache(THUMBNAIL_CACHE_TTL_SECONDS, THUMBNAIL_CACHE_MAX_BYTES)
+
+def thumbnail(image, max_edge=THUMBNAIL_GRID_EDGE):
+    """Cached preview bytes for an encoded image, sized for where it is shown"""
+    cache = get_thumbnail_cache()
+    key = (image.digest, max_edge)
+    preview = cache.get(key)
+    if preview is None:
+        preview = make_thumbnail(image.data, max_edge)
+        cache.put(key, preview, len(preview))
+    return preview
+
+# Output encoding for batch results
+ENCODER_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+ENCODED_CACHE_TTL_SECONDS = 6 * 60 * 60
+ENCODED_CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+@st.cache_resource
+def get_encoder_pool():
+    """Process pool for image encoding; PNG compression holds the GIL for most of its run"""
+    return create_encoder_pool(ENCODER_WORKERS)
+
+@st.cache_resource
+def get_encoded_cache():
+    """Encoded outputs keyed by (image hash, format, quality), shared by all sessions"""
+    return ResultCache(ENCODED_CACHE_TTL_SECONDS, ENCODED_CACHE_MAX_BYTES)
+
+def create_zip_download(items, manifest, filename):
+    """Create download button for a ZIP of encoded results plus a JSON manifest"""
+    # st.download_button keeps its data in memory for as long as the button is shown, so the archive is
+    # built in memory too: roughly the total size of the encoded images, since entries are stored uncompressed.
+    # items may be a generator, so images loaded for the archive are not also held in a list
+    buf = io.BytesIO()
+    write_results_zip(buf, items, manifest)
+    return st.download_button(
+        "📦 Download All as ZIP",
         buf.getvalue(),
-        f"{filename}.png",
-        "image/png"
+        f"{filename}.zip",
+        "application/zip",
+        key=f"zip_{filename}"
     )
 
+# Analytics windows for model call latency
+CALL_WINDOWS = {"Last hour": 60 * 60, "Last 24 hours": 24 * 60 * 60, "Last 7 days": 7 * 24 * 60 * 60}
+CALL_TIMELINE_BUCKETS = 24
+
+# Background jobs
+JOB_POLL_SECONDS = 2
+
+@st.cache_resource
+def get_job_manager():
+    """Process-wide job manager; its workers keep running when a session reruns or disconnects"""
+    return JobManager(HISTORY_DB_PATH, get_blob_store())
+
+def batch_generation_job(studio, encoder_pool, encoded_cache, prompts, num_variants, max_in_flight, rate_limiter, force_fresh, output_format, output_quality, quota_id, report):
+    """Generate every (prompt x variant) and convert the results to the requested format"""
+    batch_jobs = studio.run_generation_batch(
+        prompts,
+        num_variants,
+        max_in_flight=max_in_flight,
+        rate_limiter=rate_limiter,
+        on_progress=report,
+        force_fresh=force_fresh,
+        user_id=quota_id
+    )
+    
+    successful_jobs = [job for job in batch_jobs if job['image'] is not None]
+    original_bytes = sum(len(job['image'].data) for job in successful_jobs)
+    encode_errors = {}
+    if successful_jobs:
+        encoded_images = encode_results(
+            [job['image'] for job in successful_jobs],
+            output_format,
+            output_quality,
+            encoder_pool,
+            encoded_cache,
+            errors=encode_errors
+        )
+        for job, encoded in zip(successful_jobs, encoded_images):
+            job['image'] = encoded
+        for i, error in encode_errors.items():
+            job = successful_jobs[i]
+            job['encode_error'] = f"kept as {job['image'].extension.upper()}: {error}"
+    
+    return {'jobs': batch_jobs, 'original_bytes': original_bytes}
+
+def batch_analysis_job(studio, files, analysis_type, max_in_flight, packed, quota_id, report):
+    """Analyze (filename, prepared image) pairs concurrently; per-image text streams into the job as it is generated"""
+    if packed:
+        return {'results': studio.run_packed_analysis_batch(files, analysis_type, max_in_flight, on_progress=report, user_id=quota_id)}
+    
+    def on_text(i, text):
+        report(item={'filename': files[i][0], 'analysis': text}, slot=i)
+    
+    def on_progress(done, total, result):
+        report(done, total)
+    
+    return {'results': studio.run_analysis_batch(files, analysis_type, max_in_flight, on_progress=on_progress, user_id=quota_id, on_text=on_text)}
+
+def face_swap_job(studio, history_store, blob_store, source_image, target_image, options, user_id, quota_id, report):
+    """Run a face swap and record it in history once it completes"""
+    report(0, 1)
+    edited_image, message = studio.face_swap_images(source_image, target_image, options, quota_id)
+    if edited_image:
+        save_to_history('edit', {
+            'edit_type': "👥 Face Swap",
+            'options': {k: v for k, v in options.items() if k != 'source_image'},
+            'success': True,
+            'timestamp': datetime.now().isoformat()
+        }, images=[edited_image], user_id=user_id, history_store=history_store, blob_store=blob_store)
+    report(1, 1)
+    return {'image': edited_image, 'message': message, 'source': source_image, 'target': target_image, 'options': options}
+
+@st.cache_resource
+def get_bulk_store():
+    """Process-wide record of offline bulk jobs, kept in the history database"""
+    return BulkJobStore(HISTORY_DB_PATH)
+
+@st.cache_resource
+def get_bulk_poller():
+    """Daemon thread collecting finished bulk jobs, including ones submitted before a restart"""
+    studio, bulk_store, history_store, blob_store = get_studio(), get_bulk_store(), get_history_store(), get_blob_store()
+    
+    def store_bulk_image(job, item, image):
+        # Keep a finished bulk result in the blob store and the submitting user's history
+        save_to_history('generation', {
+            'prompt': item['prompt'],
+            'variants': 1,
+            'batch_mode': 'bulk',
+            'bulk_job': job['name'],
+            'count': 1
+        }, images=[image], user_id=job['user_id'], history_store=history_store, blob_store=blob_store)
+    
+    def poll():
+        while True:
+            try:
+                studio.poll_bulk_jobs(bulk_store, on_image=store_bulk_image)
+            except Exception as e:
+                print(f"Bulk job poll failed: {e}")
+            time.sleep(BULK_POLL_SECONDS)
+    
+    thread = threading.Thread(target=poll, name="studio-bulk-poller", daemon=True)
+    thread.start()
+    return thread
+
+# Metrics exporter on a side port; set METRICS_PORT=0 to disable it
+METRICS_HOST = os.environ.get("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))
+
+@st.cache_resource
+def get_metrics():
+    """Process-wide metrics registry; the exporter thread starts with the first session"""
+    studio = get_studio()
+    registry = MetricsRegistry()
+    studio.call_log.add_listener(registry.observe_call)
+    registry.add_collector(gateway_collector(studio.gateway))
+    registry.add_collector(cache_collector({
+        'image': studio.image_cache,
+        'analysis': studio.analysis_cache,
+        'thumbnail': get_thumbnail_cache(),
+        'encoded': get_encoded_cache()
+    }))
+    if METRICS_PORT:
+        try:
+            serve_metrics(registry, METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            # Another server process on this host may already own the port
+            print(f"Metrics exporter not started: {e}")
+    return registry
+
 # Main app
 def main():
     st.markdown("""
@@ -556,9 +459,11 @@ def main():
         st.title("🎯 Dashboard")
         
         # Usage statistics
-        gen_count = len(st.session_state.generation_history)
-        edit_count = len(st.session_state.edit_history)
-        analysis_count = len(st.session_state.analysis_history)
+        history_store = get_history_store()
+        today_counts = history_store.counts_by_type(current_user_id(), since=datetime.now().strftime("%Y-%m-%d"))
+        gen_count = today_counts.get('generation', 0)
+        edit_count = today_counts.get('edit', 0)
+        analysis_count = today_counts.get('analysis', 0)
         
         st.markdown("**📊 Today's Usage**")
         col1, col2 = st.columns(2)
@@ -573,16 +478,15 @@ def main():
         
         # Quick actions
         if st.button("🔄 Clear All History"):
-            st.session_state.generation_history = []
-            st.session_state.edit_history = []
-            st.session_state.analysis_history = []
+            get_blob_store().release(history_store.clear(current_user_id()))
             st.success("All history cleared!")
         
         if st.button("📊 Export Usage Data"):
+            user_id = current_user_id()
             usage_data = {
-                'generations': st.session_state.generation_history,
-                'edits': st.session_state.edit_history,
-                'analyses': st.session_state.analysis_history
+                'generations': history_store.list(user_id, 'generation', limit=-1),
+                'edits': history_store.list(user_id, 'edit', limit=-1),
+                'analyses': history_store.list(user_id, 'analysis', limit=-1)
             }
             st.download_button(
                 "Download Usage Report",
@@ -644,6 +548,7 @@ def generation_tab():
         with col1c:
             batch_mode = st.checkbox("Batch Mode", False, help="Generate images from multiple prompts")
             auto_enhance = st.checkbox("Auto-Enhance Prompt", True)
+            force_fresh = st.checkbox("Force Fresh", False, help="Skip cached results and call the model again")
         
         # Batch generation option
         if batch_mode:
@@ -665,18 +570,22 @@ def generation_tab():
                     prompts_to_process = [enhanced_prompt]
                 
                 all_images = []
+                image_prompts = []
                 
                 for i, current_prompt in enumerate(prompts_to_process):
                     with st.spinner(f"🎨 Generating images {i+1}/{len(prompts_to_process)}..."):
-                        images, message = generate_image(current_prompt, num_variants)
+                        images, message = get_studio().generate_image(current_prompt, num_variants, force_fresh=force_fresh, user_id=current_quota_id())
                         all_images.extend(images)
+                        image_prompts.extend([current_prompt] * len(images))
+                        if len(images) < num_variants:
+                            st.warning(f"⚠️ {message}")
                 
                 if all_images:
                     st.success(f"✅ Generated {len(all_images)} images successfully!")
                     
                     # Display images in responsive grid
                     if len(all_images) == 1:
-                        st.image(all_images[0], use_column_width=True)
+                        st.image(thumbnail(all_images[0], THUMBNAIL_SINGLE_EDGE), use_column_width=True)
                         create_download_link(all_images[0], "generated_image")
                     else:
                         # Grid display for multiple images
@@ -685,13 +594,17 @@ def generation_tab():
                             cols = st.columns(cols_per_row)
                             for j, img in enumerate(all_images[i:i+cols_per_row]):
                                 with cols[j]:
-                                    st.image(img, caption=f"Image {i+j+1}")
+                                    st.image(thumbnail(img), caption=f"Image {i+j+1}")
                                     create_download_link(img, f"image_{i+j+1}")
                     
                     # Batch download option
                     if len(all_images) > 1:
-                        if st.button("📦 Download All as ZIP"):
-                            st.info("ZIP download feature coming soon!")
+                        create_zip_download(
+                            [(f"image_{i+1}", img, {'prompt': image_prompt})
+                             for i, (img, image_prompt) in enumerate(zip(all_images, image_prompts))],
+                            {'source': 'generate', 'style': style, 'aspect_ratio': aspect_ratio, 'variants': num_variants},
+                            "generated_images"
+                        )
                     
                     # Save to history
                     save_to_history('generation', {
@@ -700,7 +613,7 @@ def generation_tab():
                         'variants': num_variants,
                         'batch_mode': batch_mode,
                         'count': len(all_images)
-                    })
+                    }, images=all_images)
                 else:
                     st.error("Failed to generate images. Please try again.")
             else:
@@ -754,8 +667,9 @@ def editing_tab():
     )
     
     if uploaded_image:
-        image = PIL.Image.open(uploaded_image)
-        st.image(image, caption="📸 Original Image", use_column_width=True)
+        upload = prepare_upload(uploaded_image)
+        st.image(thumbnail(upload, THUMBNAIL_SINGLE_EDGE), caption="📸 Original Image", use_column_width=True)
+        st.caption(upload.payload_summary())
         
         # Main transformation type selection
         st.markdown("**🎯 Choose Transformation Type:**")
@@ -838,13 +752,14 @@ def editing_tab():
                     help="Clear frontal face photo works best"
                 )
                 if source_face:
-                    source_img = PIL.Image.open(source_face)
-                    st.image(source_img, caption="Source Face", use_column_width=True)
+                    source_img = prepare_upload(source_face)
+                    st.image(thumbnail(source_img, THUMBNAIL_COMPARE_EDGE), caption="Source Face", use_column_width=True)
+                    st.caption(source_img.payload_summary())
             
             with col2:
                 st.markdown("**🎯 Target Image (Body to Keep)**")
                 st.info("Using the main uploaded image as target body")
-                st.image(image, caption="Target Body", use_column_width=True)
+                st.image(thumbnail(upload, THUMBNAIL_COMPARE_EDGE), caption="Target Body", use_column_width=True)
             
             # Face swap options
             st.markdown("**⚙️ Face Swap Settings**")
@@ -1098,8 +1013,13 @@ def editing_tab():
             # Special handling for face swap
             if edit_type == "👥 Face Swap":
                 if 'source_image' in options and options['source_image'] is not None:
-                    with st.spinner("👥 Performing face swap..."):
-                        result = face_swap_images(options['source_image'], image, options)
+                    user_id = current_user_id()
+                    get_job_manager().submit(
+                        user_id, 'face_swap', "Face swap",
+                        face_swap_job, get_studio(), get_history_store(), get_blob_store(),
+                        options['source_image'], upload, options, user_id, current_quota_id()
+                    )
+                    st.info("👥 Face swap started in the background. You can keep working while it runs.")
                 else:
                     st.warning("⚠️ Please upload a source face image for face swap!")
                     return
@@ -1118,44 +1038,57 @@ def editing_tab():
                 }
                 
                 with st.spinner(f"✨ Performing {edit_type.lower()}..."):
-                    result = advanced_edit_image(image, edit_type_map[edit_type], options)
-            
-            edited_image, message = result
-            
-            if edited_image:
-                st.success(f"✅ {message}")
-                
-                # Before/After comparison
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.image(image, caption="📸 Before", use_column_width=True)
-                with col2:
-                    st.image(edited_image, caption="✨ After", use_column_width=True)
-                
-                # Special display for face swap
-                if edit_type == "👥 Face Swap" and 'source_image' in options:
-                    st.markdown("**👥 Face Swap Result**")
-                    col1, col2, col3 = st.columns(3)
-                    with col1:
-                        st.image(options['source_image'], caption="👤 Source Face", use_column_width=True)
-                    with col2:
-                        st.image(image, caption="🎯 Target Body", use_column_width=True)
-                    with col3:
-                        st.image(edited_image, caption="✨ Face Swapped", use_column_width=True)
+                    edited_image, message = get_studio().advanced_edit_image(upload, edit_type_map[edit_type], options, current_quota_id())
                 
-                # Download options
-                create_download_link(edited_image, f"transformed_{edit_type.replace(' ', '_').lower()}")
+                show_edit_result(edit_type, upload, edited_image, message, options)
                 
-                # Save to history
-                save_to_history('edit', {
-                    'edit_type': edit_type,
-                    'options': str(options),
-                    'success': True,
-                    'timestamp': datetime.now().isoformat()
-                })
-                
-            else:
-                st.error(f"❌ {message}")
+                if edited_image:
+                    # Save to history
+                    save_to_history('edit', {
+                        'edit_type': edit_type,
+                        'options': {k: v for k, v in options.items() if k != 'source_image'},
+                        'success': True,
+                        'timestamp': datetime.now().isoformat()
+                    }, images=[edited_image])
+        
+        if edit_type == "👥 Face Swap":
+            active_jobs_panel(('face_swap',))
+            finished_jobs_panel(('face_swap',))
+
+def show_edit_result(edit_type, original_image, edited_image, message, options):
+    """Before/after comparison and downloads for an edit or face swap result"""
+    if not edited_image:
+        st.error(f"❌ {message}")
+        return
+    
+    st.success(f"✅ {message}")
+    
+    # Before/After comparison
+    col1, col2 = st.columns(2)
+    with col1:
+        st.image(thumbnail(original_image, THUMBNAIL_COMPARE_EDGE), caption="📸 Before", use_column_width=True)
+    with col2:
+        st.image(thumbnail(edited_image, THUMBNAIL_COMPARE_EDGE), caption="✨ After", use_column_width=True)
+    
+    # Special display for face swap
+    if edit_type == "👥 Face Swap" and options.get('source_image') is not None:
+        st.markdown("**👥 Face Swap Result**")
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.image(thumbnail(options['source_image']), caption="👤 Source Face", use_column_width=True)
+        with col2:
+            st.image(thumbnail(original_image), caption="🎯 Target Body", use_column_width=True)
+        with col3:
+            st.image(thumbnail(edited_image), caption="✨ Face Swapped", use_column_width=True)
+    
+    # Download options
+    result_name = f"transformed_{edit_type.replace(' ', '_').lower()}"
+    create_download_link(edited_image, result_name, key=f"download_{edited_image.digest[:12]}")
+    create_zip_download(
+        [(result_name, edited_image, {'edit_type': edit_type})],
+        {'source': 'edit', 'edit_type': edit_type, 'options': {k: v for k, v in options.items() if k != 'source_image'}},
+        f"transformed_image_{edited_image.digest[:12]}"
+    )
 
 def analysis_tab():
     st.header("🔍 Smart Image Analysis & Text Extraction")
@@ -1169,8 +1102,9 @@ def analysis_tab():
     )
     
     if analysis_image:
-        image = PIL.Image.open(analysis_image)
-        st.image(image, caption="📸 Image for Analysis", use_column_width=True)
+        upload = prepare_upload(analysis_image)
+        st.image(thumbnail(upload, THUMBNAIL_SINGLE_EDGE), caption="📸 Image for Analysis", use_column_width=True)
+        st.caption(upload.payload_summary())
         
         # Analysis type selection
         st.markdown("**🎯 Choose Analysis Type:**")
@@ -1203,8 +1137,11 @@ def analysis_tab():
             with st.spinner("🧠 Analyzing image with AI..."):
                 
                 if analysis_type == "📝 Text Extraction (OCR)":
-                    # Text extraction analysis
-                    extracted_text = analyze_image_content(image, "text_extraction")
+                    # Text extraction analysis, shown incrementally while the model responds
+                    stream_placeholder = st.empty()
+                    with stream_placeholder.container():
+                        extracted_text = st.write_stream(get_studio().analyze_image_content_stream(upload, "text_extraction", current_quota_id()))
+                    stream_placeholder.empty()
                     
                     if extracted_text and "NO TEXT DETECTED" not in extracted_text.upper():
                         st.success("✅ Text extraction completed!")
@@ -1261,8 +1198,11 @@ def analysis_tab():
                         st.warning("⚠️ No text detected in this image.")
                 
                 else:
-                    # General image analysis
-                    analysis_result = analyze_image_content(image, analysis_type.split()[1].lower() if " " in analysis_type else "complete")
+                    # General image analysis, streamed first and then replaced by the structured view
+                    stream_placeholder = st.empty()
+                    with stream_placeholder.container():
+                        analysis_result = st.write_stream(get_studio().analyze_image_content_stream(upload, analysis_type.split()[1].lower() if " " in analysis_type else "complete", current_quota_id()))
+                    stream_placeholder.empty()
                     
                     if analysis_result:
                         st.success("✅ Analysis completed!")
@@ -1315,8 +1255,9 @@ def history_tab():
     
     with history_tab1:
         st.subheader("🎨 Generation History")
-        if st.session_state.generation_history:
-            for i, item in enumerate(st.session_state.generation_history):
+        items, offset = paginated_history('generation', "gen_history", "🔎 Search prompts:")
+        if items:
+            for i, item in enumerate(items, start=offset):
                 with st.expander(f"🎨 Generation {i+1} - {item['timestamp']}"):
                     data = item['data']
                     st.write(f"**Prompt:** {data.get('prompt', 'N/A')}")
@@ -1324,42 +1265,50 @@ def history_tab():
                     st.write(f"**Variants:** {data.get('variants', 1)}")
                     st.write(f"**Images Created:** {data.get('count', 1)}")
                     
+                    if item['images']:
+                        show_history_images(item)
+                    
                     col1, col2 = st.columns(2)
                     with col1:
-                        if st.button(f"🔄 Regenerate", key=f"regen_{i}"):
+                        if st.button(f"🔄 Regenerate", key=f"regen_{item['id']}"):
                             st.session_state.template_prompt = data.get('prompt', '')
                             st.info("Prompt copied! Go to Generate tab.")
                     with col2:
-                        if st.button(f"📋 Copy Prompt", key=f"copy_gen_{i}"):
+                        if st.button(f"📋 Copy Prompt", key=f"copy_gen_{item['id']}"):
                             st.code(data.get('prompt', ''))
         else:
             st.info("📭 No generations yet. Create your first image in the Generate tab!")
     
     with history_tab2:
         st.subheader("✏️ Transformation History")
-        if st.session_state.edit_history:
-            for i, item in enumerate(st.session_state.edit_history):
+        items, offset = paginated_history('edit', "edit_history", "🔎 Search transformations:")
+        if items:
+            for i, item in enumerate(items, start=offset):
                 with st.expander(f"✏️ Transform {i+1} - {item['timestamp']}"):
                     data = item['data']
                     st.write(f"**Type:** {data.get('edit_type', 'Unknown')}")
                     st.write(f"**Success:** {'✅' if data.get('success') else '❌'}")
                     st.write(f"**Timestamp:** {data.get('timestamp', 'N/A')}")
                     
-                    if st.button(f"📋 View Details", key=f"edit_details_{i}"):
+                    if item['images']:
+                        show_history_images(item)
+                    
+                    if st.button(f"📋 View Details", key=f"edit_details_{item['id']}"):
                         st.json(data.get('options', {}))
         else:
             st.info("📭 No transformations yet. Edit your first image in the Transform tab!")
     
     with history_tab3:
         st.subheader("🔍 Analysis History")
-        if st.session_state.analysis_history:
-            for i, item in enumerate(st.session_state.analysis_history):
+        items, offset = paginated_history('analysis', "analysis_history", "🔎 Search analyses:")
+        if items:
+            for i, item in enumerate(items, start=offset):
                 with st.expander(f"🔍 Analysis {i+1} - {item['timestamp']}"):
                     data = item['data']
                     st.write(f"**Analysis Type:** {data.get('analysis_type', 'Unknown')}")
                     st.write(f"**Success:** {'✅' if data.get('success') else '❌'}")
                     
-                    if st.button(f"📊 Re-run Analysis", key=f"rerun_analysis_{i}"):
+                    if st.button(f"📊 Re-run Analysis", key=f"rerun_analysis_{item['id']}"):
                         st.info("Go to Analysis tab to perform new analysis!")
         else:
             st.info("📭 No analysis performed yet. Analyze your first image in the Analysis tab!")
@@ -1411,6 +1360,217 @@ def history_tab():
                             st.session_state.template_prompt = template
                             st.success("✅ Copied!")
 
+def active_jobs(kinds):
+    """This user's queued and running jobs of the given kinds"""
+    return [job for job in get_job_manager().list(current_user_id(), kinds) if job['status'] in ('queued', 'running')]
+
+def active_jobs_panel(kinds):
+    """Live progress for this user's queued and running jobs; nothing polls while none are running"""
+    if active_jobs(kinds):
+        polling_jobs_panel(kinds)
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def polling_jobs_panel(kinds):
+    """Progress bars and streamed partial results, refreshing the page when a job finishes"""
+    manager = get_job_manager()
+    active = active_jobs(kinds)
+    
+    seen_key = f"active_jobs_{'_'.join(kinds)}"
+    active_ids = {job['id'] for job in active}
+    finished = st.session_state.get(seen_key, set()) - active_ids
+    st.session_state[seen_key] = active_ids
+    if finished or not active:
+        st.rerun()
+    
+    for job in active:
+        fraction = job['done'] / job['total'] if job['total'] else 0.0
+        st.progress(fraction, text=f"⏳ {job['description']} ({job['done']}/{job['total'] or '?'})")
+        show_partial_analyses(manager.partial_results(job['id']))
+
+def show_partial_analyses(items):
+    for item in items:
+        with st.expander(f"📊 {item['filename']} - Analysis"):
+            st.markdown(item['analysis'])
+
+def finished_jobs_panel(kinds):
+    """Results of this user's completed and failed jobs"""
+    manager = get_job_manager()
+    renderers = {
+        'batch_generation': show_batch_generation_result,
+        'batch_analysis': show_batch_analysis_result,
+        'face_swap': show_face_swap_result
+    }
+    
+    finished = [job for job in manager.list(current_user_id(), kinds) if job['status'] not in ('queued', 'running')]
+    for n, job in enumerate(finished):
+        icon = "✅" if job['status'] == 'done' else "❌"
+        # Results are only loaded for the newest job and for jobs the user opened; older ones stay one click away
+        opened_key = f"job_opened_{job['id']}"
+        opened = n == 0 or st.session_state.get(opened_key, False)
+        with st.expander(f"{icon} {job['description']} - {job['created_at']}", expanded=opened):
+            if job['status'] == 'failed':
+                st.error(f"❌ {job['error']}")
+                show_partial_analyses(manager.partial_results(job['id']))
+            elif not opened:
+                if st.button("📂 Show results", key=f"job_open_{job['id']}"):
+                    st.session_state[opened_key] = True
+                    st.rerun()
+            else:
+                result = manager.result(job['id'])
+                if result is None:
+                    st.info("⌛ No stored results for this job.")
+                else:
+                    renderers[job['kind']](job, result)
+            
+            if st.button("🗑️ Dismiss", key=f"dismiss_{job['id']}"):
+                manager.dismiss(job['id'])
+                st.session_state.pop(opened_key, None)
+                st.rerun()
+
+def show_batch_generation_result(job, result):
+    batch_jobs = result['jobs']
+    all_results = [item['image'] for item in batch_jobs if item['image'] is not None]
+    failed_jobs = [item for item in batch_jobs if item['error']]
+    
+    st.success(f"✅ Generated {len(all_results)} images from {len({item['prompt_index'] for item in batch_jobs})} prompts!")
+    if failed_jobs:
+        st.warning(f"⚠️ {len(failed_jobs)} of {len(batch_jobs)} requests failed")
+        for item in failed_jobs:
+            st.write(f"**Prompt {item['prompt_index']+1}, variant {item['variant']+1}:** {item['error']}")
+    unconverted = [item for item in batch_jobs if item.get('encode_error')]
+    if unconverted:
+        st.warning(f"⚠️ {len(unconverted)} images could not be converted and keep their original format")
+        for item in unconverted:
+            st.write(f"**Prompt {item['prompt_index']+1}, variant {item['variant']+1}:** {item['encode_error']}")
+    
+    # Display batch results
+    if all_results:
+        encoded_bytes = sum(len(img.data) for img in all_results)
+        st.caption(f"🗜️ Output: {format_bytes(encoded_bytes)} total (model output {format_bytes(result['original_bytes'])})")
+        
+        cols = st.columns(min(3, len(all_results)))
+        for i, img in enumerate(all_results):
+            with cols[i % 3]:
+                st.image(thumbnail(img), caption=f"Batch {i+1} · {format_bytes(len(img.data))}")
+                create_download_link(img, f"batch_image_{job['id'][:8]}_{i+1}")
+        
+        # The archive is as large as every image together, so it is only built on request
+        if st.button("📦 Prepare ZIP", key=f"batch_zip_{job['id']}"):
+            successful_jobs = [item for item in batch_jobs if item['image'] is not None]
+            create_zip_download(
+                [(f"batch_image_{i+1}", item['image'], {'prompt': item['prompt'], 'prompt_index': item['prompt_index'], 'variant': item['variant']})
+                 for i, item in enumerate(successful_jobs)],
+                {'source': 'batch_generation', 'job': job['id'], 'description': job['description']},
+                f"batch_images_{job['id'][:8]}"
+            )
+
+def show_batch_analysis_result(job, result):
+    results = result['results']
+    st.success(f"✅ Analyzed {len(results)} images!")
+    
+    # Display batch analysis results
+    for item in results:
+        st.markdown(f"**📊 {item['filename']} - Analysis**")
+        st.markdown(item['analysis'])
+    
+    # Export batch results
+    batch_report = {
+        'analysis_type': job['description'],
+        'timestamp': job['updated_at'],
+        'results': results
+    }
+    st.download_button(
+        "📋 Download Batch Report",
+        json.dumps(batch_report, indent=2),
+        "batch_analysis_report.json",
+        "application/json",
+        key=f"batch_report_{job['id']}"
+    )
+
+def show_face_swap_result(job, result):
+    show_edit_result("👥 Face Swap", result['target'], result['image'], result['message'], result['options'])
+
+BULK_STATE_LABELS = {
+    'JOB_STATE_PENDING': "⏳ Queued",
+    'JOB_STATE_QUEUED': "⏳ Queued",
+    'JOB_STATE_RUNNING': "⚙️ Running",
+    'JOB_STATE_CANCELLING': "🛑 Cancelling",
+    'JOB_STATE_SUCCEEDED': "✅ Done",
+    'JOB_STATE_PARTIALLY_SUCCEEDED': "⚠️ Partly done",
+    'JOB_STATE_FAILED': "❌ Failed",
+    'JOB_STATE_CANCELLED': "🛑 Cancelled",
+    'JOB_STATE_EXPIRED': "⌛ Expired",
+}
+BULK_PREVIEW_LIMIT = 12
+
+def bulk_zip_items(blob_store, items):
+    """Yield ZIP entries for stored bulk results, reading each blob only when the archive writes it"""
+    for i, item in enumerate(items):
+        image = blob_store.get(item['digest'])
+        if image is not None:
+            yield f"bulk_image_{i+1}", image, {'prompt': item['prompt'], 'prompt_index': item['prompt_index'], 'variant': item['variant']}
+
+@st.fragment(run_every=BULK_POLL_SECONDS)
+def bulk_jobs_panel():
+    """This user's offline bulk jobs with state, counts and collected results"""
+    store = get_bulk_store()
+    jobs = store.list_jobs(current_user_id())
+    if not jobs:
+        st.caption("No bulk jobs yet.")
+        return
+    
+    for job in jobs:
+        label = BULK_STATE_LABELS.get(job['state'], job['state'])
+        created = datetime.fromtimestamp(job['created_at']).strftime("%Y-%m-%d %H:%M")
+        summary = f"{job['succeeded']}/{job['total']} images" if job['collected'] else f"{job['total']} images"
+        with st.expander(f"{label} · {job['display_name']} · {summary} · {created}"):
+            if job['error']:
+                st.warning(f"⚠️ {job['error']}")
+            
+            if not job['collected']:
+                if job['state'] in BULK_DONE_STATES:
+                    st.info("📥 Finished; results are being collected.")
+                else:
+                    st.info(f"🌙 Checked every {BULK_POLL_SECONDS} seconds. Results land in your history as soon as the job finishes.")
+                if job['state'] not in BULK_DONE_STATES and st.button("🛑 Cancel", key=f"bulk_cancel_{job['name']}"):
+                    ok, message = get_studio().cancel_bulk_job(store, job['name'])
+                    (st.success if ok else st.error)(message)
+                continue
+            
+            items = store.items(job['name'])
+            failed = [item for item in items if item['error']]
+            if failed:
+                st.warning(f"⚠️ {len(failed)} of {len(items)} requests failed")
+                for item in failed[:BULK_PREVIEW_LIMIT]:
+                    st.write(f"**Prompt {item['prompt_index']+1}, variant {item['variant']+1}:** {item['error']}")
+            
+            done = [item for item in items if item['digest']]
+            if done:
+                blob_store = get_blob_store()
+                preview = done[:BULK_PREVIEW_LIMIT]
+                cols = st.columns(min(3, len(preview)))
+                for i, item in enumerate(preview):
+                    image = blob_store.get(item['digest'])
+                    with cols[i % 3]:
+                        if image is None:
+                            st.caption("🗑️ Image no longer stored")
+                        else:
+                            st.image(thumbnail(image), caption=f"Prompt {item['prompt_index']+1} · v{item['variant']+1}")
+                if len(done) > len(preview):
+                    st.caption(f"Showing {len(preview)} of {len(done)} images; all of them are in your generation history.")
+                
+                # Packing thousands of images is only worth doing on request
+                if st.button("📦 Prepare ZIP", key=f"bulk_zip_{job['name']}"):
+                    create_zip_download(
+                        bulk_zip_items(blob_store, done),
+                        {'source': 'bulk_generation', 'job': job['name'], 'description': job['display_name']},
+                        f"bulk_images_{job['name'].rsplit('/', 1)[-1][:8]}"
+                    )
+            
+            if st.button("🗑️ Dismiss", key=f"bulk_dismiss_{job['name']}"):
+                store.delete_job(job['name'])
+                st.rerun()
+
 def pro_features_tab():
     st.header("💡 Professional Features & Business Tools")
     
@@ -1432,37 +1592,68 @@ def pro_features_tab():
                 height=150
             )
             
+            batch_mode = st.radio(
+                "Mode:",
+                ["⚡ Live", "🌙 Offline bulk"],
+                horizontal=True,
+                help="Offline bulk jobs run on the Gemini batch queue at about half the price. Results arrive within 24 hours, even if you close this page."
+            )
+            
             col1, col2 = st.columns(2)
             with col1:
                 batch_style = st.selectbox("Style for all:", ["None"] + list(STYLE_PRESETS.keys()))
                 batch_variants = st.slider("Variants per prompt:", 1, 3, 1)
+                if batch_mode == "⚡ Live":
+                    batch_max_in_flight = st.slider("Parallel requests:", 1, 16, BATCH_MAX_IN_FLIGHT)
             with col2:
                 batch_quality = st.checkbox("Quality boost for all", True)
-                batch_format = st.selectbox("Output format:", ["PNG", "JPEG", "WEBP"])
+                if batch_mode == "⚡ Live":
+                    batch_format = st.selectbox("Output format:", ["PNG", "JPEG", "WEBP"])
+                    batch_rate = st.number_input("Requests per minute:", 1, 600, BATCH_REQUESTS_PER_MINUTE, help="Applies to this batch only; all batches on this server together stay under a server-wide limit. Cached images do not count")
+                    batch_force_fresh = st.checkbox("Force fresh (skip cache)", False)
             
-            if st.button("🚀 Generate Batch Images"):
+            if batch_mode == "🌙 Offline bulk":
+                if st.button("🌙 Submit Bulk Job"):
+                    prompts = [p.strip() for p in batch_prompts.split('\n') if p.strip()]
+                    if prompts:
+                        enhanced_prompts = [enhance_prompt(p, batch_style, "Default", batch_quality) for p in prompts]
+                        with st.spinner("📤 Submitting bulk job..."):
+                            names, message = get_studio().submit_bulk_generation(
+                                enhanced_prompts,
+                                batch_variants,
+                                get_bulk_store(),
+                                user_id=current_user_id(),
+                                display_name=f"{len(prompts)} prompts × {batch_variants} ({batch_style})",
+                                quota_id=current_quota_id()
+                            )
+                        (st.success if names else st.error)(f"🌙 {message}")
+                    else:
+                        st.warning("⚠️ Please enter batch prompts!")
+                
+                bulk_jobs_panel()
+            
+            elif st.button("🚀 Generate Batch Images"):
                 if batch_prompts.strip():
                     prompts = [p.strip() for p in batch_prompts.split('\n') if p.strip()]
+                    enhanced_prompts = [enhance_prompt(p, batch_style, "Default", batch_quality) for p in prompts]
+                    output_quality = quality_from_setting(st.session_state.get('compression_quality', 9))
                     
-                    all_results = []
-                    progress_bar = st.progress(0)
-                    
-                    for i, prompt in enumerate(prompts):
-                        enhanced_prompt = enhance_prompt(prompt, batch_style, "Default", batch_quality)
-                        images, _ = generate_image(enhanced_prompt, batch_variants)
-                        all_results.extend(images)
-                        progress_bar.progress((i + 1) / len(prompts))
-                    
-                    st.success(f"✅ Generated {len(all_results)} images from {len(prompts)} prompts!")
-                    
-                    # Display batch results
-                    cols = st.columns(min(3, len(all_results)))
-                    for i, img in enumerate(all_results):
-                        with cols[i % 3]:
-                            st.image(img, caption=f"Batch {i+1}")
-                            create_download_link(img, f"batch_image_{i+1}")
+                    user_id = current_user_id()
+                    rate_limiter = RateLimiter(int(batch_rate), parent=get_rate_limiter())
+                    get_job_manager().submit(
+                        user_id, 'batch_generation',
+                        f"Batch generation: {len(prompts)} prompts × {batch_variants} ({batch_format})",
+                        batch_generation_job, get_studio(), get_encoder_pool(), get_encoded_cache(),
+                        enhanced_prompts, batch_variants, batch_max_in_flight,
+                        rate_limiter, batch_force_fresh, batch_format, output_quality, current_quota_id()
+                    )
+                    st.info("🚀 Batch started in the background. Progress and results appear below.")
                 else:
                     st.warning("⚠️ Please enter batch prompts!")
+            
+            if batch_mode == "⚡ Live":
+                active_jobs_panel(('batch_generation',))
+                finished_jobs_panel(('batch_generation',))
         
         elif batch_operation == "Batch Analysis":
             st.markdown("**📊 Multiple Image Analysis**")
@@ -1470,7 +1661,7 @@ def pro_features_tab():
                 "Upload multiple images:",
                 type=['png', 'jpg', 'jpeg'],
                 accept_multiple_files=True,
-                help="Upload up to 10 images for batch analysis"
+                help="Upload images for batch analysis"
             )
             
             if uploaded_files:
@@ -1478,47 +1669,36 @@ def pro_features_tab():
                     "Analysis Type:",
                     ["Complete Analysis", "Text Extraction", "Quality Assessment", "Business Intelligence"]
                 )
+                pack_images = st.checkbox(
+                    "📦 Pack several images per request",
+                    True,
+                    help=f"Sends up to {PACK_MAX_IMAGES} images in one request and reads back one result per file, so large batches need far fewer round trips"
+                )
                 
                 if st.button("🔍 Analyze All Images"):
-                    results = []
-                    progress_bar = st.progress(0)
-                    
-                    for i, file in enumerate(uploaded_files):
-                        image = PIL.Image.open(file)
-                        analysis = analyze_image_content(image, analysis_type_batch.lower().replace(" ", "_"))
-                        results.append({
-                            'filename': file.name,
-                            'analysis': analysis
-                        })
-                        progress_bar.progress((i + 1) / len(uploaded_files))
-                    
-                    st.success(f"✅ Analyzed {len(results)} images!")
-                    
-                    # Display batch analysis results
-                    for i, result in enumerate(results):
-                        with st.expander(f"📊 {result['filename']} - Analysis"):
-                            st.markdown(result['analysis'])
-                    
-                    # Export batch results
-                    batch_report = {
-                        'analysis_type': analysis_type_batch,
-                        'timestamp': datetime.now().isoformat(),
-                        'results': results
-                    }
-                    st.download_button(
-                        "📋 Download Batch Report",
-                        json.dumps(batch_report, indent=2),
-                        "batch_analysis_report.json",
-                        "application/json"
+                    # Uploads must be read on the script thread before handing them to a worker
+                    files = [(file.name, prepare_upload(file)) for file in uploaded_files]
+                    user_id = current_user_id()
+                    get_job_manager().submit(
+                        user_id, 'batch_analysis',
+                        f"Batch analysis: {len(files)} images ({analysis_type_batch})",
+                        batch_analysis_job, get_studio(),
+                        files, analysis_type_batch.lower().replace(" ", "_"), BATCH_MAX_IN_FLIGHT, pack_images, current_quota_id()
                     )
+                    st.info("🔍 Analysis started in the background. Results appear below as they finish.")
+            
+            active_jobs_panel(('batch_analysis',))
+            finished_jobs_panel(('batch_analysis',))
     
     with pro_tab2:
         st.subheader("📊 Usage Analytics & Insights")
         
         # Usage metrics
-        total_generations = len(st.session_state.generation_history)
-        total_edits = len(st.session_state.edit_history)
-        total_analyses = len(st.session_state.analysis_history)
+        history_store = get_history_store()
+        type_counts = history_store.counts_by_type(current_user_id())
+        total_generations = type_counts.get('generation', 0)
+        total_edits = type_counts.get('edit', 0)
+        total_analyses = type_counts.get('analysis', 0)
         total_operations = total_generations + total_edits + total_analyses
         
         # Metrics display
@@ -1549,17 +1729,94 @@ def pro_features_tab():
             st.markdown("**📈 Feature Usage Breakdown**")
             
             # Most used features
-            feature_usage = {}
-            for item in st.session_state.edit_history:
-                edit_type = item['data'].get('edit_type', 'Unknown')
-                feature_usage[edit_type] = feature_usage.get(edit_type, 0) + 1
-            
-            if feature_usage:
-                for feature, count in sorted(feature_usage.items(), key=lambda x: x[1], reverse=True):
-                    st.write(f"**{feature}:** {count} times")
+            for feature, count in history_store.counts_by_operation(current_user_id(), 'edit'):
+                st.write(f"**{feature}:** {count} times")
         
         else:
             st.info("📊 Start using the app to see analytics!")
+        
+        # Cache effectiveness across all sessions in this process
+        st.markdown("**⚡ Analysis Cache**")
+        cache_stats = get_studio().analysis_cache.stats()
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.metric("Cache Hits", cache_stats['hits'])
+        with col2:
+            st.metric("Cache Misses", cache_stats['misses'])
+        with col3:
+            st.metric("Hit Ratio", f"{cache_stats['hit_ratio']:.0%}")
+        with col4:
+            st.metric("Cached Results", cache_stats['entries'])
+        
+        st.markdown("**🛡️ Model Call Reliability**")
+        gateway_stats = get_studio().gateway.stats()
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.metric("Model Calls", gateway_stats['calls'])
+        with col2:
+            st.metric("Retries", gateway_stats['retries'])
+        with col3:
+            st.metric("Failed Calls", gateway_stats['failures'])
+        with col4:
+            st.metric("Fast-Failed", gateway_stats['circuit_rejections'])
+        if gateway_stats['ttft_p50'] is not None:
+            col1, col2 = st.columns(2)
+            with col1:
+                st.metric("Time to First Token (p50)", f"{gateway_stats['ttft_p50']:.2f}s")
+            with col2:
+                st.metric("Time to First Token (p95)", f"{gateway_stats['ttft_p95']:.2f}s")
+        for model, state in gateway_stats['breakers'].items():
+            st.write(f"**{model}:** circuit {state}")
+        
+        st.markdown("**⏱️ Model Call Latency**")
+        window_label = st.selectbox("Window:", list(CALL_WINDOWS.keys()), key="call_window")
+        window_seconds = CALL_WINDOWS[window_label]
+        calls = get_studio().call_log.since(window_seconds)
+        if calls:
+            summary = summarize_calls(calls)
+            operations = list(summary)
+            st.bar_chart(
+                {
+                    'operation': operations,
+                    'p50': [summary[op]['p50'] for op in operations],
+                    'p95': [summary[op]['p95'] for op in operations],
+                    'p99': [summary[op]['p99'] for op in operations],
+                },
+                x='operation',
+                y=['p50', 'p95', 'p99'],
+                y_label="seconds",
+                stack=False
+            )
+            
+            timeline = latency_timeline(calls, window_seconds / CALL_TIMELINE_BUCKETS)
+            starts = sorted({start for points in timeline.values() for start, _ in points})
+            if len(starts) > 1:
+                st.caption("p95 latency over time")
+                chart = {'time': [datetime.fromtimestamp(start) for start in starts]}
+                for operation, points in timeline.items():
+                    values = dict(points)
+                    chart[operation] = [values.get(start) for start in starts]
+                st.line_chart(chart, x='time', y=list(timeline), y_label="seconds")
+            
+            st.dataframe([
+                {
+                    'Operation': operation,
+                    'Calls': stats['calls'],
+                    'Errors': f"{stats['error_rate']:.1%}",
+                    'p50 (s)': stats['p50'],
+                    'p95 (s)': stats['p95'],
+                    'p99 (s)': stats['p99'],
+                    'TTFB p50 (s)': stats['ttfb_p50'],
+                    'Quota Wait p95 (s)': stats['queue_wait_p95'],
+                    'Sent': format_bytes(stats['request_bytes']),
+                    'Received': format_bytes(stats['response_bytes']),
+                    'Prompt Tokens': stats['prompt_tokens'],
+                    'Output Tokens': stats['candidate_tokens'],
+                }
+                for operation, stats in summary.items()
+            ], use_container_width=True, hide_index=True)
+        else:
+            st.info("⏱️ No model calls recorded in this window yet")
     
     with pro_tab3:
         st.subheader("⚙️ Advanced Settings & Configuration")
@@ -1575,7 +1832,7 @@ def pro_features_tab():
         with col2:
             default_variants = st.slider("Default variants:", 1, 4, 2)
             save_originals = st.checkbox("Save original images", True)
-            compression_quality = st.slider("Image quality:", 1, 10, 9)
+            compression_quality = st.slider("Image quality:", 1, 10, 9, key="compression_quality")
         
         st.markdown("**🔒 Privacy & Safety Settings**")
         col3, col4 = st.columns(2)
@@ -1593,7 +1850,18 @@ def pro_features_tab():
         # API usage monitoring
         st.markdown("**📊 API Usage Monitoring**")
         st.info("🔋 API Credits: Monitor your Google API usage in Google Cloud Console")
-        st.info("💰 Current Limit: ₹1000/month (You're protected from overspending)")
+        usage = get_studio().quota.usage(current_quota_id())
+        currency = usage['currency']
+        # A budget of 0 refuses every request, so its bar shows as full
+        st.progress(
+            min(1.0, usage['user_spent'] / usage['user_budget']) if usage['user_budget'] else 1.0,
+            text=f"💰 {'Your' if current_user_email() else 'Anonymous visitors’'} spend: {currency}{usage['user_spent']:,.2f} of {currency}{usage['user_budget']:,.0f} (last {usage['window_days']} days)"
+        )
+        st.progress(
+            min(1.0, usage['global_spent'] / usage['global_budget']) if usage['global_budget'] else 1.0,
+            text=f"🏢 App spend: {currency}{usage['global_spent']:,.2f} of {currency}{usage['global_budget']:,.0f} (last {usage['window_days']} days)"
+        )
+        st.caption("Requests that would go over budget are refused before they are sent.")
         
         if st.button("🔄 Reset All Settings"):
             st.warning("This will reset all settings to default values.")
@@ -1627,23 +1895,31 @@ def manage_downloads():
 
 # Main execution
 if __name__ == "__main__":
-    # Display app info
-    st.markdown("""
-    <div style="text-align: center; padding: 1rem; background: #f8fafc; border-radius: 8px; margin-bottom: 1rem;">
-        <h3>🚀 Complete AI Image Studio</h3>
-        <p><strong>68+ Features:</strong> Generation • Editing • Face Swap • Body Modification • Analysis • OCR</p>
-        <p><em>Professional-grade AI image processing for businesses and creators</em></p>
-    </div>
-    """, unsafe_allow_html=True)
+    metrics = get_metrics()
+    # Resumes collecting bulk jobs left open by a previous server process
+    get_bulk_poller()
+    run_started = time.monotonic()
+    try:
+        # Display app info
+        st.markdown("""
+        <div style="text-align: center; padding: 1rem; background: #f8fafc; border-radius: 8px; margin-bottom: 1rem;">
+            <h3>🚀 Complete AI Image Studio</h3>
+            <p><strong>68+ Features:</strong> Generation • Editing • Face Swap • Body Modification • Analysis • OCR</p>
+            <p><em>Professional-grade AI image processing for businesses and creators</em></p>
+        </div>
+        """, unsafe_allow_html=True)
     
-    main()
+        main()
     
-    # Footer with feature summary
-    st.markdown("---")
-    st.markdown("""
-    <div style="text-align: center; padding: 1rem; color: #6b7280; font-size: 0.9rem;">
-        <p><strong>🎨 AI Image Studio Pro</strong> - Your complete AI-powered image solution</p>
-        <p>Generation • Transformation • Enhancement • Analysis • Extraction</p>
-        <p>Built with ❤️ using Streamlit + Google Gemini AI</p>
-    </div>
-    """, unsafe_allow_html=True)
+        # Footer with feature summary
+        st.markdown("---")
+        st.markdown("""
+        <div style="text-align: center; padding: 1rem; color: #6b7280; font-size: 0.9rem;">
+            <p><strong>🎨 AI Image Studio Pro</strong> - Your complete AI-powered image solution</p>
+            <p>Generation • Transformation • Enhancement • Analysis • Extraction</p>
+            <p>Built with ❤️ using Streamlit + Google Gemini AI</p>
+        </div>
+        """, unsafe_allow_html=True)
+    finally:
+        # Reruns interrupted by st.rerun/st.stop still count
+        metrics.observe_rerun(current_session_id(), time.monotonic() - run_started)
@@ -0,0 +1,349 @@
+"""End-to-end benchmarks of the app's code paths against a simulated Gemini backend.
+
+    python studio_benchmark.py --output before.json
+    python studio_benchmark.py --output after.json --compare before.json
+    python studio_benchmark.py --scenarios generate,upload --iterations 50 --latency-ms 1500
+
+Each scenario runs the same engine calls the Streamlit handlers make. Timings
+cover everything between the click and the result being ready to render or
+download. The default backend is the in-process fake from fake_gemini.py;
+--backend can point at a fake_gemini server or, with GOOGLE_API_KEY, the live API.
+Every iteration starts with empty caches.
+
+Reported per scenario: p50/p95/p99 latency, throughput, bytes encoded and the
+peak RSS so far. Peak RSS covers this process and, separately, the encoder pool.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import PIL.Image
+
+from fake_gemini import FakeClient, FakeGeminiBackend
+from image_encoder import FORMAT_MIME_TYPES, create_encoder_pool, quality_from_setting
+from studio_engine import (
+    BATCH_MAX_IN_FLIGHT,
+    UPLOAD_MAX_EDGE,
+    DecodedImageCache,
+    EncodedImage,
+    RateLimiter,
+    Studio,
+    create_client,
+    encode_results,
+    enhance_prompt,
+    make_thumbnail,
+    percentile,
+    prepare_image_bytes,
+    write_results_zip,
+)
+
+# Sizes the app renders previews at (THUMBNAIL_SINGLE_EDGE / THUMBNAIL_GRID_EDGE in streamlit_app.py)
+SINGLE_PREVIEW_EDGE = 1024
+GRID_PREVIEW_EDGE = 384
+
+DEFAULT_ITERATIONS = {
+    'generate': 20,
+    'batch_generation': 3,
+    'batch_analysis': 5,
+    'batch_analysis_packed': 5,
+    'upload': 20,
+    'download': 5,
+}
+
+PROMPTS = [
+    "A lighthouse on a rocky coast at sunset",
+    "Portrait of an astronaut in a sunflower field",
+    "A cozy reading nook with rain on the window",
+    "Street market in Marrakech at golden hour",
+    "A fox curled up in fresh snow",
+]
+
+
+def peak_rss_bytes(who=resource.RUSAGE_SELF):
+    """Peak resident set size; ru_maxrss is KiB on Linux and bytes on macOS"""
+    peak = resource.getrusage(who).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def synthetic_photo(width, height, seed):
+    """JPEG bytes resembling a phone photo: smooth gradients with sensor-like noise"""
+    rng = random.Random(seed)
+    base = PIL.Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    tint = PIL.Image.new('RGB', (width, height), tuple(rng.randrange(256) for _ in range(3)))
+    noise = PIL.Image.effect_noise((width, height), 24).convert('RGB')
+    photo = PIL.Image.blend(PIL.Image.blend(base, tint, 0.5), noise, 0.15)
+    buf = io.BytesIO()
+    photo.save(buf, format='JPEG', quality=92)
+    return buf.getvalue()
+
+
+class Bench:
+    """Shared client, encoder pool and settings for all scenarios"""
+
+    def __init__(self, args, client):
+        self.args = args
+        self.client = client
+        self.pool = create_encoder_pool(args.encoder_workers)
+        self.quality = quality_from_setting(args.quality)
+        self.workdir = tempfile.mkdtemp(prefix="studio-bench-")
+        self.download_images = None
+        self.uploads = [synthetic_photo(args.upload_width, args.upload_height, seed) for seed in range(8)]
+
+    def studio(self):
+        """Engine with empty caches, as on a fresh server process"""
+        return Studio(self.client, image_cache_dir=tempfile.mkdtemp(dir=self.workdir))
+
+    def rate_limiter(self):
+        return RateLimiter(self.args.rpm, burst=self.args.concurrency) if self.args.rpm else None
+
+    def prompt(self, i):
+        return enhance_prompt(PROMPTS[i % len(PROMPTS)] + f" #{i}", "Photorealistic", "Square (1:1)")
+
+    def package(self, images, name):
+        """Convert results to the output format and build the ZIP download, returning bytes written"""
+        encoded = encode_results(images, self.args.format, self.quality, self.pool)
+        items = [(f"{name}_{i+1}", image, {}) for i, image in enumerate(encoded)]
+        # The app builds ZIP downloads in memory, since st.download_button holds them there anyway
+        buf = io.BytesIO()
+        write_results_zip(buf, items, {'benchmark': name})
+        zip_bytes = buf.tell()
+        return sum(len(image.data) for image in encoded) + zip_bytes
+
+    def close(self):
+        self.pool.shutdown()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def scenario_generate(bench, i):
+    """Generate click: variants in parallel, then previews for the result grid"""
+    images, _ = bench.studio().generate_image(bench.prompt(i), bench.args.variants, force_fresh=True)
+    edge = SINGLE_PREVIEW_EDGE if len(images) == 1 else GRID_PREVIEW_EDGE
+    previews = [make_thumbnail(image.data, edge) for image in images]
+    return len(images), sum(len(p) for p in previews), bench.args.variants - len(images)
+
+
+def scenario_batch_generation(bench, i):
+    """Pro Features batch: every prompt x variant, format conversion and the ZIP download"""
+    prompts = [bench.prompt(i * bench.args.batch_prompts + p) for p in range(bench.args.batch_prompts)]
+    jobs = bench.studio().run_generation_batch(
+        prompts,
+        bench.args.batch_variants,
+        max_in_flight=bench.args.concurrency,
+        rate_limiter=bench.rate_limiter(),
+        force_fresh=True
+    )
+    images = [job['image'] for job in jobs if job['image'] is not None]
+    encoded_bytes = bench.package(images, "batch") if images else 0
+    return len(images), encoded_bytes, len(jobs) - len(images)
+
+
+def scenario_batch_analysis(bench, i):
+    """Pro Features batch analysis of uploaded images"""
+    files = [
+        (f"photo_{n}.jpg", prepare_image_bytes(bench.uploads[n % len(bench.uploads)]))
+        for n in range(bench.args.analysis_images)
+    ]
+    results = bench.studio().run_analysis_batch(files, "complete", max_in_flight=bench.args.concurrency)
+    failed = sum(1 for r in results if r['analysis'].startswith("Analysis error"))
+    return len(results) - failed, 0, failed
+
+
+def scenario_batch_analysis_packed(bench, i):
+    """Batch analysis with several images packed into each request"""
+    files = [
+        (f"photo_{n}.jpg", prepare_image_bytes(bench.uploads[n % len(bench.uploads)]))
+        for n in range(bench.args.analysis_images)
+    ]
+    results = bench.studio().run_packed_analysis_batch(files, "complete", max_in_flight=bench.args.concurrency)
+    failed = sum(1 for r in results if r['analysis'].startswith("Analysis error"))
+    return len(results) - failed, 0, failed
+
+
+def scenario_upload(bench, i):
+    """Upload handling: EXIF fix, downscale, re-encode and decode for display"""
+    cache = DecodedImageCache(256 * 1024 * 1024)
+    data = bench.uploads[i % len(bench.uploads)]
+    prepared = cache.get_or_create(i, lambda: prepare_image_bytes(data, UPLOAD_MAX_EDGE))
+    return 1, len(prepared.data), 0
+
+
+def scenario_download(bench, i):
+    """Download-all of generated images: format conversion plus ZIP packaging, no model calls"""
+    if bench.download_images is None:
+        bench.download_images, _ = bench.studio().generate_image("download benchmark", bench.args.variants, force_fresh=True)
+    # Fresh objects so cached digests don't carry over between iterations
+    images = [EncodedImage(image.data, image.mime_type) for image in bench.download_images]
+    return len(images), bench.package(images, "download"), 0
+
+
+SCENARIOS = {
+    'generate': scenario_generate,
+    'batch_generation': scenario_batch_generation,
+    'batch_analysis': scenario_batch_analysis,
+    'batch_analysis_packed': scenario_batch_analysis_packed,
+    'upload': scenario_upload,
+    'download': scenario_download,
+}
+
+
+def run_scenario(bench, name, iterations, warmup):
+    """Time each iteration and summarize latency, throughput and bytes"""
+    fn = SCENARIOS[name]
+    for i in range(warmup):
+        fn(bench, -1 - i)
+
+    latencies = []
+    items = bytes_encoded = failures = 0
+    for i in range(iterations):
+        started = time.perf_counter()
+        done, encoded, failed = fn(bench, i)
+        latencies.append(time.perf_counter() - started)
+        items += done
+        bytes_encoded += encoded
+        failures += failed
+
+    elapsed = sum(latencies)
+    return {
+        'iterations': iterations,
+        'items': items,
+        'failures': failures,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'latency_mean': elapsed / iterations if iterations else None,
+        'throughput_items_per_s': items / elapsed if elapsed else None,
+        'bytes_encoded': bytes_encoded,
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def print_summary(report, baseline=None):
+    """Human-readable table on stderr, with % change against a baseline report when given"""
+    header = f"{'scenario':<18}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'items/s':>10}{'encoded':>12}{'fail':>6}"
+    print(header, file=sys.stderr)
+    for name, result in report['scenarios'].items():
+        print(
+            f"{name:<18}{result['latency_p50']:>9.3f}{result['latency_p95']:>9.3f}{result['latency_p99']:>9.3f}"
+            f"{result['throughput_items_per_s'] or 0:>10.2f}{result['bytes_encoded']:>12,}{result['failures']:>6}",
+            file=sys.stderr
+        )
+        old = (baseline or {}).get('scenarios', {}).get(name)
+        if old:
+            changes = []
+            for key in ('latency_p50', 'latency_p95', 'latency_p99', 'throughput_items_per_s'):
+                if old.get(key) and result.get(key) is not None:
+                    changes.append(f"{key} {(result[key] - old[key]) / old[key]:+.1%}")
+            print(f"{'':<18}vs {baseline.get('revision') or 'baseline'}: {', '.join(changes)}", file=sys.stderr)
+    print(
+        f"peak RSS: {report['peak_rss_bytes'] / 2**20:.1f} MiB (encoder pool {report['peak_rss_children_bytes'] / 2**20:.1f} MiB)",
+        file=sys.stderr
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the studio's code paths against a simulated backend")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated subset of " + ", ".join(SCENARIOS))
+    parser.add_argument("--iterations", type=int, help="iterations per scenario (default: per-scenario)")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed iterations per scenario")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="earlier JSON report to show changes against")
+    parser.add_argument("--backend", default="fake", help='"fake", a fake_gemini server URL, or "live"')
+    parser.add_argument("--latency-ms", type=float, default=300, help="fake backend median latency")
+    parser.add_argument("--latency-sigma", type=float, default=0.4, help="fake backend latency spread")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fake backend injected error rate")
+    parser.add_argument("--image-edge", type=int, default=1024, help="fake backend image size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--variants", type=int, default=2, help="images per prompt")
+    parser.add_argument("--batch-prompts", type=int, default=20, help="prompts per batch generation")
+    parser.add_argument("--batch-variants", type=int, default=1, help="images per prompt in batch generation")
+    parser.add_argument("--analysis-images", type=int, default=10, help="images per batch analysis")
+    parser.add_argument("--upload-width", type=int, default=4032)
+    parser.add_argument("--upload-height", type=int, default=3024)
+    parser.add_argument("--concurrency", type=int, default=BATCH_MAX_IN_FLIGHT)
+    parser.add_argument("--rpm", type=int, default=0, help="batch rate limit as in the app (which uses 60); 0 disables it")
+    parser.add_argument("--format", choices=sorted(FORMAT_MIME_TYPES), default="JPEG", help="download format")
+    parser.add_argument("--quality", type=int, default=9, help="1-10 download quality")
+    parser.add_argument("--encoder-workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    backend = None
+    if args.backend == "fake":
+        backend = FakeGeminiBackend(
+            latency_ms=args.latency_ms,
+            latency_sigma=args.latency_sigma,
+            error_rate=args.error_rate,
+            image_edge=args.image_edge,
+            seed=args.seed,
+        )
+        client = FakeClient(backend)
+    else:
+        client = create_client(os.environ.get("GOOGLE_API_KEY"), args.backend)
+
+    bench = Bench(args, client)
+    scenarios = {}
+    try:
+        for name in names:
+            iterations = args.iterations or DEFAULT_ITERATIONS[name]
+            print(f"running {name} x{iterations}", file=sys.stderr)
+            scenarios[name] = run_scenario(bench, name, iterations, args.warmup)
+    finally:
+        bench.close()
+
+    report = {
+        'revision': git_revision(),
+        'created': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        'scenarios': scenarios,
+        'peak_rss_bytes': peak_rss_bytes(),
+        'peak_rss_children_bytes': peak_rss_bytes(resource.RUSAGE_CHILDREN),
+        'backend': backend.stats() if backend else None,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_summary(report, baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
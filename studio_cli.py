@@ -0,0 +1,160 @@
+"""Generate images from a prompt file without a browser session.
+
+    GOOGLE_API_KEY=... python studio_cli.py prompts.txt --out results/ --variants 2
+    python studio_cli.py prompts.txt --backend fake --out /tmp/results
+    cat prompts.txt | python studio_cli.py - --out results/ --format JPEG --quality 8
+
+Prompts are read one per line; blank lines and lines starting with # are skipped.
+Images are written to the output directory as they complete, followed by a
+manifest.json. The exit status is non-zero when any image failed.
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from image_encoder import FORMAT_MIME_TYPES, create_encoder_pool, encode_image_bytes, quality_from_setting
+from studio_engine import (
+    ASPECT_RATIOS,
+    BATCH_MAX_IN_FLIGHT,
+    BATCH_REQUESTS_PER_MINUTE,
+    GEMINI_BACKEND,
+    MIME_EXTENSIONS,
+    STYLE_PRESETS,
+    RateLimiter,
+    Studio,
+    create_client,
+    enhance_prompt,
+)
+
+# Files are written by a small thread pool so slow disks don't hold up result collection
+WRITER_WORKERS = 4
+
+
+def read_prompts(source):
+    """Prompts from a file path, or stdin when source is "-" """
+    handle = sys.stdin if source == "-" else open(source, encoding="utf-8")
+    try:
+        return [line.strip() for line in handle if line.strip() and not line.lstrip().startswith("#")]
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+
+
+def parse_args(argv=None):
+    """Command line options"""
+    parser = argparse.ArgumentParser(description="Batch image generation without Streamlit")
+    parser.add_argument("prompts", help='prompt file, one prompt per line, or "-" for stdin')
+    parser.add_argument("--out", default="output", help="directory for generated images (default: output)")
+    parser.add_argument("--variants", type=int, default=1, help="images per prompt (default: 1)")
+    parser.add_argument("--style", choices=["None"] + sorted(STYLE_PRESETS), default="None", help="style preset")
+    parser.add_argument("--aspect-ratio", choices=["Default"] + sorted(ASPECT_RATIOS), default="Default", help="aspect ratio")
+    parser.add_argument("--no-quality-boost", action="store_true", help="don't append quality keywords to prompts")
+    parser.add_argument("--concurrency", type=int, default=BATCH_MAX_IN_FLIGHT, help="max requests in flight")
+    parser.add_argument("--rpm", type=int, default=BATCH_REQUESTS_PER_MINUTE, help="max requests per minute")
+    parser.add_argument("--format", choices=sorted(FORMAT_MIME_TYPES), help="re-encode outputs to this format")
+    parser.add_argument("--quality", type=int, default=9, help="1-10 quality for JPEG/WEBP output (default: 9)")
+    parser.add_argument("--backend", default=GEMINI_BACKEND, help='"live", "fake" or a fake_gemini server URL')
+    parser.add_argument("--force-fresh", action="store_true", help="skip cached images and call the model again")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    prompts = read_prompts(args.prompts)
+    if not prompts:
+        print("No prompts to generate", file=sys.stderr)
+        return 1
+
+    api_key = os.environ.get("GOOGLE_API_KEY")
+    if not api_key and args.backend == "live":
+        print("GOOGLE_API_KEY is not set", file=sys.stderr)
+        return 1
+
+    os.makedirs(args.out, exist_ok=True)
+    studio = Studio(create_client(api_key, args.backend))
+    rate_limiter = RateLimiter(args.rpm, burst=args.concurrency)
+    quality = quality_from_setting(args.quality)
+    final_prompts = [
+        enhance_prompt(prompt, args.style, args.aspect_ratio, not args.no_quality_boost)
+        for prompt in prompts
+    ]
+
+    encoder = create_encoder_pool() if args.format else None
+    writer = ThreadPoolExecutor(max_workers=WRITER_WORKERS)
+    writes = []
+
+    def save(job):
+        name = f"prompt_{job['prompt_index'] + 1:04d}_v{job['variant'] + 1}"
+        data, mime_type = job['image'].data, job['image'].mime_type
+        if encoder:
+            data = encoder.submit(encode_image_bytes, data, args.format, quality).result()
+            mime_type = FORMAT_MIME_TYPES[args.format]
+        filename = f"{name}.{MIME_EXTENSIONS.get(mime_type, 'png')}"
+        with open(os.path.join(args.out, filename), "wb") as f:
+            f.write(data)
+        return filename
+
+    def on_result(job):
+        if job['image'] is not None:
+            writes.append((job, writer.submit(save, job)))
+
+    def on_progress(done, total):
+        print(f"\r{done}/{total} images", end="", file=sys.stderr, flush=True)
+
+    try:
+        jobs = studio.run_generation_batch(
+            final_prompts,
+            args.variants,
+            max_in_flight=args.concurrency,
+            rate_limiter=rate_limiter,
+            on_progress=on_progress,
+            force_fresh=args.force_fresh,
+            on_result=on_result
+        )
+        print(file=sys.stderr)
+
+        files = {}
+        for job, future in writes:
+            try:
+                files[id(job)] = future.result()
+            except Exception as e:
+                job['error'] = f"write failed: {str(e)}"
+    finally:
+        writer.shutdown()
+        if encoder:
+            encoder.shutdown()
+
+    manifest = {
+        'created': datetime.now().isoformat(),
+        'style': args.style,
+        'aspect_ratio': args.aspect_ratio,
+        'variants': args.variants,
+        'format': args.format,
+        'gateway': studio.gateway.stats(),
+        'files': [
+            {
+                'prompt': prompts[job['prompt_index']],
+                'final_prompt': job['prompt'],
+                'variant': job['variant'] + 1,
+                'file': files.get(id(job)),
+                'error': job['error'],
+            }
+            for job in jobs
+        ]
+    }
+    with open(os.path.join(args.out, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, default=str)
+
+    failed = [job for job in jobs if job['error']]
+    for job in failed:
+        print(f"prompt {job['prompt_index'] + 1} variant {job['variant'] + 1}: {job['error']}", file=sys.stderr)
+    print(f"Wrote {len(jobs) - len(failed)}/{len(jobs)} images to {args.out}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
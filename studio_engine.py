@@ -0,0 +1,2470 @@
+"""Model-calling, prompt-building and image-handling code shared by the app and the CLI.
+
+Nothing here imports Streamlit, so the engine can be driven from scripts and
+cron jobs. streamlit_app.py wraps a process-wide Studio in st.cache_resource.
+"""
+import hashlib
+import itertools
+import io
+import json
+import math
+import os
+import random
+import sqlite3
+import textwrap
+import threading
+import time
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import PIL.Image
+import PIL.ImageOps
+from google import genai
+from google.genai import types
+
+from image_encoder import FORMAT_MIME_TYPES, encode_image_bytes
+
+MODEL_ID = "gemini-2.5-flash-image-preview"
+
+# "live" for the Gemini API, "fake" for the in-process stand-in, or a URL such as a local fake_gemini server
+GEMINI_BACKEND = os.environ.get("GEMINI_BACKEND", "live")
+
+def create_client(api_key=None, backend=GEMINI_BACKEND):
+    """Gemini client for the configured backend; only the live API needs a real key"""
+    if backend == "fake":
+        from fake_gemini import FakeClient
+        return FakeClient()
+    if backend.startswith(("http://", "https://")):
+        return genai.Client(api_key=api_key or "fake", http_options=types.HttpOptions(base_url=backend))
+    return genai.Client(api_key=api_key)
+
+# Upper bound on simultaneous generate_content calls per generate_image request
+MAX_CONCURRENT_VARIANTS = 4
+
+# Batch scheduler defaults for Pro Features batch generation
+BATCH_MAX_IN_FLIGHT = 8
+BATCH_REQUESTS_PER_MINUTE = 60
+# Ceiling on the combined rate of every batch running in one process
+BATCH_SERVER_REQUESTS_PER_MINUTE = int(os.environ.get("BATCH_SERVER_REQUESTS_PER_MINUTE", "600"))
+
+class RateLimiter:
+    """Thread-safe token bucket shared by batch workers; a parent limiter caps several buckets together"""
+    
+    def __init__(self, requests_per_minute, burst=BATCH_MAX_IN_FLIGHT, parent=None):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.parent = parent
+    
+    def acquire(self):
+        """Block until a request slot is available here and in the parent"""
+        self._take()
+        if self.parent is not None:
+            self.parent.acquire()
+    
+    def _take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# On-disk cache for generated image bytes
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", os.path.join(".cache", "images"))
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+class ImageCache:
+    """Content-addressed on-disk store for generated image bytes with LRU eviction"""
+    
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        
+        # Rebuild LRU order from the modification times left by previous runs
+        files = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.tmp') or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name, stat.st_size))
+        
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total_bytes += size
+        self._evict()
+    
+    @staticmethod
+    def make_key(*parts):
+        """Hash request parameters into a stable cache key"""
+        payload = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+    
+    def get(self, key):
+        """Return cached bytes for key, or None on a miss"""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.total_bytes -= self.entries.pop(key, 0)
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return data
+    
+    def put(self, key, data):
+        """Store bytes under key, evicting least recently used entries over budget"""
+        if len(data) > self.max_bytes:
+            return
+        
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        
+        with self.lock:
+            self.total_bytes -= self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            self.total_bytes += len(data)
+            self._evict()
+    
+    def stats(self):
+        """Snapshot of cache counters for display"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+                'bytes': self.total_bytes
+            }
+    
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+# In-memory cache for analysis results
+ANALYSIS_CACHE_TTL_SECONDS = 60 * 60
+ANALYSIS_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+class ResultCache:
+    """Thread-safe in-memory LRU cache with per-entry TTL, a size cap and hit/miss counters"""
+    
+    def __init__(self, ttl_seconds, max_bytes):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, key, value, size):
+        """Store value under key, evicting least recently used entries over budget"""
+        if size > self.max_bytes:
+            return
+        
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, value, size)
+            self.total_bytes += size
+            
+            while self.total_bytes > self.max_bytes and self.entries:
+                self._remove(next(iter(self.entries)))
+    
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+    
+    def stats(self):
+        """Snapshot of cache counters for display"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+                'bytes': self.total_bytes
+            }
+
+class SingleFlight:
+    """Coalesce concurrent identical calls so only one reaches the model"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+    
+    def _claim(self, key):
+        """(True, future to complete) for the caller that leads a key, else (False, the leader's result)"""
+        while True:
+            with self.lock:
+                future = self.in_flight.get(key)
+                leader = future is None
+                if leader:
+                    future = Future()
+                    self.in_flight[key] = future
+            
+            if leader:
+                return True, future
+            
+            try:
+                return False, future.result()
+            except CancelledError:
+                # The leading session was interrupted (e.g. a rerun); retry as a new caller
+                continue
+    
+    def do(self, key, fn, *args, **kwargs):
+        """Run fn once per key at a time; concurrent callers with the same key wait for its result"""
+        leader, claim = self._claim(key)
+        if not leader:
+            return claim
+        future = claim
+        
+        try:
+            result = fn(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+    
+    def do_stream(self, key, fn, *args, **kwargs):
+        """Generator form of do for text streams: the leader yields fn's chunks as they arrive, waiting callers get the joined text"""
+        leader, claim = self._claim(key)
+        if not leader:
+            yield claim
+            return
+        future = claim
+        
+        chunks = []
+        try:
+            for chunk in fn(*args, **kwargs):
+                chunks.append(chunk)
+                yield chunk
+            future.set_result("".join(chunks))
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        except BaseException:
+            # Includes GeneratorExit when the consumer stops reading early
+            future.cancel()
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+# Retry and circuit breaker policy for model calls
+MODEL_MAX_RETRIES = 3
+RETRY_BASE_DELAY_SECONDS = 1.0
+RETRY_MAX_DELAY_SECONDS = 30.0
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 30.0
+
+# Number of recent time-to-first-token samples kept for streaming calls
+TTFT_SAMPLE_SIZE = 500
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers, or None when empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+class CircuitOpenError(Exception):
+    """Raised when a model's circuit breaker is rejecting calls"""
+
+def _is_retryable(error):
+    """Transient upstream failures (rate limits, overload, network) are worth retrying"""
+    code = getattr(error, 'code', None)
+    if isinstance(code, int):
+        return code in RETRYABLE_STATUS_CODES
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    # httpx transport errors do not derive from the builtin network exceptions
+    return any(cls.__name__ == 'TransportError' for cls in type(error).__mro__)
+
+def _retry_after_seconds(error):
+    """Delay requested by the server via Retry-After, if any"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers or not hasattr(headers, 'get'):
+        return None
+    try:
+        return max(0.0, float(headers.get('retry-after')))
+    except (TypeError, ValueError):
+        return None
+
+class CircuitBreaker:
+    """Fast-fail calls to a model after repeated transient failures"""
+    
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.probe_ticket = None
+    
+    def allow(self):
+        """A truthy ticket if a call may proceed; lets a single probe through once the cooldown has passed"""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_seconds and not self.probe_in_flight:
+                self.probe_in_flight = True
+                self.probe_ticket = object()
+                return self.probe_ticket
+            return False
+    
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probe_in_flight = False
+            self.probe_ticket = None
+    
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probe_in_flight = False
+            self.probe_ticket = None
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+    
+    def record_neutral(self, ticket=None):
+        """End an attempt that says nothing about upstream health, freeing the probe slot only if the ticket from allow() holds it"""
+        with self.lock:
+            if self.probe_in_flight and ticket is not None and ticket is self.probe_ticket:
+                self.probe_in_flight = False
+                self.probe_ticket = None
+    
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if self.probe_in_flight else "open"
+
+# Per-call instrumentation: recent calls stay in memory, all calls are persisted in batches
+CALL_LOG_SIZE = 2000
+CALL_LOG_FLUSH_SIZE = 50
+CALL_LOG_FLUSH_SECONDS = 5.0
+CALL_LOG_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+CALL_LOG_FIELDS = (
+    'created_at', 'operation', 'model', 'outcome', 'error', 'attempts', 'wall_time', 'ttfb',
+    'request_bytes', 'response_bytes', 'prompt_tokens', 'candidate_tokens', 'total_tokens', 'queue_wait', 'mode'
+)
+
+def content_bytes(contents):
+    """Approximate request payload: UTF-8 text plus inline image bytes"""
+    items = contents if isinstance(contents, (list, tuple)) else [contents]
+    total = 0
+    for item in items:
+        if isinstance(item, str):
+            total += len(item.encode('utf-8'))
+        elif getattr(item, 'inline_data', None) is not None and item.inline_data.data:
+            total += len(item.inline_data.data)
+        elif getattr(item, 'text', None):
+            total += len(item.text.encode('utf-8'))
+    return total
+
+def response_bytes(response):
+    """Text and inline image bytes carried by a response or stream chunk"""
+    total = 0
+    for part in getattr(response, 'parts', None) or []:
+        if part.text:
+            total += len(part.text.encode('utf-8'))
+        inline_data = getattr(part, 'inline_data', None)
+        if inline_data is not None and inline_data.data:
+            total += len(inline_data.data)
+    return total
+
+def usage_tokens(response):
+    """(prompt, candidate, total) token counts from usage_metadata, None where not reported"""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return None, None, None
+    return usage.prompt_token_count, usage.candidates_token_count, usage.total_token_count
+
+class CallLog:
+    """Ring buffer of recent model calls, flushed in batches to SQLite when a path is given"""
+    
+    def __init__(self, db_path=None, size=CALL_LOG_SIZE, retention_seconds=CALL_LOG_RETENTION_SECONDS):
+        self.lock = threading.Lock()
+        self.records = deque(maxlen=size)
+        self.pending = []
+        self.last_flush = time.monotonic()
+        self.retention_seconds = retention_seconds
+        self.listeners = []
+        self.conn = None
+        self.db_lock = threading.Lock()
+        
+        if db_path:
+            directory = os.path.dirname(db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row
+            with self.db_lock, self.conn:
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS model_calls (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        created_at REAL NOT NULL,
+                        operation TEXT NOT NULL,
+                        model TEXT NOT NULL,
+                        outcome TEXT NOT NULL,
+                        error TEXT,
+                        attempts INTEGER,
+                        wall_time REAL,
+                        ttfb REAL,
+                        request_bytes INTEGER,
+                        response_bytes INTEGER,
+                        prompt_tokens INTEGER,
+                        candidate_tokens INTEGER,
+                        total_tokens INTEGER,
+                        queue_wait REAL,
+                        mode TEXT
+                    )
+                """)
+                columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(model_calls)")}
+                for column, column_type in (('queue_wait', 'REAL'), ('mode', 'TEXT')):
+                    if column not in columns:
+                        self.conn.execute(f"ALTER TABLE model_calls ADD COLUMN {column} {column_type}")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_model_calls_created ON model_calls (created_at)")
+    
+    def record(self, **fields):
+        """Add one call; persistence happens every CALL_LOG_FLUSH_SIZE calls or CALL_LOG_FLUSH_SECONDS"""
+        record = {name: fields.get(name) for name in CALL_LOG_FIELDS}
+        record['created_at'] = record['created_at'] or time.time()
+        for listener in self.listeners:
+            listener(record)
+        with self.lock:
+            self.records.append(record)
+            if self.conn is None:
+                return
+            self.pending.append(record)
+            due = len(self.pending) >= CALL_LOG_FLUSH_SIZE or time.monotonic() - self.last_flush >= CALL_LOG_FLUSH_SECONDS
+        if due:
+            self.flush()
+    
+    def add_listener(self, listener):
+        """Call listener(record) for every call recorded from now on"""
+        self.listeners.append(listener)
+    
+    def flush(self):
+        """Write pending records and drop rows past the retention window"""
+        with self.lock:
+            batch, self.pending = self.pending, []
+            self.last_flush = time.monotonic()
+        if self.conn is None or not batch:
+            return
+        placeholders = ", ".join("?" for _ in CALL_LOG_FIELDS)
+        with self.db_lock, self.conn:
+            self.conn.executemany(
+                f"INSERT INTO model_calls ({', '.join(CALL_LOG_FIELDS)}) VALUES ({placeholders})",
+                [tuple(record[name] for name in CALL_LOG_FIELDS) for record in batch]
+            )
+            self.conn.execute("DELETE FROM model_calls WHERE created_at < ?", (time.time() - self.retention_seconds,))
+    
+    def recent(self):
+        """Calls still in the ring buffer, oldest first"""
+        with self.lock:
+            return list(self.records)
+    
+    def since(self, seconds):
+        """Calls from the last `seconds`, read from SQLite when persisted and the ring buffer otherwise"""
+        cutoff = time.time() - seconds
+        if self.conn is None:
+            return [record for record in self.recent() if record['created_at'] >= cutoff]
+        self.flush()
+        with self.db_lock:
+            rows = self.conn.execute(
+                f"SELECT {', '.join(CALL_LOG_FIELDS)} FROM model_calls WHERE created_at >= ? ORDER BY created_at",
+                (cutoff,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+def summarize_calls(records):
+    """Per-operation call counts, error rate, latency percentiles, bytes and tokens"""
+    groups = {}
+    for record in records:
+        groups.setdefault(record['operation'], []).append(record)
+    
+    summary = {}
+    for operation, calls in sorted(groups.items()):
+        ok = [call for call in calls if call['outcome'] == 'ok']
+        wall_times = [call['wall_time'] for call in ok if call['wall_time'] is not None]
+        ttfbs = [call['ttfb'] for call in ok if call['ttfb'] is not None]
+        queue_waits = [call['queue_wait'] for call in calls if call.get('queue_wait') is not None]
+        summary[operation] = {
+            'calls': len(calls),
+            'errors': len(calls) - len(ok),
+            'error_rate': (len(calls) - len(ok)) / len(calls),
+            'p50': percentile(wall_times, 50),
+            'p95': percentile(wall_times, 95),
+            'p99': percentile(wall_times, 99),
+            'ttfb_p50': percentile(ttfbs, 50),
+            'ttfb_p95': percentile(ttfbs, 95),
+            'queue_wait_p95': percentile(queue_waits, 95),
+            'request_bytes': sum(call['request_bytes'] or 0 for call in calls),
+            'response_bytes': sum(call['response_bytes'] or 0 for call in calls),
+            'prompt_tokens': sum(call['prompt_tokens'] or 0 for call in calls),
+            'candidate_tokens': sum(call['candidate_tokens'] or 0 for call in calls),
+        }
+    return summary
+
+def latency_timeline(records, bucket_seconds, pct=95):
+    """{operation: [(bucket start, percentile wall time)]} over fixed time buckets of successful calls"""
+    buckets = {}
+    for record in records:
+        if record['outcome'] != 'ok' or record['wall_time'] is None:
+            continue
+        start = record['created_at'] - record['created_at'] % bucket_seconds
+        buckets.setdefault(record['operation'], {}).setdefault(start, []).append(record['wall_time'])
+    return {
+        operation: [(start, percentile(values, pct)) for start, values in sorted(by_start.items())]
+        for operation, by_start in buckets.items()
+    }
+
+# Spend limits over a rolling window, in the budget currency
+QUOTA_CURRENCY = os.environ.get("QUOTA_CURRENCY", "₹")
+QUOTA_GLOBAL_BUDGET = float(os.environ.get("QUOTA_GLOBAL_BUDGET", "1000"))
+QUOTA_USER_BUDGET = float(os.environ.get("QUOTA_USER_BUDGET", "250"))
+QUOTA_WINDOW_SECONDS = 30 * 24 * 60 * 60
+QUOTA_BUCKET_SECONDS = 60 * 60
+
+# How long a call waits for in-flight reservations to settle before it is rejected
+QUOTA_QUEUE_SECONDS = 30.0
+
+# List prices in USD per million tokens; QUOTA_FX_RATE converts them to the budget currency
+PRICE_INPUT_PER_MILLION = 0.30
+PRICE_TEXT_OUTPUT_PER_MILLION = 2.50
+PRICE_IMAGE_OUTPUT_PER_MILLION = 30.0
+QUOTA_FX_RATE = float(os.environ.get("QUOTA_FX_RATE", "88"))
+
+# Token counts used to price a call before it is sent
+INPUT_IMAGE_TOKENS = 258
+OUTPUT_IMAGE_TOKENS = 1290
+TEXT_OUTPUT_ESTIMATE_TOKENS = 1000
+IMAGE_OPERATIONS = ('generate', 'edit', 'face_swap')
+
+class QuotaExceededError(Exception):
+    """Raised before a model call when it would take a user or the whole app over budget"""
+
+def response_image_count(response):
+    """Number of inline images in a response"""
+    return sum(1 for part in getattr(response, 'parts', None) or [] if getattr(part, 'inline_data', None) is not None)
+
+class RollingBudget:
+    """Spend over a sliding window, kept as per-bucket totals plus a running sum"""
+    
+    def __init__(self, window_seconds=QUOTA_WINDOW_SECONDS, bucket_seconds=QUOTA_BUCKET_SECONDS):
+        self.window_seconds = window_seconds
+        self.bucket_seconds = bucket_seconds
+        self.buckets = deque()
+        self.total = 0.0
+    
+    def _expire(self, now):
+        cutoff = now - self.window_seconds
+        while self.buckets and self.buckets[0][0] + self.bucket_seconds <= cutoff:
+            self.total -= self.buckets.popleft()[1]
+    
+    def add(self, amount, now):
+        start = now - now % self.bucket_seconds
+        if self.buckets and self.buckets[-1][0] >= start:
+            self.buckets[-1][1] += amount
+        else:
+            self.buckets.append([start, amount])
+        self.total += amount
+    
+    def spent(self, now):
+        self._expire(now)
+        return max(0.0, self.total)
+    
+    def frees_at(self, amount, budget, now):
+        """When enough spend ages out of the window for `amount` to fit in `budget`, or None if it never will"""
+        remaining = self.spent(now)
+        if remaining + amount <= budget:
+            return now
+        for start, spent in self.buckets:
+            remaining -= spent
+            if remaining + amount <= budget:
+                return start + self.bucket_seconds + self.window_seconds
+        return None
+
+class QuotaManager:
+    """Per-user and global rolling spend budgets, persisted to SQLite, with reservations for calls in flight"""
+    
+    def __init__(self, db_path=None, global_budget=QUOTA_GLOBAL_BUDGET, user_budget=QUOTA_USER_BUDGET,
+                 window_seconds=QUOTA_WINDOW_SECONDS, bucket_seconds=QUOTA_BUCKET_SECONDS):
+        self.global_budget = global_budget
+        self.user_budget = user_budget
+        self.window_seconds = window_seconds
+        self.bucket_seconds = bucket_seconds
+        self.cond = threading.Condition()
+        self.global_spend = RollingBudget(window_seconds, bucket_seconds)
+        self.user_spend = {}
+        self.global_reserved = 0.0
+        self.user_reserved = {}
+        self.conn = None
+        self.db_lock = threading.Lock()
+        
+        if db_path:
+            directory = os.path.dirname(db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            with self.db_lock, self.conn:
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS quota_usage (
+                        bucket_start INTEGER NOT NULL,
+                        user_id TEXT NOT NULL,
+                        cost REAL NOT NULL,
+                        prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                        candidate_tokens INTEGER NOT NULL DEFAULT 0,
+                        images INTEGER NOT NULL DEFAULT 0,
+                        calls INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (bucket_start, user_id)
+                    )
+                """)
+                rows = self.conn.execute(
+                    "SELECT bucket_start, user_id, cost FROM quota_usage WHERE bucket_start >= ? ORDER BY bucket_start",
+                    (time.time() - window_seconds - bucket_seconds,)
+                ).fetchall()
+            for bucket_start, user_id, cost in rows:
+                self.global_spend.add(cost, bucket_start)
+                self._user(user_id).add(cost, bucket_start)
+    
+    def _user(self, user_id):
+        if user_id not in self.user_spend:
+            self.user_spend[user_id] = RollingBudget(self.window_seconds, self.bucket_seconds)
+        return self.user_spend[user_id]
+    
+    @staticmethod
+    def price(prompt_tokens, candidate_tokens, image_count=0):
+        """Cost in the budget currency; output tokens beyond the images' share are priced as text"""
+        image_tokens = min(candidate_tokens, image_count * OUTPUT_IMAGE_TOKENS)
+        usd = (
+            prompt_tokens * PRICE_INPUT_PER_MILLION
+            + image_tokens * PRICE_IMAGE_OUTPUT_PER_MILLION
+            + (candidate_tokens - image_tokens) * PRICE_TEXT_OUTPUT_PER_MILLION
+        ) / 1_000_000
+        return usd * QUOTA_FX_RATE
+    
+    def estimate(self, operation, contents):
+        """Expected cost of a call before it is sent"""
+        items = contents if isinstance(contents, (list, tuple)) else [contents]
+        prompt_tokens = 0
+        for item in items:
+            if isinstance(item, str):
+                prompt_tokens += len(item) // 4
+            elif isinstance(item, PIL.Image.Image) or getattr(item, 'inline_data', None) is not None:
+                prompt_tokens += INPUT_IMAGE_TOKENS
+            elif getattr(item, 'text', None):
+                prompt_tokens += len(item.text) // 4
+        if operation in IMAGE_OPERATIONS:
+            return self.price(prompt_tokens, OUTPUT_IMAGE_TOKENS, 1)
+        return self.price(prompt_tokens, TEXT_OUTPUT_ESTIMATE_TOKENS)
+    
+    def _fits(self, user_id, amount, now, include_reserved=True):
+        global_total = self.global_spend.spent(now) + (self.global_reserved if include_reserved else 0)
+        if global_total + amount > self.global_budget:
+            return False
+        if user_id is None:
+            return True
+        user_total = self._user(user_id).spent(now) + (self.user_reserved.get(user_id, 0.0) if include_reserved else 0)
+        return user_total + amount <= self.user_budget
+    
+    def _rejection(self, user_id, amount, now):
+        if self.global_spend.spent(now) + amount > self.global_budget:
+            scope, spend, budget = "the app's", self.global_spend, self.global_budget
+        else:
+            scope, spend, budget = "your", self._user(user_id), self.user_budget
+        message = (
+            f"This request (~{QUOTA_CURRENCY}{amount:,.2f}) would exceed {scope} budget of "
+            f"{QUOTA_CURRENCY}{budget:,.2f} per {self.window_seconds // 86400} days "
+            f"({QUOTA_CURRENCY}{spend.spent(now):,.2f} spent)"
+        )
+        freed = spend.frees_at(amount, budget, now)
+        if freed:
+            message += f"; it fits again from {datetime.fromtimestamp(freed).strftime('%Y-%m-%d %H:%M')}"
+        return QuotaExceededError(message)
+    
+    def admit(self, user_id, amount, timeout=QUOTA_QUEUE_SECONDS, price_factor=1.0):
+        """Reserve a call's list-price estimate times price_factor, waiting for in-flight reservations to settle if that would make it fit"""
+        amount *= price_factor
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                # Running sums in memory keep the check O(1) amortized; SQLite is only written on settle
+                now = time.time()
+                if self._fits(user_id, amount, now):
+                    self.global_reserved += amount
+                    if user_id is not None:
+                        self.user_reserved[user_id] = self.user_reserved.get(user_id, 0.0) + amount
+                    return (user_id, amount, price_factor)
+                
+                # Settled spend alone already rules the call out, so waiting cannot help
+                remaining = deadline - time.monotonic()
+                if not self._fits(user_id, amount, now, include_reserved=False) or remaining <= 0:
+                    raise self._rejection(user_id, amount, now)
+                self.cond.wait(remaining)
+    
+    def _unreserve(self, reservation):
+        user_id, amount, _ = reservation
+        self.global_reserved = max(0.0, self.global_reserved - amount)
+        if user_id is not None:
+            self.user_reserved[user_id] = max(0.0, self.user_reserved.get(user_id, 0.0) - amount)
+    
+    def release(self, reservation):
+        """Drop a reservation for a call that was never billed"""
+        with self.cond:
+            self._unreserve(reservation)
+            self.cond.notify_all()
+    
+    def settle(self, reservation, prompt_tokens=None, candidate_tokens=None, image_count=0):
+        """Replace a reservation with the call's actual cost, falling back to the estimate without usage data"""
+        # The reserved amount already carries the reservation's price factor, so both branches are discounted alike
+        user_id, reserved, price_factor = reservation
+        if prompt_tokens is None and candidate_tokens is None:
+            cost = reserved
+        else:
+            cost = self.price(prompt_tokens or 0, candidate_tokens or 0, image_count) * price_factor
+        
+        now = time.time()
+        with self.cond:
+            self._unreserve(reservation)
+            self.global_spend.add(cost, now)
+            if user_id is not None:
+                self._user(user_id).add(cost, now)
+            self.cond.notify_all()
+        
+        if self.conn is not None:
+            bucket_start = int(now - now % self.bucket_seconds)
+            with self.db_lock, self.conn:
+                self.conn.execute(
+                    "INSERT INTO quota_usage (bucket_start, user_id, cost, prompt_tokens, candidate_tokens, images, calls) "
+                    "VALUES (?, ?, ?, ?, ?, ?, 1) "
+                    "ON CONFLICT (bucket_start, user_id) DO UPDATE SET "
+                    "cost = cost + excluded.cost, prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                    "candidate_tokens = candidate_tokens + excluded.candidate_tokens, "
+                    "images = images + excluded.images, calls = calls + 1",
+                    (bucket_start, user_id or "", cost, prompt_tokens or 0, candidate_tokens or 0, image_count)
+                )
+                self.conn.execute(
+                    "DELETE FROM quota_usage WHERE bucket_start < ?",
+                    (now - self.window_seconds - self.bucket_seconds,)
+                )
+        return cost
+    
+    def usage(self, user_id=None):
+        """Spend and budgets for display"""
+        now = time.time()
+        with self.cond:
+            return {
+                'currency': QUOTA_CURRENCY,
+                'window_days': self.window_seconds // 86400,
+                'global_spent': self.global_spend.spent(now),
+                'global_budget': self.global_budget,
+                'user_spent': self._user(user_id).spent(now) if user_id is not None else None,
+                'user_budget': self.user_budget,
+            }
+
+class ModelGateway:
+    """Shared call layer adding classified retries and per-model circuit breakers to generate_content"""
+    
+    def __init__(self, client, max_retries=MODEL_MAX_RETRIES, call_log=None, quota=None):
+        self.client = client
+        self.max_retries = max_retries
+        self.call_log = call_log
+        self.quota = quota
+        self.lock = threading.Lock()
+        self.breakers = {}
+        self.metrics = {'calls': 0, 'retries': 0, 'failures': 0, 'circuit_rejections': 0}
+        self.in_flight = {}
+        self.ttft_samples = deque(maxlen=TTFT_SAMPLE_SIZE)
+    
+    def _count(self, name):
+        with self.lock:
+            self.metrics[name] += 1
+    
+    def _track(self, operation, delta):
+        with self.lock:
+            self.in_flight[operation] = self.in_flight.get(operation, 0) + delta
+    
+    def _admit(self, model, breaker):
+        ticket = breaker.allow()
+        if not ticket:
+            self._count('circuit_rejections')
+            raise CircuitOpenError(f"{model} is temporarily unavailable, please retry shortly")
+        return ticket
+    
+    def _backoff_or_raise(self, breaker, ticket, error, attempt):
+        """Record a failed attempt, re-raising it when it should not be retried and sleeping otherwise"""
+        retryable = _is_retryable(error)
+        if retryable:
+            breaker.record_failure()
+        else:
+            # A rejected request (bad input, auth, safety) neither proves nor disproves upstream health
+            breaker.record_neutral(ticket)
+        
+        if not retryable or attempt == self.max_retries:
+            self._count('failures')
+            raise error
+        
+        delay = _retry_after_seconds(error)
+        if delay is None:
+            delay = random.uniform(0, RETRY_BASE_DELAY_SECONDS * 2 ** attempt)
+        self._count('retries')
+        time.sleep(min(delay, RETRY_MAX_DELAY_SECONDS))
+    
+    def _breaker(self, model):
+        with self.lock:
+            if model not in self.breakers:
+                self.breakers[model] = CircuitBreaker()
+            return self.breakers[model]
+    
+    def _log_call(self, operation, mode, model, contents, queued, started, attempts, ttfb=None, error=None, received=0, usage=(None, None, None)):
+        # Time spent waiting for quota is kept out of wall_time and ttfb; started is None if the call never got past it
+        if self.call_log is None:
+            return
+        now = time.monotonic()
+        if error is None:
+            outcome = 'ok'
+        elif isinstance(error, CircuitOpenError):
+            outcome = 'circuit_open'
+        elif isinstance(error, QuotaExceededError):
+            outcome = 'rejected'
+        else:
+            outcome = 'error'
+        code = getattr(error, 'code', None)
+        self.call_log.record(
+            operation=operation,
+            mode=mode,
+            model=model,
+            outcome=outcome,
+            error=None if error is None else str(code) if isinstance(code, int) else type(error).__name__,
+            attempts=attempts,
+            wall_time=0.0 if started is None else now - started,
+            ttfb=ttfb,
+            request_bytes=content_bytes(contents),
+            response_bytes=received,
+            prompt_tokens=usage[0],
+            candidate_tokens=usage[1],
+            total_tokens=usage[2],
+            queue_wait=(now if started is None else started) - queued
+        )
+    
+    def _reserve(self, operation, contents, user_id):
+        """Hold the estimated cost of a call against the quota, or None without a quota"""
+        if self.quota is None:
+            return None
+        return self.quota.admit(user_id, self.quota.estimate(operation, contents))
+    
+    def generate_content(self, model, contents, config=None, operation=None, user_id=None, mode='single'):
+        """Call the model, retrying transient errors with exponential backoff and jitter; mode labels how the operation was sent"""
+        operation = operation or 'generate_content'
+        self._track(operation, 1)
+        try:
+            return self._generate_content(model, contents, config, operation, user_id, mode)
+        finally:
+            self._track(operation, -1)
+    
+    def _generate_content(self, model, contents, config, operation, user_id, mode):
+        breaker = self._breaker(model)
+        self._count('calls')
+        queued = time.monotonic()
+        started = None
+        attempts = 0
+        reservation = None
+        
+        try:
+            reservation = self._reserve(operation, contents, user_id)
+            started = time.monotonic()
+            for attempt in range(self.max_retries + 1):
+                ticket = self._admit(model, breaker)
+                attempts += 1
+                try:
+                    response = self.client.models.generate_content(model=model, contents=contents, config=config)
+                except Exception as e:
+                    self._backoff_or_raise(breaker, ticket, e, attempt)
+                    continue
+                
+                breaker.record_success()
+                # The SDK returns the body in one piece, so first byte and completion coincide
+                ttfb = time.monotonic() - started
+                usage = usage_tokens(response)
+                if reservation is not None:
+                    self.quota.settle(reservation, usage[0], usage[1], response_image_count(response))
+                    reservation = None
+                self._log_call(operation, mode, model, contents, queued, started, attempts, ttfb, received=response_bytes(response), usage=usage)
+                return response
+        except Exception as e:
+            if reservation is not None:
+                self.quota.release(reservation)
+            self._log_call(operation, mode, model, contents, queued, started, attempts, error=e)
+            raise
+    
+    def generate_content_stream(self, model, contents, config=None, operation=None, user_id=None):
+        """Yield response chunks as they arrive; failures before the first chunk are retried"""
+        operation = operation or 'generate_content_stream'
+        self._track(operation, 1)
+        try:
+            yield from self._generate_content_stream(model, contents, config, operation, user_id)
+        finally:
+            self._track(operation, -1)
+    
+    def _generate_content_stream(self, model, contents, config, operation, user_id):
+        breaker = self._breaker(model)
+        self._count('calls')
+        queued = time.monotonic()
+        started = None
+        attempts = 0
+        reservation = None
+        
+        try:
+            reservation = self._reserve(operation, contents, user_id)
+            started = time.monotonic()
+            for attempt in range(self.max_retries + 1):
+                ticket = self._admit(model, breaker)
+                attempts += 1
+                try:
+                    stream = iter(self.client.models.generate_content_stream(model=model, contents=contents, config=config))
+                    first_chunk = next(stream, None)
+                except Exception as e:
+                    self._backoff_or_raise(breaker, ticket, e, attempt)
+                    continue
+                
+                breaker.record_success()
+                ttfb = time.monotonic() - started
+                with self.lock:
+                    self.ttft_samples.append(ttfb)
+                break
+        except Exception as e:
+            if reservation is not None:
+                self.quota.release(reservation)
+            self._log_call(operation, 'stream', model, contents, queued, started, attempts, error=e)
+            raise
+        
+        # Usage metadata arrives on the final chunk
+        received = 0
+        usage = (None, None, None)
+        images = 0
+        error = None
+        try:
+            chunks = [first_chunk] if first_chunk is not None else []
+            for chunk in itertools.chain(chunks, stream):
+                received += response_bytes(chunk)
+                images += response_image_count(chunk)
+                if getattr(chunk, 'usage_metadata', None) is not None:
+                    usage = usage_tokens(chunk)
+                yield chunk
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # A stream cut short has still been billed for what was sent
+            if reservation is not None:
+                self.quota.settle(reservation, usage[0], usage[1], images)
+            self._log_call(operation, 'stream', model, contents, queued, started, attempts, ttfb, error, received, usage)
+    
+    def stats(self):
+        """Snapshot of call counters, streaming latency and breaker states for display"""
+        with self.lock:
+            metrics = dict(self.metrics)
+            breakers = dict(self.breakers)
+            ttft_samples = list(self.ttft_samples)
+            metrics['in_flight'] = dict(self.in_flight)
+        metrics['ttft_p50'] = percentile(ttft_samples, 50)
+        metrics['ttft_p95'] = percentile(ttft_samples, 95)
+        metrics['breakers'] = {model: breaker.state for model, breaker in breakers.items()}
+        return metrics
+
+def decode_image(image_bytes):
+    """Decode image bytes into a fully loaded PIL Image safe to share between threads"""
+    pil_image = PIL.Image.open(io.BytesIO(image_bytes))
+    pil_image.load()
+    return pil_image
+
+# Upload normalization applied before images are sent to the model
+UPLOAD_MAX_EDGE = int(os.environ.get("UPLOAD_MAX_EDGE", "2048"))
+UPLOAD_FORMAT = os.environ.get("UPLOAD_FORMAT", "JPEG")
+UPLOAD_QUALITY = 90
+UPLOAD_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+
+def normalize_image_bytes(data, max_edge=UPLOAD_MAX_EDGE, fmt=UPLOAD_FORMAT, quality=UPLOAD_QUALITY):
+    """Fix EXIF orientation, downscale and re-encode an upload into a compact payload"""
+    image = PIL.Image.open(io.BytesIO(data))
+    original_format = image.format
+    rotated = image.getexif().get(0x0112, 1) != 1
+    resized = max(image.size) > max_edge
+    
+    image = PIL.ImageOps.exif_transpose(image)
+    if resized:
+        image.thumbnail((max_edge, max_edge), PIL.Image.LANCZOS)
+    
+    # JPEG has no alpha channel, so transparent uploads go out as WEBP instead
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    if has_alpha and fmt == "JPEG":
+        fmt = "WEBP"
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    
+    buf = io.BytesIO()
+    image.save(buf, format=fmt, quality=quality)
+    encoded = buf.getvalue()
+    
+    # Keep the original file when re-encoding gains nothing and no pixels changed
+    if not rotated and not resized and len(encoded) >= len(data) and original_format in UPLOAD_MIME_TYPES:
+        return data, UPLOAD_MIME_TYPES[original_format]
+    return encoded, UPLOAD_MIME_TYPES[fmt]
+
+MIME_EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp"}
+
+def sniff_mime_type(data):
+    """Detect the image MIME type from its leading bytes"""
+    if data.startswith(b'\xff\xd8'):
+        return "image/jpeg"
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return "image/webp"
+    return "image/png"
+
+class EncodedImage:
+    """Encoded image bytes kept as produced; decoded to PIL only when pixels are needed"""
+    
+    def __init__(self, data, mime_type=None, digest=None):
+        self.data = data
+        self.mime_type = mime_type or sniff_mime_type(data)
+        self._image = None
+        self._digest = digest
+    
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = decode_image(self.data)
+        return self._image
+    
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.data).hexdigest()
+        return self._digest
+    
+    @property
+    def extension(self):
+        return MIME_EXTENSIONS.get(self.mime_type, "png")
+
+class PreparedImage(EncodedImage):
+    """Normalized upload: compact encoded bytes for the model and for display"""
+    
+    def __init__(self, data, mime_type, original_bytes):
+        super().__init__(data, mime_type)
+        self.original_bytes = original_bytes
+    
+    def payload_summary(self):
+        """Human-readable before/after upload size"""
+        return f"📦 Upload payload: {format_bytes(self.original_bytes)} → {format_bytes(len(self.data))}"
+
+def prepare_image_bytes(data, max_edge=UPLOAD_MAX_EDGE):
+    """Normalized upload bytes wrapped for the model, remembering the original size"""
+    normalized, mime_type = normalize_image_bytes(data, max_edge)
+    return PreparedImage(normalized, mime_type, len(data))
+
+def pixel_bytes(image):
+    """Approximate memory held by a decoded PIL image"""
+    return image.width * image.height * len(image.getbands())
+
+class DecodedImageCache:
+    """LRU of prepared uploads bounded by the memory held in their decoded pixels"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+    
+    def get_or_create(self, key, factory):
+        """Return the cached entry for key, building it with factory on a miss"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+        
+        # Decode outside the lock so other sessions are not blocked behind a large upload
+        prepared = factory()
+        size = pixel_bytes(prepared.image)
+        
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (prepared, size)
+                self.total_bytes += size
+            self.entries.move_to_end(key)
+            
+            # Always keep the most recent entry, even if it alone exceeds the budget
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+            return self.entries[key][0]
+
+def model_input(image):
+    """Content part for an image argument, sending encoded bytes without re-encoding"""
+    if isinstance(image, EncodedImage):
+        return types.Part.from_bytes(data=image.data, mime_type=image.mime_type)
+    return image
+
+def format_bytes(num_bytes):
+    """Format a byte count for display"""
+    for unit in ["B", "KB", "MB"]:
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GB"
+
+def image_digest(image):
+    """Content hash of an image, independent of the file it came from"""
+    if isinstance(image, EncodedImage):
+        return image.digest
+    
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.size}".encode('utf-8'))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+# Packed batch analysis: several images per request, answered as one JSON array
+PACK_MAX_IMAGES = int(os.environ.get("PACK_MAX_IMAGES", "16"))
+# Inline requests are capped at 20 MB after base64 encoding
+PACK_MAX_BYTES = 14 * 1000 * 1000
+# Room left for the instructions and the answer inside a 32k-token context
+PACK_MAX_INPUT_TOKENS = 20000
+
+# Images up to 384px cost one tile; larger ones are billed per 768px tile
+IMAGE_TILE_THRESHOLD = 384
+IMAGE_TILE_EDGE = 768
+
+PACK_INSTRUCTIONS = """
+You will receive {count} images, each preceded by a line giving its filename.
+Analyze every image separately using the instructions below. Return a JSON array
+with exactly one object per image: "filename" is the filename given before that
+image, copied exactly, and "analysis" is the full analysis of that image in Markdown.
+"""
+
+PACK_LABEL_PREFIX = "Filename:"
+
+PACK_RESPONSE_SCHEMA = types.Schema(
+    type=types.Type.ARRAY,
+    items=types.Schema(
+        type=types.Type.OBJECT,
+        properties={
+            'filename': types.Schema(type=types.Type.STRING),
+            'analysis': types.Schema(type=types.Type.STRING),
+        },
+        required=['filename', 'analysis']
+    )
+)
+
+def packed_analysis_key(prompt, digest):
+    """Result cache key for an answer split out of a packed request, kept apart from single-image analyses"""
+    return ImageCache.make_key(MODEL_ID, PACK_INSTRUCTIONS, prompt, digest)
+
+def image_input_tokens(image):
+    """Input tokens the API bills for an image"""
+    if isinstance(image, EncodedImage):
+        width, height = PIL.Image.open(io.BytesIO(image.data)).size
+    else:
+        width, height = image.size
+    if max(width, height) <= IMAGE_TILE_THRESHOLD:
+        return INPUT_IMAGE_TOKENS
+    return math.ceil(width / IMAGE_TILE_EDGE) * math.ceil(height / IMAGE_TILE_EDGE) * INPUT_IMAGE_TOKENS
+
+def plan_packs(sizes, max_images=PACK_MAX_IMAGES, max_bytes=PACK_MAX_BYTES, max_tokens=PACK_MAX_INPUT_TOKENS):
+    """Split (bytes, tokens) per image into consecutive index packs that stay within every limit"""
+    packs = []
+    used_bytes = used_tokens = 0
+    for i, (num_bytes, num_tokens) in enumerate(sizes):
+        if not packs or len(packs[-1]) >= max_images or used_bytes + num_bytes > max_bytes or used_tokens + num_tokens > max_tokens:
+            packs.append([])
+            used_bytes = used_tokens = 0
+        packs[-1].append(i)
+        used_bytes += num_bytes
+        used_tokens += num_tokens
+    return packs
+
+def pack_labels(filenames):
+    """Filenames made unique so each image in a pack can be matched to its answer"""
+    used = set()
+    labels = []
+    for filename in filenames:
+        label, n = filename, 1
+        # Suffixed labels can clash with real filenames ("a", "a", "a (2)"), so check every label handed out
+        while label in used:
+            n += 1
+            label = f"{filename} ({n})"
+        used.add(label)
+        labels.append(label)
+    return labels
+
+# Style and content options
+STYLE_PRESETS = {
+    "Photorealistic": "ultra-realistic, high-definition, professional photography, sharp details",
+    "Digital Art": "digital painting, concept art, detailed illustration, vibrant colors",
+    "Cartoon Style": "cartoon, animated style, colorful and fun, playful",
+    "Oil Painting": "classical oil painting, artistic brushstrokes, textured canvas",
+    "Sketch": "pencil sketch, hand-drawn, artistic lines, monochrome",
+    "Vintage": "vintage style, retro aesthetic, aged look, nostalgic",
+    "Cyberpunk": "neon lights, futuristic, cyberpunk aesthetic, dark atmosphere",
+    "Minimalist": "clean, simple, minimalist design, elegant simplicity"
+}
+
+ASPECT_RATIOS = {
+    "Square (1:1)": "square format, equal dimensions",
+    "Portrait (3:4)": "portrait orientation, vertical composition",
+    "Landscape (4:3)": "landscape orientation, horizontal composition", 
+    "Wide (16:9)": "wide format, cinematic composition"
+}
+
+CLOTHING_OPTIONS = {
+    "Business Formal": "professional business suit, formal corporate attire, executive styling",
+    "Casual Wear": "comfortable jeans and t-shirt, relaxed everyday clothing",
+    "Elegant Evening": "sophisticated evening dress, formal party attire, glamorous",
+    "Traditional Indian": "beautiful traditional Indian clothing, saree, kurta, cultural dress",
+    "Wedding Attire": "elegant wedding dress, formal wedding suit, bridal styling",
+    "Sportswear": "athletic wear, gym clothes, sports uniform, active lifestyle",
+    "Winter Wear": "warm winter coat, cozy sweater, seasonal layered clothing",
+    "Beach Wear": "summer beach outfit, light breezy clothing, vacation style",
+    "Vintage Style": "retro vintage clothing from past decades, classic fashion",
+    "Designer Fashion": "high-end designer clothing, luxury fashion, couture styling"
+}
+
+POSE_OPTIONS = {
+    "Confident Standing": "confident upright posture, hands on hips, strong authoritative stance",
+    "Relaxed Casual": "relaxed natural pose, comfortable casual body language",
+    "Professional Portrait": "professional headshot pose, business appropriate, executive presence",
+    "Dynamic Action": "energetic dynamic pose, movement and life, active positioning",
+    "Sitting Elegant": "graceful sitting position, elegant refined posture",
+    "Walking Forward": "confident walking stride, forward motion, purposeful movement",
+    "Arms Crossed": "confident pose with arms crossed, assertive professional stance",
+    "Waving Hello": "friendly waving gesture, welcoming approachable pose",
+    "Thinking Pose": "thoughtful pose, hand on chin, contemplative positioning",
+    "Victory Pose": "celebratory victory stance, arms raised, triumphant gesture"
+}
+
+FACIAL_EXPRESSIONS = {
+    "Natural Smile": "genuine natural smile, warm and friendly expression",
+    "Confident Look": "confident serious expression, professional authoritative demeanor", 
+    "Joyful Laugh": "happy laughing expression, pure joy and happiness",
+    "Thoughtful": "contemplative thoughtful expression, intelligent focused look",
+    "Surprised": "surprised expression, wide eyes, astonished look",
+    "Peaceful": "calm peaceful expression, serene tranquil look"
+}
+
+BACKGROUND_OPTIONS = {
+    "Smart Remove": "completely remove background, create transparent PNG",
+    "Studio Professional": "professional studio lighting, clean neutral backdrop",
+    "Modern Office": "contemporary office environment, professional workspace",
+    "Outdoor Natural": "beautiful outdoor natural setting, parks or landscapes",
+    "Urban City": "modern city environment, urban professional setting",
+    "Home Lifestyle": "cozy home interior, comfortable living space",
+    "Product Studio": "e-commerce white background, clean product photography",
+    "Fantasy World": "magical fantasy environment, creative artistic backdrop",
+    "Seasonal Theme": "seasonal environment, holiday or weather-themed backdrop"
+}
+
+FACE_ENHANCEMENT = {
+    "Skin Perfection": "smooth flawless skin, remove blemishes naturally, even skin tone",
+    "Eye Enhancement": "brighter sparkling eyes, natural eye enhancement", 
+    "Smile Improvement": "perfect natural smile, teeth whitening, confident expression",
+    "Hair Styling": "perfect hairstyle, natural hair enhancement, styled look",
+    "Overall Beauty": "natural beauty enhancement, subtle professional improvement",
+    "Age Adjustment": "youthful appearance, age-appropriate enhancement"
+}
+
+BODY_MODIFICATIONS = {
+    "Fitness Transform": "athletic toned body, fit healthy appearance, natural muscle definition",
+    "Posture Improvement": "confident straight posture, professional body language",
+    "Height Enhancement": "taller proportional appearance, elegant stature",
+    "Body Proportions": "balanced natural body proportions, harmonious physique",
+    "Clothing Fit": "perfectly fitted clothing, tailored professional appearance"
+}
+
+ANALYSIS_PROMPTS = {
+    "complete": """
+    Provide comprehensive analysis of this image in the following structured format:
+
+    CONTENT_ANALYSIS:
+    - Objects: List all objects, people, animals visible
+    - Scene_Type: Indoor/outdoor, location, environment
+    - Activities: What people are doing, actions happening
+    - Mood: Overall atmosphere and feeling
+
+    TECHNICAL_QUALITY:
+    - Resolution_Score: Rate image sharpness (1-10)
+    - Lighting_Quality: Assess lighting quality (1-10) 
+    - Composition_Score: Photography composition (1-10)
+    - Color_Balance: Color accuracy and harmony (1-10)
+    - Professional_Rating: Overall professional quality (1-10)
+
+    PEOPLE_ANALYSIS:
+    - Count: Number of people visible
+    - Demographics: Age groups, gender distribution
+    - Emotions: Facial expressions, mood analysis
+    - Clothing: Outfit styles, formality level
+    - Body_Language: Pose, confidence, energy
+
+    BUSINESS_INTELLIGENCE:
+    - Commercial_Value: Business usage potential (1-10)
+    - Target_Audience: Who this appeals to
+    - Marketing_Effectiveness: Social media potential (1-10)
+    - Brand_Elements: Any logos, brands, products visible
+    - Usage_Recommendations: Best platforms, contexts
+
+    IMPROVEMENT_SUGGESTIONS:
+    - Technical_Fixes: Specific quality improvements
+    - Composition_Tips: Framing and layout suggestions  
+    - Enhancement_Ideas: Creative improvement options
+
+    KEYWORDS: 10 relevant tags for this image
+    """,
+
+    "text_extraction": """
+    Extract and analyze ALL visible text in this image:
+
+    EXTRACTED_TEXT:
+    [Provide all visible text exactly as it appears, maintaining formatting]
+
+    TEXT_ANALYSIS:
+    - Language: Primary language(s) detected
+    - Text_Type: (document, sign, handwritten, printed, display, etc.)
+    - Structure: (paragraph, list, table, form, receipt, etc.)
+    - Quality_Score: Text clarity and readability (1-10)
+    - Business_Document_Type: (invoice, receipt, business card, form, etc.)
+
+    STRUCTURED_DATA:
+    [If receipt/invoice: extract line items, totals, dates]
+    [If business card: extract name, phone, email, company]
+    [If form: extract field names and values]
+    [If table: organize data in rows and columns]
+
+    KEYWORDS: Key terms and important phrases found
+    SUMMARY: Brief description of text content
+
+    If no text is visible, clearly state "NO TEXT DETECTED"
+    """,
+
+    "people_demographics": """
+    Analyze all people in this image:
+
+    PEOPLE_COUNT: Exact number of people visible
+
+    DEMOGRAPHICS:
+    - Age_Groups: Estimated age ranges for each person
+    - Gender_Distribution: Gender breakdown
+    - Ethnicity_Diversity: Cultural/ethnic representation
+
+    FACIAL_ANALYSIS:
+    - Expressions: Each person's facial expression
+    - Emotions: Mood and emotional state
+    - Eye_Contact: Where people are looking
+    - Confidence_Level: Body language assessment
+
+    CLOTHING_ANALYSIS:
+    - Outfit_Styles: Describe each person's clothing
+    - Formality_Level: Casual to formal rating (1-10)
+    - Color_Coordination: How well outfits work together
+    - Fashion_Era: Modern, vintage, traditional styling
+
+    SOCIAL_DYNAMICS:
+    - Group_Interaction: How people relate to each other
+    - Professional_Suitability: Business usage appropriateness (1-10)
+    - Social_Media_Ready: Instagram/LinkedIn readiness (1-10)
+    """,
+
+    "technical_quality": """
+    Technical photography analysis:
+
+    IMAGE_QUALITY:
+    - Resolution: Image sharpness and detail (1-10)
+    - Exposure: Brightness and contrast balance (1-10) 
+    - Focus: Subject sharpness and depth (1-10)
+    - Noise_Level: Grain and digital noise (1-10)
+
+    COMPOSITION:
+    - Rule_of_Thirds: Composition adherence (1-10)
+    - Balance: Visual weight distribution (1-10)
+    - Framing: Subject framing quality (1-10)
+    - Leading_Lines: Use of visual guides (1-10)
+
+    LIGHTING:
+    - Lighting_Direction: Where light comes from
+    - Lighting_Quality: Soft/hard light assessment (1-10)
+    - Shadow_Detail: Shadow quality and placement (1-10)
+    - Color_Temperature: Warm/cool light balance
+
+    COLOR_ANALYSIS:
+    - Color_Harmony: How colors work together (1-10)
+    - Saturation: Color intensity appropriateness (1-10)
+    - Contrast: Light/dark balance (1-10)
+    - Dominant_Colors: Primary colors in image
+
+    PROFESSIONAL_ASSESSMENT:
+    - Commercial_Readiness: Ready for business use (1-10)
+    - Improvement_Priority: What to fix first
+    - Strengths: What's working well
+    - Technical_Recommendations: Specific fixes needed
+    """
+}
+
+def resolve_analysis_prompt(analysis_type):
+    """Instruction block for an analysis type, falling back to the complete analysis"""
+    return ANALYSIS_PROMPTS.get(analysis_type, ANALYSIS_PROMPTS["complete"])
+
+def analysis_system_instruction():
+    """Every analysis type's instructions, sent once as the cached prefix"""
+    return "\n\n".join(f"ANALYSIS TYPE: {name}\n{textwrap.dedent(prompt).strip()}" for name, prompt in ANALYSIS_PROMPTS.items())
+
+def analysis_request_text(analysis_type):
+    """Per-call instruction selecting an analysis type from the cached system instruction"""
+    name = analysis_type if analysis_type in ANALYSIS_PROMPTS else "complete"
+    return f"Analyze the attached image using the ANALYSIS TYPE: {name} format."
+
+# The shared analysis instruction is registered as cached content and referenced by name on each call.
+# The API rejects cached content below its minimum size, so shorter prefixes are always sent inline.
+PROMPT_CACHE_ENABLED = os.environ.get("PROMPT_CACHE", "1") != "0"
+PROMPT_CACHE_TTL_SECONDS = int(os.environ.get("PROMPT_CACHE_TTL_SECONDS", "3600"))
+PROMPT_CACHE_REFRESH_SECONDS = 5 * 60
+PROMPT_CACHE_RETRY_SECONDS = 10 * 60
+PROMPT_CACHE_MIN_TOKENS = 1024
+CHARS_PER_TOKEN = 4
+
+def is_cache_error(e):
+    """True when an API error is about the referenced cached content rather than the request itself"""
+    message = str(getattr(e, 'message', None) or e).lower().replace(' ', '')
+    return getattr(e, 'code', None) in (400, 403, 404) and 'cachedcontent' in message
+
+class PromptCache:
+    """Server-side cached content for static prompt prefixes, refreshed before it expires"""
+    
+    def __init__(self, client, model=MODEL_ID, ttl_seconds=PROMPT_CACHE_TTL_SECONDS, refresh_seconds=PROMPT_CACHE_REFRESH_SECONDS):
+        self.client = client
+        self.model = model
+        self.ttl_seconds = ttl_seconds
+        self.refresh_seconds = refresh_seconds
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.unavailable = {}
+        self.single_flight = SingleFlight()
+        self.metrics = {'hits': 0, 'creates': 0, 'refreshes': 0, 'failures': 0}
+        self.last_error = None
+    
+    def _count(self, name):
+        with self.lock:
+            self.metrics[name] += 1
+    
+    @staticmethod
+    def cacheable(prompt):
+        """Whether a prompt is large enough for the API to accept it as cached content"""
+        return len(prompt) // CHARS_PER_TOKEN >= PROMPT_CACHE_MIN_TOKENS
+    
+    def get(self, prompt):
+        """Cached content name for a system instruction, creating or refreshing it as needed; None to send it inline"""
+        if not self.cacheable(prompt):
+            return None
+        key = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            retry_at = self.unavailable.get(key, 0)
+        
+        if entry is not None and entry['expires_at'] - now > self.refresh_seconds:
+            self._count('hits')
+            return entry['name']
+        if entry is None and now < retry_at:
+            return None
+        
+        # Concurrent callers for the same prompt share one create/refresh
+        return self.single_flight.do(key, self._ensure, key, prompt, entry)
+    
+    def _ensure(self, key, prompt, entry):
+        ttl = f"{self.ttl_seconds}s"
+        try:
+            if entry is not None and entry['expires_at'] > time.time():
+                try:
+                    cached = self.client.caches.update(name=entry['name'], config=types.UpdateCachedContentConfig(ttl=ttl))
+                    self._count('refreshes')
+                except Exception:
+                    # Expired or evicted on the server; register it again
+                    cached = None
+            else:
+                cached = None
+            
+            if cached is None:
+                cached = self.client.caches.create(
+                    model=self.model,
+                    config=types.CreateCachedContentConfig(
+                        system_instruction=prompt,
+                        display_name=f"prompt-{key[:12]}",
+                        ttl=ttl
+                    )
+                )
+                self._count('creates')
+        except Exception as e:
+            # Send the prefix inline for a while and try again later; stats() keeps the error visible
+            self._count('failures')
+            with self.lock:
+                self.entries.pop(key, None)
+                self.unavailable[key] = time.time() + PROMPT_CACHE_RETRY_SECONDS
+                self.last_error = str(e)
+            return None
+        
+        expire_time = getattr(cached, 'expire_time', None)
+        expires_at = expire_time.timestamp() if expire_time else time.time() + self.ttl_seconds
+        with self.lock:
+            self.entries[key] = {'name': cached.name, 'expires_at': expires_at}
+        return cached.name
+    
+    def invalidate(self, prompt):
+        """Forget a prompt's cached content so the next call registers it again"""
+        key = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        with self.lock:
+            self.entries.pop(key, None)
+    
+    def stats(self):
+        """Hit, create, refresh and failure counters plus live entries and the last failure"""
+        with self.lock:
+            return {**self.metrics, 'entries': len(self.entries), 'last_error': self.last_error}
+
+def enhance_prompt(base_prompt, style, aspect_ratio, quality_boost=True):
+    """Enhance user prompt with style and technical improvements"""
+    enhanced = base_prompt
+    
+    if style != "None":
+        enhanced = f"{enhanced}, {STYLE_PRESETS[style]}"
+    
+    if aspect_ratio != "Default":
+        enhanced = f"{enhanced}, {ASPECT_RATIOS[aspect_ratio]}"
+    
+    if quality_boost:
+        enhanced = f"{enhanced}, high quality, detailed, professional, sharp focus, well-composed"
+    
+    return enhanced
+
+def _image_generation_config():
+    """Config used for every text-to-image call"""
+    return types.GenerateContentConfig(
+        safety_settings=[
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+                threshold=types.HarmBlockThreshold.BLOCK_NONE,
+            )
+        ],
+        response_modalities=['Text', 'Image']
+    )
+
+
+def _generate_single_variant(gateway, prompt, variant=0, cache=None, read_cache=True, user_id=None, rate_limiter=None):
+    """Run one generation call and return the first image, using the image cache when given"""
+    config = _image_generation_config()
+    cache_key = ImageCache.make_key(MODEL_ID, prompt, config.model_dump(mode='json', exclude_none=True), variant)
+    
+    if cache and read_cache:
+        cached_bytes = cache.get(cache_key)
+        if cached_bytes is not None:
+            return EncodedImage(cached_bytes)
+    
+    # Only calls that reach the model count against the rate limit
+    if rate_limiter:
+        rate_limiter.acquire()
+    response = gateway.generate_content(
+        model=MODEL_ID,
+        contents=prompt,
+        config=config,
+        operation='generate',
+        user_id=user_id
+    )
+    
+    image = _response_image(response)
+    if image is not None and cache:
+        cache.put(cache_key, image.data)
+    return image
+
+def _response_image(response):
+    """First image in a response as encoded bytes, or None"""
+    for part in response.parts or []:
+        if hasattr(part, 'as_image') and part.as_image():
+            gemini_image = part.as_image()
+            
+            if gemini_image and hasattr(gemini_image, 'image_bytes'):
+                # Keep the encoded bytes; callers decode only if they need pixels
+                return EncodedImage(gemini_image.image_bytes, gemini_image.mime_type)
+    
+    return None
+
+# Offline bulk generation through the Batch API: about half the price, results within 24 hours
+BULK_PRICE_FACTOR = 0.5
+BULK_POLL_SECONDS = int(os.environ.get("BULK_POLL_SECONDS", "60"))
+BULK_LIST_LIMIT = 20
+
+# Inline batch requests are capped at 20 MB; larger submissions are split across jobs
+BULK_MAX_INLINE_BYTES = 20 * 1000 * 1000
+BULK_REQUEST_OVERHEAD_BYTES = 512
+
+BULK_DONE_STATES = {
+    'JOB_STATE_SUCCEEDED', 'JOB_STATE_PARTIALLY_SUCCEEDED', 'JOB_STATE_FAILED',
+    'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'
+}
+
+def _job_state(state):
+    """Batch job state as a plain JOB_STATE_* string"""
+    return getattr(state, 'value', None) or str(state)
+
+class BulkJobStore:
+    """SQLite record of submitted batch jobs and their per-item outcomes, so polling resumes after a restart"""
+    
+    def __init__(self, db_path):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS bulk_jobs (
+                    name TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    display_name TEXT,
+                    state TEXT NOT NULL,
+                    total INTEGER NOT NULL,
+                    succeeded INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    collected INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    quota_id TEXT
+                )
+            """)
+            columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(bulk_jobs)")}
+            if 'quota_id' not in columns:
+                self.conn.execute("ALTER TABLE bulk_jobs ADD COLUMN quota_id TEXT")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS bulk_items (
+                    job_name TEXT NOT NULL,
+                    item_key TEXT NOT NULL,
+                    prompt_index INTEGER NOT NULL,
+                    variant INTEGER NOT NULL,
+                    prompt TEXT NOT NULL,
+                    digest TEXT,
+                    mime_type TEXT,
+                    error TEXT,
+                    PRIMARY KEY (job_name, item_key)
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_bulk_jobs_user_created ON bulk_jobs (user_id, created_at)")
+    
+    def add_job(self, name, user_id, display_name, state, items, quota_id=None):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO bulk_jobs (name, user_id, display_name, state, total, created_at, updated_at, quota_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, user_id or "", display_name, state, len(items), now, now, quota_id)
+            )
+            self.conn.executemany(
+                "INSERT INTO bulk_items (job_name, item_key, prompt_index, variant, prompt) VALUES (?, ?, ?, ?, ?)",
+                [(name, item['key'], item['prompt_index'], item['variant'], item['prompt']) for item in items]
+            )
+    
+    def update_job(self, name, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        with self.lock, self.conn:
+            self.conn.execute(f"UPDATE bulk_jobs SET {assignments} WHERE name = ?", list(fields.values()) + [name])
+    
+    def set_item(self, job_name, item_key, digest=None, mime_type=None, error=None):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE bulk_items SET digest = ?, mime_type = ?, error = ? WHERE job_name = ? AND item_key = ?",
+                (digest, mime_type, error, job_name, item_key)
+            )
+    
+    def open_jobs(self):
+        """Jobs whose results have not been collected yet"""
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM bulk_jobs WHERE collected = 0 ORDER BY created_at").fetchall()
+        return [dict(row) for row in rows]
+    
+    def list_jobs(self, user_id, limit=BULK_LIST_LIMIT):
+        """Most recent jobs for a user"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM bulk_jobs WHERE user_id = ? ORDER BY created_at DESC LIMIT ?", (user_id or "", limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+    
+    def items(self, job_name):
+        """Items of a job in prompt order"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM bulk_items WHERE job_name = ? ORDER BY prompt_index, variant", (job_name,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+    
+    def delete_job(self, name):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM bulk_items WHERE job_name = ?", (name,))
+            self.conn.execute("DELETE FROM bulk_jobs WHERE name = ?", (name,))
+
+class Studio:
+    """Gateway, caches and request coalescing behind the generate/edit/analyze operations"""
+    
+    def __init__(self, client, image_cache_dir=IMAGE_CACHE_DIR, image_cache_max_bytes=IMAGE_CACHE_MAX_BYTES, call_log=None, quota=None):
+        self.call_log = call_log or CallLog()
+        self.quota = quota
+        self.client = client
+        self.bulk_reservations = {}
+        self.gateway = ModelGateway(client, call_log=self.call_log, quota=quota)
+        self.image_cache = ImageCache(image_cache_dir, image_cache_max_bytes)
+        self.analysis_cache = ResultCache(ANALYSIS_CACHE_TTL_SECONDS, ANALYSIS_CACHE_MAX_BYTES)
+        self.prompt_cache = PromptCache(client) if PROMPT_CACHE_ENABLED else None
+        self.single_flight = SingleFlight()
+    
+    def _shares_analysis_instruction(self):
+        """Whether analyses send every type's instructions as one system instruction the prompt cache can hold"""
+        return self.prompt_cache is not None and PromptCache.cacheable(analysis_system_instruction())
+    
+    def _analysis_key(self, analysis_type, digest):
+        """Result cache key for an analysis, covering the instructions the model is given"""
+        if self._shares_analysis_instruction():
+            return ImageCache.make_key(MODEL_ID, analysis_system_instruction(), analysis_request_text(analysis_type), digest)
+        return ImageCache.make_key(MODEL_ID, resolve_analysis_prompt(analysis_type), digest)
+    
+    def _analysis_request(self, analysis_type, image, use_cache=True):
+        """Contents and config for an analysis call; the shared instruction is referenced when cached and sent inline otherwise"""
+        if not self._shares_analysis_instruction():
+            return [resolve_analysis_prompt(analysis_type), model_input(image)], None
+        
+        # Both forms give the model the same instructions, so their answers can share one result cache key
+        instruction = analysis_system_instruction()
+        cached_content = self.prompt_cache.get(instruction) if use_cache else None
+        if cached_content:
+            config = types.GenerateContentConfig(cached_content=cached_content)
+        else:
+            config = types.GenerateContentConfig(system_instruction=instruction)
+        return [analysis_request_text(analysis_type), model_input(image)], config
+    
+    def generate_image(self, prompt, num_variants=1, max_concurrency=MAX_CONCURRENT_VARIANTS, force_fresh=False, user_id=None):
+        """Generate image(s) from text prompt; identical concurrent requests share one call"""
+        key = ImageCache.make_key('generate', MODEL_ID, prompt, num_variants, force_fresh)
+        return self.single_flight.do(key, self._generate_image, prompt, num_variants, max_concurrency, force_fresh, user_id)
+
+    def _generate_image(self, prompt, num_variants, max_concurrency, force_fresh, user_id=None):
+        """Generate image(s) from text prompt, running variants concurrently"""
+        gateway = self.gateway
+        cache = self.image_cache
+        
+        # Slots keep variant order stable regardless of completion order
+        results = [None] * num_variants
+        errors = {}
+        
+        workers = max(1, min(max_concurrency, num_variants))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(_generate_single_variant, gateway, prompt, i, cache, not force_fresh, user_id): i
+                for i in range(num_variants)
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                    if results[i] is None:
+                        errors[i] = "no image in response"
+                except Exception as e:
+                    errors[i] = str(e)
+        
+        images = [img for img in results if img is not None]
+        
+        if not errors:
+            return images, "Images generated successfully!"
+        
+        failures = "; ".join(f"variant {i+1}: {errors[i]}" for i in sorted(errors))
+        if not images:
+            return [], f"Generation error: {failures}"
+        return images, f"Generated {len(images)}/{num_variants} images ({failures})"
+
+    def run_generation_batch(self, prompts, num_variants, max_in_flight=BATCH_MAX_IN_FLIGHT, rate_limiter=None, on_progress=None, force_fresh=False, on_result=None, user_id=None):
+        """Fan (prompt x variant) jobs out over a worker pool; on_result(job) fires as each one finishes"""
+        gateway = self.gateway
+        cache = self.image_cache
+        
+        jobs = [
+            {'prompt_index': p, 'variant': v, 'prompt': prompt, 'image': None, 'error': None}
+            for p, prompt in enumerate(prompts)
+            for v in range(num_variants)
+        ]
+        if not jobs:
+            return jobs
+        
+        def run_job(job):
+            return _generate_single_variant(gateway, job['prompt'], job['variant'], cache, not force_fresh, user_id, rate_limiter)
+        
+        workers = max(1, min(max_in_flight, len(jobs)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run_job, job): job for job in jobs}
+        
+            # Callbacks run on the calling thread so Streamlit widgets can be updated
+            for done, future in enumerate(as_completed(futures), start=1):
+                job = futures[future]
+                try:
+                    job['image'] = future.result()
+                    if job['image'] is None:
+                        job['error'] = "no image in response"
+                except Exception as e:
+                    job['error'] = str(e)
+                
+                if on_result:
+                    on_result(job)
+                if on_progress:
+                    on_progress(done, len(jobs))
+        
+        return jobs
+
+    def submit_bulk_generation(self, prompts, num_variants, store, user_id=None, display_name=None, quota_id=None):
+        """Queue (prompt x variant) generations as Batch API jobs owned by user_id and billed to quota_id (default user_id); returns (job names, message)"""
+        quota_id = user_id if quota_id is None else quota_id
+        items = [
+            {'key': f"{p}:{v}", 'prompt_index': p, 'variant': v, 'prompt': prompt}
+            for p, prompt in enumerate(prompts)
+            for v in range(num_variants)
+        ]
+        
+        chunks = [[]]
+        size = 0
+        for item in items:
+            item_size = len(item['prompt'].encode('utf-8')) + BULK_REQUEST_OVERHEAD_BYTES
+            if chunks[-1] and size + item_size > BULK_MAX_INLINE_BYTES:
+                chunks.append([])
+                size = 0
+            chunks[-1].append(item)
+            size += item_size
+        
+        config = _image_generation_config()
+        names = []
+        try:
+            for i, chunk in enumerate(chunks):
+                reservation = None
+                if self.quota is not None:
+                    estimate = sum(self.quota.estimate('generate', item['prompt']) for item in chunk)
+                    reservation = self.quota.admit(quota_id, estimate, timeout=0, price_factor=BULK_PRICE_FACTOR)
+                
+                name = display_name or f"bulk-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+                if len(chunks) > 1:
+                    name = f"{name} ({i + 1}/{len(chunks)})"
+                try:
+                    job = self.client.batches.create(
+                        model=MODEL_ID,
+                        src=[
+                            types.InlinedRequest(model=MODEL_ID, contents=item['prompt'], config=config, metadata={'key': item['key']})
+                            for item in chunk
+                        ],
+                        config=types.CreateBatchJobConfig(display_name=name)
+                    )
+                except Exception:
+                    if reservation is not None:
+                        self.quota.release(reservation)
+                    raise
+                
+                store.add_job(job.name, user_id, name, _job_state(job.state), chunk, quota_id)
+                if reservation is not None:
+                    self.bulk_reservations[job.name] = reservation
+                names.append(job.name)
+        except Exception as e:
+            if not names:
+                return [], f"Bulk submission error: {str(e)}"
+            return names, f"Submitted {len(names)}/{len(chunks)} bulk jobs ({str(e)})"
+        
+        return names, f"Submitted {len(items)} images in {len(names)} bulk job(s)"
+    
+    def poll_bulk_jobs(self, store, on_image=None):
+        """Refresh unfinished bulk jobs and collect finished ones; on_image(job, item, image) fires for each stored result"""
+        collected = []
+        for record in store.open_jobs():
+            try:
+                job = self.client.batches.get(name=record['name'])
+            except Exception as e:
+                store.update_job(record['name'], error=str(e))
+                continue
+            
+            state = _job_state(job.state)
+            if state not in BULK_DONE_STATES:
+                if state != record['state']:
+                    store.update_job(record['name'], state=state, error=None)
+                continue
+            
+            self._collect_bulk_job(store, record, job, state, on_image)
+            collected.append(record['name'])
+        return collected
+    
+    def _collect_bulk_job(self, store, record, job, state, on_image):
+        ordered = store.items(record['name'])
+        items = {item['item_key']: item for item in ordered}
+        config = _image_generation_config().model_dump(mode='json', exclude_none=True)
+        responses = getattr(getattr(job, 'dest', None), 'inlined_responses', None) or []
+        
+        prompt_tokens = candidate_tokens = images = 0
+        answered = set()
+        for index, inlined in enumerate(responses):
+            # Responses come back in request order; metadata carries the key when the API echoes it
+            key = (inlined.metadata or {}).get('key') or (ordered[index]['item_key'] if index < len(ordered) else None)
+            item = items.get(key)
+            if item is None:
+                continue
+            answered.add(key)
+            
+            # Items stored before a restart interrupted collection are not handed out twice
+            if item['digest'] or item['error']:
+                continue
+            
+            image = None
+            if inlined.error is not None:
+                error = inlined.error.message or f"error {inlined.error.code}"
+            else:
+                image = _response_image(inlined.response)
+                error = None if image is not None else "no image in response"
+                usage = usage_tokens(inlined.response)
+                if usage[0] is None and usage[1] is None:
+                    # Without usage metadata the request is billed at the estimate its reservation was based on
+                    usage = (len(item['prompt']) // CHARS_PER_TOKEN, OUTPUT_IMAGE_TOKENS if image is not None else 0, None)
+                prompt_tokens += usage[0] or 0
+                candidate_tokens += usage[1] or 0
+            
+            if image is not None:
+                images += 1
+                self.image_cache.put(ImageCache.make_key(MODEL_ID, item['prompt'], config, item['variant']), image.data)
+                try:
+                    if on_image:
+                        on_image(record, item, image)
+                except Exception as e:
+                    error = f"could not store result: {str(e)}"
+            
+            if error is None:
+                store.set_item(record['name'], key, digest=image.digest, mime_type=image.mime_type)
+            else:
+                store.set_item(record['name'], key, error=error)
+        
+        for key in items.keys() - answered:
+            if not items[key]['digest'] and not items[key]['error']:
+                store.set_item(record['name'], key, error=f"not run ({state.replace('JOB_STATE_', '').lower()})")
+        
+        # Batch usage is billed at a discount; jobs that ran nothing release their hold
+        quota_id = record['user_id'] if record.get('quota_id') is None else record['quota_id']
+        reservation = self.bulk_reservations.pop(record['name'], (quota_id or None, 0.0, BULK_PRICE_FACTOR))
+        if self.quota is not None:
+            if responses:
+                self.quota.settle(reservation, prompt_tokens, candidate_tokens, images)
+            else:
+                self.quota.release(reservation)
+        
+        final_items = store.items(record['name'])
+        job_error = getattr(job, 'error', None)
+        store.update_job(
+            record['name'],
+            state=state,
+            succeeded=sum(1 for item in final_items if item['digest']),
+            failed=sum(1 for item in final_items if item['error']),
+            collected=1,
+            error=getattr(job_error, 'message', None) or (str(job_error) if job_error else None)
+        )
+    
+    def cancel_bulk_job(self, store, name):
+        """Ask the API to cancel a bulk job; returns (success, message)"""
+        try:
+            self.client.batches.cancel(name=name)
+            store.update_job(name, state='JOB_STATE_CANCELLING')
+            return True, "Cancellation requested"
+        except Exception as e:
+            return False, f"Cancel error: {str(e)}"
+
+    def face_swap_images(self, source_image, target_image, options, user_id=None):
+        """Advanced face swap between two images"""
+        try:
+            gateway = self.gateway
+
+            prompt = f"""
+        Perform a precise face swap operation:
+        
+        TASK: Take the face from the first image and naturally place it on the person in the second image
+        
+        REQUIREMENTS:
+        - Keep target person's exact body, clothing, pose, and background
+        - Swap only the facial features (eyes, nose, mouth, face shape)
+        - Match skin tone and lighting naturally
+        - Preserve target's hairstyle unless specified
+        - Ensure proper face size and angle alignment
+        - Create seamless, realistic integration
+        - Maintain image quality and resolution
+        
+        QUALITY SETTINGS:
+        - Blend mode: {options.get('blend_quality', 'natural')}
+        - Skin tone matching: {options.get('skin_match', 'automatic')}
+        - Hair preservation: {options.get('preserve_hair', True)}
+        - Expression: {options.get('expression', 'keep target expression')}
+        
+        Make it look completely natural and professional.
+        """
+
+            response = gateway.generate_content(
+                model=MODEL_ID,
+                contents=[prompt, model_input(source_image), model_input(target_image)],
+                config=types.GenerateContentConfig(
+                    safety_settings=[
+                        types.SafetySetting(
+                            category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+                            threshold=types.HarmBlockThreshold.BLOCK_NONE,
+                        )
+                    ]
+                ),
+                operation='face_swap',
+                user_id=user_id
+            )
+
+            for part in response.parts:
+                if hasattr(part, 'as_image') and part.as_image():
+                    gemini_image = part.as_image()
+
+                    if gemini_image and hasattr(gemini_image, 'image_bytes'):
+                        # Keep the encoded bytes; callers decode only if they need pixels
+                        result_image = EncodedImage(gemini_image.image_bytes, gemini_image.mime_type)
+                        return result_image, "Face swap completed successfully!"
+
+            return None, "Face swap failed to generate result"
+        except Exception as e:
+            return None, f"Face swap error: {str(e)}"
+
+    def advanced_edit_image(self, input_image, edit_type, options, user_id=None):
+        """Enhanced editing; identical concurrent requests share one call"""
+        key = ImageCache.make_key('edit', MODEL_ID, image_digest(input_image), edit_type, options)
+        return self.single_flight.do(key, self._advanced_edit_image, input_image, edit_type, options, user_id)
+
+    def _advanced_edit_image(self, input_image, edit_type, options, user_id=None):
+        """Enhanced editing with all transformation capabilities"""
+        try:
+            gateway = self.gateway
+
+            # Build specific prompts for different edit types
+            if edit_type == "outfit_change":
+                prompt = f"Change the person's clothing to {options['clothing']}, keep same person, face, pose and background. {options.get('additional', '')}"
+
+            elif edit_type == "pose_change":
+                prompt = f"Modify the person's pose to {options['pose']} with {options['expression']} facial expression. Keep same person, clothing, and background."
+
+            elif edit_type == "face_enhancement":
+                prompt = f"Enhance the person's face: {options['enhancement']}. Keep everything else exactly the same. Make it look natural and professional."
+
+            elif edit_type == "body_modification":
+                prompt = f"Modify the person's body: {options['modification']}. Keep face, clothing style, and background the same. Make it look natural and realistic."
+
+            elif edit_type == "background_change":
+                prompt = f"Change the background to {options['background']}. Keep the person(s) exactly the same with proper lighting and shadows."
+
+            elif edit_type == "object_control":
+                if options['action'] == 'remove':
+                    prompt = f"Remove {options['object']} from the image. Fill the space naturally with appropriate background."
+                elif options['action'] == 'add':
+                    prompt = f"Add {options['object']} to the image in a natural way that fits the scene and lighting."
+                else:
+                    prompt = f"Replace {options['old_object']} with {options['new_object']} naturally in the scene."
+
+            elif edit_type == "complete_makeover":
+                prompt = f"Complete transformation: change clothing to {options['clothing']}, modify pose to {options['pose']}, enhance face with {options['face_enhancement']}, expression to {options['expression']}. Keep same person and background."
+
+            elif edit_type == "style_transfer":
+                prompt = f"Transform this image to {options['style']} style while maintaining all subjects and composition."
+
+            else:  # custom edit
+                prompt = options.get('custom_prompt', 'Enhance this image professionally')
+
+            response = gateway.generate_content(
+                model=MODEL_ID,
+                contents=[prompt, model_input(input_image)],
+                config=types.GenerateContentConfig(
+                    safety_settings=[
+                        types.SafetySetting(
+                            category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+                            threshold=types.HarmBlockThreshold.BLOCK_NONE,
+                        )
+                    ]
+                ),
+                operation='edit',
+                user_id=user_id
+            )
+
+            for part in response.parts:
+                if hasattr(part, 'as_image') and part.as_image():
+                    gemini_image = part.as_image()
+
+                    if gemini_image and hasattr(gemini_image, 'image_bytes'):
+                        # Keep the encoded bytes; callers decode only if they need pixels
+                        result_image = EncodedImage(gemini_image.image_bytes, gemini_image.mime_type)
+                        return result_image, "Image transformation completed successfully!"
+
+            return None, "No edited image generated"
+        except Exception as e:
+            return None, f"Editing error: {str(e)}"
+
+    def analyze_image_content(self, image, analysis_type, user_id=None):
+        """Image analysis; identical concurrent requests share one call"""
+        digest = image_digest(image)
+        key = ImageCache.make_key('analyze', MODEL_ID, digest, analysis_type)
+        return self.single_flight.do(key, self._analyze_image_content, image, analysis_type, digest, user_id)
+
+    def _analyze_image_content(self, image, analysis_type, digest, user_id=None):
+        """Comprehensive image analysis and intelligence"""
+        try:
+            gateway = self.gateway
+        
+            cache = self.analysis_cache
+            cache_key = self._analysis_key(analysis_type, digest)
+            cached_text = cache.get(cache_key)
+            if cached_text is not None:
+                return cached_text
+        
+            contents, config = self._analysis_request(analysis_type, image)
+            try:
+                response = gateway.generate_content(
+                    model=MODEL_ID,
+                    contents=contents,
+                    config=config,
+                    operation='analyze',
+                    user_id=user_id
+                )
+            except Exception as e:
+                if config is None or not config.cached_content or not is_cache_error(e):
+                    raise
+                # The cached content was evicted or expired early; resend the instruction inline
+                self.prompt_cache.invalidate(analysis_system_instruction())
+                contents, config = self._analysis_request(analysis_type, image, use_cache=False)
+                response = gateway.generate_content(
+                    model=MODEL_ID,
+                    contents=contents,
+                    config=config,
+                    operation='analyze',
+                    user_id=user_id
+                )
+        
+            analysis_text = ""
+            for part in response.parts:
+                if part.text:
+                    analysis_text += part.text
+        
+            if analysis_text:
+                cache.put(cache_key, analysis_text, len(analysis_text.encode('utf-8')))
+        
+            return analysis_text
+        
+        except Exception as e:
+            return f"Analysis error: {str(e)}"
+
+    def run_analysis_batch(self, files, analysis_type, max_in_flight=BATCH_MAX_IN_FLIGHT, on_progress=None, user_id=None, on_text=None):
+        """Analyze (filename, image) pairs concurrently; on_progress(done, total, result) fires as each one lands"""
+        results = [None] * len(files)
+        
+        # With on_text, analyses are streamed and on_text(index, text_so_far) fires from the worker threads
+        def analyze_streaming(i, image):
+            text = ""
+            for chunk in self.analyze_image_content_stream(image, analysis_type, user_id):
+                text += chunk
+                on_text(i, text)
+            return text
+        
+        workers = max(1, min(max_in_flight, len(files)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                (executor.submit(analyze_streaming, i, image) if on_text
+                 else executor.submit(self.analyze_image_content, image, analysis_type, user_id)): i
+                for i, (_, image) in enumerate(files)
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                i = futures[future]
+                results[i] = {'filename': files[i][0], 'analysis': future.result()}
+                if on_progress:
+                    on_progress(done, len(files), results[i])
+        return results
+    
+    def run_packed_analysis_batch(self, files, analysis_type, max_in_flight=BATCH_MAX_IN_FLIGHT, on_progress=None, user_id=None, max_images=PACK_MAX_IMAGES):
+        """Like run_analysis_batch, but sends several images per request with a JSON answer keyed by filename"""
+        prompt = resolve_analysis_prompt(analysis_type)
+        results = [None] * len(files)
+        done = 0
+        
+        def finish(i, analysis):
+            nonlocal done
+            done += 1
+            results[i] = {'filename': files[i][0], 'analysis': analysis}
+            if on_progress:
+                on_progress(done, len(files), results[i])
+        
+        pending = []
+        for i, (_, image) in enumerate(files):
+            cached_text = self.analysis_cache.get(packed_analysis_key(prompt, image_digest(image)))
+            if cached_text is not None:
+                finish(i, cached_text)
+            else:
+                pending.append(i)
+        
+        if pending:
+            sizes = [
+                (len(files[i][1].data) if isinstance(files[i][1], EncodedImage) else pixel_bytes(files[i][1]),
+                 image_input_tokens(files[i][1]))
+                for i in pending
+            ]
+            max_tokens = PACK_MAX_INPUT_TOKENS - len(prompt + PACK_INSTRUCTIONS) // 4
+            packs = [[pending[j] for j in pack] for pack in plan_packs(sizes, max_images, PACK_MAX_BYTES, max_tokens)]
+            
+            workers = max(1, min(max_in_flight, len(packs)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(self._analyze_pack, files, pack, analysis_type, user_id): pack for pack in packs}
+                # Callbacks run on the calling thread so Streamlit widgets can be updated
+                for future in as_completed(futures):
+                    for i, analysis in future.result().items():
+                        finish(i, analysis)
+        
+        return results
+    
+    def _analyze_pack(self, files, indices, analysis_type, user_id):
+        """Analyses for one pack as {file index: text}; oversized packs are halved, unanswered images go one by one"""
+        prompt = resolve_analysis_prompt(analysis_type)
+        labels = pack_labels([files[i][0] for i in indices])
+        
+        contents = [PACK_INSTRUCTIONS.format(count=len(indices)) + prompt]
+        for label, i in zip(labels, indices):
+            contents.append(f"{PACK_LABEL_PREFIX} {label}")
+            contents.append(model_input(files[i][1]))
+        
+        answers = {}
+        try:
+            response = self.gateway.generate_content(
+                model=MODEL_ID,
+                contents=contents,
+                config=types.GenerateContentConfig(
+                    response_mime_type='application/json',
+                    response_schema=PACK_RESPONSE_SCHEMA
+                ),
+                operation='analyze',
+                mode='pack',
+                user_id=user_id
+            )
+            entries = json.loads(response.text or "[]")
+            # Models sometimes echo the whole label line back, so match on the bare filename
+            answers = {
+                str(entry.get('filename', '')).strip().removeprefix(PACK_LABEL_PREFIX).strip(): entry.get('analysis')
+                for entry in entries if isinstance(entry, dict)
+            }
+        except ValueError:
+            # Malformed JSON; fall through and analyze each image on its own
+            pass
+        except Exception as e:
+            if getattr(e, 'code', None) not in (400, 413):
+                return {i: f"Analysis error: {str(e)}" for i in indices}
+            if len(indices) > 1:
+                # Over a payload or token limit the estimate missed; split the pack and try again
+                middle = len(indices) // 2
+                return {
+                    **self._analyze_pack(files, indices[:middle], analysis_type, user_id),
+                    **self._analyze_pack(files, indices[middle:], analysis_type, user_id),
+                }
+            # A lone image the packed request could not carry falls through to the plain call
+        
+        results = {}
+        for label, i in zip(labels, indices):
+            analysis = answers.get(label)
+            if analysis:
+                image = files[i][1]
+                self.analysis_cache.put(packed_analysis_key(prompt, image_digest(image)), analysis, len(analysis.encode('utf-8')))
+                results[i] = analysis
+            else:
+                results[i] = self.analyze_image_content(files[i][1], analysis_type, user_id)
+        return results
+    
+    def analyze_image_content_stream(self, image, analysis_type, user_id=None):
+        """Stream analysis text as it is generated; joins an identical analysis in flight and then yields its text in one piece"""
+        digest = image_digest(image)
+        key = ImageCache.make_key('analyze', MODEL_ID, digest, analysis_type)
+        yield from self.single_flight.do_stream(key, self._analyze_image_content_stream, image, analysis_type, digest, user_id)
+    
+    def _analyze_image_content_stream(self, image, analysis_type, digest, user_id=None):
+        """Stream analysis text as it is generated; cached results are yielded in one piece"""
+        try:
+            gateway = self.gateway
+        
+            cache = self.analysis_cache
+            cache_key = self._analysis_key(analysis_type, digest)
+            cached_text = cache.get(cache_key)
+            if cached_text is not None:
+                yield cached_text
+                return
+        
+            def stream(contents, config):
+                for chunk in gateway.generate_content_stream(model=MODEL_ID, contents=contents, config=config, operation='analyze', user_id=user_id):
+                    if chunk.text:
+                        yield chunk.text
+        
+            analysis_text = ""
+            contents, config = self._analysis_request(analysis_type, image)
+            try:
+                for text in stream(contents, config):
+                    analysis_text += text
+                    yield text
+            except Exception as e:
+                # Only a stream that has not produced any text yet can be restarted without duplicating it
+                if analysis_text or config is None or not config.cached_content or not is_cache_error(e):
+                    raise
+                self.prompt_cache.invalidate(analysis_system_instruction())
+                contents, config = self._analysis_request(analysis_type, image, use_cache=False)
+                for text in stream(contents, config):
+                    analysis_text += text
+                    yield text
+        
+            if analysis_text:
+                cache.put(cache_key, analysis_text, len(analysis_text.encode('utf-8')))
+        
+        except Exception as e:
+            yield f"Analysis error: {str(e)}"
+
+# Preview encoding quality
+THUMBNAIL_QUALITY = 80
+
+def make_thumbnail(data, max_edge):
+    """Downscaled JPEG (WEBP with alpha) preview of encoded image bytes"""
+    preview = PIL.Image.open(io.BytesIO(data))
+    if max(preview.size) <= max_edge:
+        return data
+    
+    # Lets the JPEG decoder skip straight to a reduced scale
+    preview.draft('RGB', (max_edge, max_edge))
+    has_alpha = preview.mode in ('RGBA', 'LA') or (preview.mode == 'P' and 'transparency' in preview.info)
+    preview = preview.convert('RGBA' if has_alpha else 'RGB')
+    preview.thumbnail((max_edge, max_edge), PIL.Image.LANCZOS)
+    
+    buf = io.BytesIO()
+    preview.save(buf, format='WEBP' if has_alpha else 'JPEG', quality=THUMBNAIL_QUALITY)
+    return buf.getvalue()
+
+def encode_results(images, fmt, quality, pool, cache=None, errors=None):
+    """Convert encoded images to the chosen format in a process pool, reusing cached conversions"""
+    mime_type = FORMAT_MIME_TYPES[fmt]
+    results = list(images)
+    pending = {}
+    
+    for i, image in enumerate(images):
+        # Lossless outputs already in the target format need no work
+        if fmt == "PNG" and image.mime_type == mime_type:
+            continue
+        
+        key = (image.digest, fmt, quality)
+        cached_bytes = cache.get(key) if cache else None
+        if cached_bytes is not None:
+            results[i] = EncodedImage(cached_bytes, mime_type)
+        else:
+            pending[pool.submit(encode_image_bytes, image.data, fmt, quality)] = (i, key)
+    
+    for future in as_completed(pending):
+        i, key = pending[future]
+        try:
+            data = future.result()
+        except Exception as e:
+            # Keep the original image, still labelled with its own MIME type, and report why through errors[i]
+            if errors is not None:
+                errors[i] = str(e) or type(e).__name__
+            continue
+        if cache:
+            cache.put(key, data, len(data))
+        results[i] = EncodedImage(data, mime_type)
+    
+    return results
+
+def write_results_zip(fileobj, items, manifest):
+    """Write (name, encoded image, metadata) items and a JSON manifest into a ZIP one entry at a time"""
+    files = []
+    # Images are already compressed, so entries are stored rather than deflated
+    with zipfile.ZipFile(fileobj, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for name, image, metadata in items:
+            filename = f"{name}.{image.extension}"
+            archive.writestr(filename, image.data)
+            files.append({'file': filename, 'mime_type': image.mime_type, 'bytes': len(image.data), **metadata})
+        
+        archive.writestr("manifest.json", json.dumps({
+            **manifest,
+            'created': datetime.now().isoformat(),
+            'files': files
+        }, indent=2, default=str))
+    return files
@@ -0,0 +1,234 @@
+"""Process-wide metrics in the OpenMetrics text format, served from a side port.
+
+MetricsRegistry keeps cumulative histograms and counters fed by CallLog
+listeners and script reruns. Point-in-time values such as in-flight calls
+and cache counters are read from collector callbacks at scrape time.
+serve_metrics exposes /metrics from a daemon thread.
+"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Model calls run from a fraction of a second to a couple of minutes
+CALL_LATENCY_BUCKETS = (0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+RERUN_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Calls wait for quota up to QUOTA_QUEUE_SECONDS (30 s by default)
+QUEUE_WAIT_BUCKETS = (0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0)
+
+# A session counts as active if it reran within this window
+ACTIVE_SESSION_SECONDS = 5 * 60
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _number(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count for one label set"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        clone = Histogram(self.buckets)
+        clone.counts, clone.sum, clone.count = self.counts[:], self.sum, self.count
+        return clone
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            yield f"{name}_bucket{_labels({**labels, 'le': _number(float(bound))})} {cumulative}"
+        yield f"{name}_sum{_labels(labels)} {_number(self.sum)}"
+        yield f"{name}_count{_labels(labels)} {self.count}"
+
+
+class MetricsRegistry:
+    """Thread-safe store of histograms and counters plus scrape-time collectors"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.call_latency = {}
+        self.counters = {}
+        self.rerun_latency = Histogram(RERUN_LATENCY_BUCKETS)
+        self.queue_wait = Histogram(QUEUE_WAIT_BUCKETS)
+        self.sessions = {}
+        self.collectors = []
+
+    def _inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe_call(self, record):
+        """CallLog listener: latency histogram per operation and mode, quota wait histogram plus call, retry and token counters"""
+        # One operation keeps one series name; mode (single, stream, pack) only splits it by how the call was sent
+        labels = {'operation': record['operation'], 'mode': record.get('mode') or 'single'}
+        key = (labels['operation'], labels['mode'])
+        with self.lock:
+            if record.get('queue_wait') is not None:
+                self.queue_wait.observe(record['queue_wait'])
+            if record['outcome'] == 'ok' and record['wall_time'] is not None:
+                if key not in self.call_latency:
+                    self.call_latency[key] = Histogram(CALL_LATENCY_BUCKETS)
+                self.call_latency[key].observe(record['wall_time'])
+            self._inc('studio_model_calls', {**labels, 'outcome': record['outcome']})
+            if record['attempts'] and record['attempts'] > 1:
+                self._inc('studio_model_call_retries', labels, record['attempts'] - 1)
+            for kind, field in (('prompt', 'prompt_tokens'), ('candidates', 'candidate_tokens')):
+                if record[field]:
+                    self._inc('studio_model_tokens', {**labels, 'kind': kind}, record[field])
+
+    def observe_rerun(self, session_id, seconds):
+        """Record one script run for a session"""
+        with self.lock:
+            self.rerun_latency.observe(seconds)
+            self.sessions[session_id] = time.time()
+            self._inc('studio_reruns', {})
+
+    def active_sessions(self):
+        """Sessions that reran within ACTIVE_SESSION_SECONDS; older ones are forgotten"""
+        cutoff = time.time() - ACTIVE_SESSION_SECONDS
+        with self.lock:
+            self.sessions = {sid: seen for sid, seen in self.sessions.items() if seen >= cutoff}
+            return len(self.sessions)
+
+    def add_collector(self, collector):
+        """Register collector() -> [(name, type, help, [(labels, value)])] evaluated on every scrape"""
+        self.collectors.append(collector)
+
+    def render(self):
+        """All metrics as OpenMetrics text"""
+        lines = []
+        with self.lock:
+            histograms = [(key, histogram.copy()) for key, histogram in sorted(self.call_latency.items())]
+            rerun_latency = self.rerun_latency.copy()
+            queue_wait = self.queue_wait.copy()
+            counters = dict(self.counters)
+
+        lines.append("# TYPE studio_model_call_duration_seconds histogram")
+        lines.append("# HELP studio_model_call_duration_seconds Wall time of successful model calls, including retries but not quota wait.")
+        for (operation, mode), histogram in histograms:
+            lines.extend(histogram.samples("studio_model_call_duration_seconds", {'operation': operation, 'mode': mode}))
+
+        lines.append("# TYPE studio_rerun_duration_seconds histogram")
+        lines.append("# HELP studio_rerun_duration_seconds Wall time of Streamlit script runs.")
+        lines.extend(rerun_latency.samples("studio_rerun_duration_seconds", {}))
+
+        lines.append("# TYPE studio_quota_wait_seconds histogram")
+        lines.append("# HELP studio_quota_wait_seconds Time model calls waited for spend quota before being sent or rejected.")
+        lines.extend(queue_wait.samples("studio_quota_wait_seconds", {}))
+
+        helps = {
+            'studio_model_calls': "Model calls by operation and outcome.",
+            'studio_model_call_retries': "Retried attempts of model calls.",
+            'studio_model_tokens': "Tokens reported in usage metadata.",
+            'studio_reruns': "Streamlit script runs.",
+        }
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"# HELP {name} {helps.get(name, name)}")
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append(f"{name}_total{_labels(dict(labels))} {_number(value)}")
+
+        lines.append("# TYPE studio_active_sessions gauge")
+        lines.append(f"# HELP studio_active_sessions Sessions that reran in the last {ACTIVE_SESSION_SECONDS} seconds.")
+        lines.append(f"studio_active_sessions {self.active_sessions()}")
+
+        for collector in self.collectors:
+            try:
+                families = collector()
+            except Exception:
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"# HELP {name} {help_text}")
+                suffix = "_total" if kind == "counter" else ""
+                for labels, value in samples:
+                    lines.append(f"{name}{suffix}{_labels(labels)} {_number(value)}")
+
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(registry, host="0.0.0.0", port=9464):
+    """Serve /metrics on a daemon thread and return the server"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="studio-metrics", daemon=True).start()
+    return server
+
+
+def cache_collector(caches):
+    """Collector for hit/miss counters, hit ratio and size of named caches exposing stats()"""
+    def collect():
+        stats = {name: cache.stats() for name, cache in caches.items()}
+        return [
+            ('studio_cache_hits', 'counter', "Cache lookups that found an entry.",
+             [({'cache': name}, s['hits']) for name, s in stats.items()]),
+            ('studio_cache_misses', 'counter', "Cache lookups that missed.",
+             [({'cache': name}, s['misses']) for name, s in stats.items()]),
+            ('studio_cache_hit_ratio', 'gauge', "Hits over lookups since the process started.",
+             [({'cache': name}, s['hit_ratio']) for name, s in stats.items()]),
+            ('studio_cache_bytes', 'gauge', "Bytes held by each cache.",
+             [({'cache': name}, s['bytes']) for name, s in stats.items()]),
+        ]
+    return collect
+
+
+def gateway_collector(gateway):
+    """Collector for in-flight calls, fast-failed calls and circuit breaker states of a ModelGateway"""
+    def collect():
+        stats = gateway.stats()
+        return [
+            ('studio_model_calls_in_flight', 'gauge', "Model calls currently running, including retries and backoff.",
+             [({'operation': operation}, count) for operation, count in sorted(stats['in_flight'].items())]),
+            ('studio_circuit_rejections', 'counter', "Calls fast-failed by an open circuit breaker.",
+             [({}, stats['circuit_rejections'])]),
+            ('studio_circuit_open', 'gauge', "1 while a model's circuit breaker is open or half-open.",
+             [({'model': model}, 0 if state == "closed" else 1) for model, state in sorted(stats['breakers'].items())]),
+        ]
+    return collect
@@ -0,0 +1,505 @@
+"""SQLite-backed history, image blob and background job stores used by the app.
+
+Nothing here imports Streamlit: streamlit_app.py keeps one instance of each
+in st.cache_resource, and tests or scripts can build their own on temporary
+paths.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from studio_engine import EncodedImage
+
+# Persistent operation history
+HISTORY_PAGE_SIZE = 20
+
+class HistoryStore:
+    """SQLite-backed operation history with structured columns and full-text prompt search"""
+    
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created_at TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    item_type TEXT NOT NULL,
+                    prompt TEXT,
+                    operation TEXT,
+                    success INTEGER NOT NULL DEFAULT 1,
+                    image_count INTEGER,
+                    data TEXT NOT NULL,
+                    images TEXT
+                )
+            """)
+            columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(history)")}
+            if 'images' not in columns:
+                self.conn.execute("ALTER TABLE history ADD COLUMN images TEXT")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_history_user_type ON history (user_id, item_type, id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_history_user_created ON history (user_id, created_at)")
+            
+            # FTS5 is optional in some SQLite builds; fall back to LIKE matching without it
+            try:
+                self.conn.execute("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS history_fts
+                    USING fts5(prompt, operation, content='history', content_rowid='id')
+                """)
+                self.conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN
+                        INSERT INTO history_fts (rowid, prompt, operation) VALUES (new.id, new.prompt, new.operation);
+                    END
+                """)
+                self.conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN
+                        INSERT INTO history_fts (history_fts, rowid, prompt, operation) VALUES ('delete', old.id, old.prompt, old.operation);
+                    END
+                """)
+                self.fts = True
+            except sqlite3.OperationalError:
+                self.fts = False
+    
+    def add(self, user_id, item_type, data, image_digests=None):
+        """Record one operation; common fields are lifted into indexed columns"""
+        operation = data.get('style') or data.get('edit_type') or data.get('analysis_type')
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO history (created_at, user_id, item_type, prompt, operation, success, image_count, data, images) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    user_id,
+                    item_type,
+                    data.get('prompt'),
+                    operation,
+                    1 if data.get('success', True) else 0,
+                    data.get('count'),
+                    json.dumps(data, default=str),
+                    json.dumps(image_digests) if image_digests else None
+                )
+            )
+            return cursor.lastrowid
+    
+    def _filter(self, user_id, item_type=None, search=None, since=None):
+        clauses = ["user_id = ?"]
+        params = [user_id]
+        if item_type:
+            clauses.append("item_type = ?")
+            params.append(item_type)
+        if since:
+            clauses.append("created_at >= ?")
+            params.append(since)
+        if search and search.strip():
+            if self.fts:
+                # Quote each term so user input cannot inject FTS syntax; trailing * matches prefixes
+                query = " ".join('"' + term.replace('"', '""') + '"*' for term in search.split())
+                clauses.append("id IN (SELECT rowid FROM history_fts WHERE history_fts MATCH ?)")
+                params.append(query)
+            else:
+                clauses.append("(prompt LIKE ? OR operation LIKE ?)")
+                params.extend([f"%{search.strip()}%"] * 2)
+        return " AND ".join(clauses), params
+    
+    def list(self, user_id, item_type, limit=HISTORY_PAGE_SIZE, offset=0, search=None):
+        """Newest-first page of history items"""
+        where, params = self._filter(user_id, item_type, search)
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT id, created_at, item_type, data, images FROM history WHERE {where} ORDER BY id DESC LIMIT ? OFFSET ?",
+                params + [limit, offset]
+            ).fetchall()
+        return [
+            {
+                'id': row['id'],
+                'timestamp': row['created_at'],
+                'type': row['item_type'],
+                'data': json.loads(row['data']),
+                'images': json.loads(row['images']) if row['images'] else []
+            }
+            for row in rows
+        ]
+    
+    def count(self, user_id, item_type=None, search=None, since=None):
+        where, params = self._filter(user_id, item_type, search, since)
+        with self.lock:
+            return self.conn.execute(f"SELECT COUNT(*) FROM history WHERE {where}", params).fetchone()[0]
+    
+    def counts_by_type(self, user_id, since=None):
+        """Number of operations per item type"""
+        where, params = self._filter(user_id, since=since)
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT item_type, COUNT(*) FROM history WHERE {where} GROUP BY item_type", params
+            ).fetchall()
+        return {row[0]: row[1] for row in rows}
+    
+    def counts_by_operation(self, user_id, item_type):
+        """Number of operations per style / edit type / analysis type, most used first"""
+        where, params = self._filter(user_id, item_type)
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT COALESCE(operation, 'Unknown'), COUNT(*) AS n FROM history WHERE {where} "
+                "GROUP BY operation ORDER BY n DESC", params
+            ).fetchall()
+        return [(row[0], row[1]) for row in rows]
+    
+    def clear(self, user_id):
+        """Delete a user's history, returning the image digests the rows referenced"""
+        with self.lock, self.conn:
+            rows = self.conn.execute(
+                "SELECT images FROM history WHERE user_id = ? AND images IS NOT NULL", (user_id,)
+            ).fetchall()
+            self.conn.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+        return [digest for row in rows for digest in json.loads(row['images'])]
+    
+    def drop_images(self, digests):
+        """Forget evicted images: rows lose those digests, and rows left without any images are deleted"""
+        gone = set(digests)
+        with self.lock, self.conn:
+            rows = self.conn.execute("SELECT id, images FROM history WHERE images IS NOT NULL").fetchall()
+            for row in rows:
+                images = json.loads(row['images'])
+                kept = [digest for digest in images if digest not in gone]
+                if not kept:
+                    self.conn.execute("DELETE FROM history WHERE id = ?", (row['id'],))
+                elif len(kept) < len(images):
+                    self.conn.execute("UPDATE history SET images = ? WHERE id = ?", (json.dumps(kept), row['id']))
+
+# Content-addressed storage for images referenced by history rows
+BLOB_STORE_MAX_BYTES = int(os.environ.get("BLOB_STORE_MAX_MB", "2048")) * 1024 * 1024
+BLOB_ORPHAN_MAX_AGE_SECONDS = 24 * 60 * 60
+BLOB_GC_INTERVAL_SECONDS = 10 * 60
+# Over budget, referenced blobs are evicted too, but never ones stored or reused this recently
+BLOB_EVICT_MIN_AGE_SECONDS = 60 * 60
+
+class BlobStore:
+    """Sharded, deduplicated image store with reference counts, kept within an age and size budget"""
+    
+    def __init__(self, directory, db_path, max_bytes=BLOB_STORE_MAX_BYTES, orphan_max_age=BLOB_ORPHAN_MAX_AGE_SECONDS,
+                 evict_min_age=BLOB_EVICT_MIN_AGE_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.orphan_max_age = orphan_max_age
+        self.evict_min_age = evict_min_age
+        self.last_gc = 0.0
+        self.evict_listeners = []
+        os.makedirs(directory, exist_ok=True)
+        
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    digest TEXT PRIMARY KEY,
+                    mime_type TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    refcount INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    last_referenced REAL NOT NULL
+                )
+            """)
+    
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest[2:4], digest)
+    
+    def put(self, image):
+        """Store an encoded image (once per unique content) and take a reference to it"""
+        digest = image.digest
+        path = self._path(digest)
+        
+        # Take the reference before checking for the file: gc removes rows and their files under the same lock
+        # and only evicts referenced blobs untouched for evict_min_age, so a file seen here cannot vanish afterwards
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO blobs (digest, mime_type, size, refcount, created_at, last_referenced) VALUES (?, ?, ?, 1, ?, ?) "
+                "ON CONFLICT(digest) DO UPDATE SET refcount = refcount + 1, last_referenced = excluded.last_referenced",
+                (digest, image.mime_type, len(image.data), now, now)
+            )
+            stored = os.path.exists(path)
+        
+        if not stored:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(image.data)
+            os.replace(tmp_path, path)
+        
+        if now - self.last_gc > BLOB_GC_INTERVAL_SECONDS:
+            self.gc()
+        return digest
+    
+    def get(self, digest):
+        """Stored image for a digest, or None if it has been collected"""
+        with self.lock:
+            row = self.conn.execute("SELECT mime_type FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+        try:
+            with open(self._path(digest), 'rb') as f:
+                return EncodedImage(f.read(), row['mime_type'], digest)
+        except OSError:
+            return None
+    
+    def release(self, digests):
+        """Drop one reference per digest; unreferenced blobs become eligible for collection"""
+        if not digests:
+            return
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE blobs SET refcount = MAX(refcount - 1, 0) WHERE digest = ?",
+                [(digest,) for digest in digests]
+            )
+    
+    def add_evict_listener(self, listener):
+        """Call listener(digests) after referenced blobs are evicted, so holders can drop their references"""
+        self.evict_listeners.append(listener)
+    
+    def gc(self):
+        """Delete expired orphans, then the least recently referenced blobs while over budget, orphans first"""
+        now = time.time()
+        self.last_gc = now
+        
+        with self.lock:
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            orphans = self.conn.execute(
+                "SELECT digest, size, last_referenced FROM blobs WHERE refcount = 0 ORDER BY last_referenced"
+            ).fetchall()
+            
+            doomed = []
+            for row in orphans:
+                if row['last_referenced'] < now - self.orphan_max_age or total > self.max_bytes:
+                    doomed.append((row['digest'], row['last_referenced'], False))
+                    total -= row['size']
+            
+            if total > self.max_bytes:
+                referenced = self.conn.execute(
+                    "SELECT digest, size, last_referenced FROM blobs WHERE refcount > 0 AND last_referenced < ? ORDER BY last_referenced",
+                    (now - self.evict_min_age,)
+                ).fetchall()
+                for row in referenced:
+                    if total <= self.max_bytes:
+                        break
+                    doomed.append((row['digest'], row['last_referenced'], True))
+                    total -= row['size']
+            
+            # Another server process sharing the database may have referenced a blob since; put() always moves
+            # last_referenced forward, so only delete rows that are still as they were read
+            deleted, evicted = [], []
+            with self.conn:
+                for digest, last_referenced, held in doomed:
+                    if self.conn.execute(
+                        "DELETE FROM blobs WHERE digest = ? AND last_referenced = ?", (digest, last_referenced)
+                    ).rowcount:
+                        deleted.append(digest)
+                        if held:
+                            evicted.append(digest)
+            for digest in deleted:
+                try:
+                    os.remove(self._path(digest))
+                except OSError:
+                    pass
+        
+        if evicted:
+            for listener in self.evict_listeners:
+                listener(evicted)
+        return len(deleted)
+
+# Background jobs
+JOB_WORKERS = 4
+JOB_RETENTION_SECONDS = int(os.environ.get("JOB_RETENTION_DAYS", "7")) * 24 * 60 * 60
+JOB_LIST_LIMIT = 10
+
+class JobManager:
+    """Worker threads for long operations so they survive reruns; status, partial items and results are persisted in SQLite"""
+    
+    def __init__(self, db_path, blob_store, max_workers=JOB_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="studio-job")
+        self.blob_store = blob_store
+        blob_store.add_evict_listener(self.drop_images)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    description TEXT,
+                    status TEXT NOT NULL,
+                    done INTEGER NOT NULL DEFAULT 0,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    result TEXT,
+                    images TEXT
+                )
+            """)
+            columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+            for column in ('result', 'images'):
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user_created ON jobs (user_id, created_at)")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS job_items (
+                    job_id TEXT NOT NULL,
+                    slot INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (job_id, slot)
+                )
+            """)
+            # Worker threads do not outlive the process, so unfinished jobs cannot resume
+            self.conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Interrupted by server restart' "
+                "WHERE status IN ('queued', 'running')"
+            )
+        self.prune()
+    
+    def submit(self, user_id, kind, description, fn, *args, **kwargs):
+        """Queue fn(*args, report=..., **kwargs) on a worker thread and return its job id"""
+        job_id = uuid.uuid4().hex
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO jobs (id, user_id, kind, description, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (job_id, user_id, kind, description, now, now)
+            )
+        self.executor.submit(self._run, job_id, fn, args, kwargs)
+        self.prune()
+        return job_id
+    
+    def _update(self, job_id, **fields):
+        fields['updated_at'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self.lock, self.conn:
+            self.conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", list(fields.values()) + [job_id])
+    
+    def _put_item(self, job_id, item, slot=None):
+        with self.lock, self.conn:
+            if slot is None:
+                slot = self.conn.execute(
+                    "SELECT COALESCE(MAX(slot) + 1, 0) FROM job_items WHERE job_id = ?", (job_id,)
+                ).fetchone()[0]
+            self.conn.execute(
+                "INSERT INTO job_items (job_id, slot, data) VALUES (?, ?, ?) "
+                "ON CONFLICT(job_id, slot) DO UPDATE SET data = excluded.data",
+                (job_id, slot, json.dumps(item, default=str))
+            )
+    
+    def _store_images(self, value, digests):
+        """Copy of a result with every EncodedImage moved into the blob store and replaced by its digest"""
+        if isinstance(value, EncodedImage):
+            digests.append(self.blob_store.put(value))
+            return {'__blob__': digests[-1]}
+        if isinstance(value, dict):
+            return {key: self._store_images(item, digests) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._store_images(item, digests) for item in value]
+        return value
+    
+    def _load_images(self, value):
+        """Inverse of _store_images; images the blob store has since collected come back as None"""
+        if isinstance(value, dict):
+            if set(value) == {'__blob__'}:
+                return self.blob_store.get(value['__blob__'])
+            return {key: self._load_images(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._load_images(item) for item in value]
+        return value
+    
+    def _run(self, job_id, fn, args, kwargs):
+        self._update(job_id, status='running')
+        
+        def report(done=None, total=None, item=None, slot=None):
+            # done/total of None leave the counters alone, so streamed items can be updated in place
+            if item is not None:
+                self._put_item(job_id, item, slot)
+            if done is not None:
+                self._update(job_id, done=done, total=total)
+        
+        digests = []
+        try:
+            result = fn(*args, report=report, **kwargs)
+            stored = json.dumps(self._store_images(result, digests), default=str)
+        except Exception as e:
+            self.blob_store.release(digests)
+            self._update(job_id, status='failed', error=str(e))
+            return
+        
+        self._update(job_id, status='done', result=stored, images=json.dumps(digests))
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM job_items WHERE job_id = ?", (job_id,))
+    
+    def list(self, user_id, kinds, limit=JOB_LIST_LIMIT):
+        """Most recent jobs of the given kinds for a user, without their results"""
+        placeholders = ", ".join("?" for _ in kinds)
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT id, user_id, kind, description, status, done, total, error, created_at, updated_at "
+                f"FROM jobs WHERE user_id = ? AND kind IN ({placeholders}) ORDER BY created_at DESC LIMIT ?",
+                [user_id, *kinds, limit]
+            ).fetchall()
+        return [dict(row) for row in rows]
+    
+    def result(self, job_id):
+        """Result of a finished job with its images loaded from the blob store, or None if there is none"""
+        with self.lock:
+            row = self.conn.execute("SELECT result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or row['result'] is None:
+            return None
+        return self._load_images(json.loads(row['result']))
+    
+    def partial_results(self, job_id):
+        """Items a running or failed job has reported so far"""
+        with self.lock:
+            rows = self.conn.execute("SELECT data FROM job_items WHERE job_id = ? ORDER BY slot", (job_id,)).fetchall()
+        return [json.loads(row['data']) for row in rows]
+    
+    def _delete(self, where, params):
+        with self.lock, self.conn:
+            rows = self.conn.execute(f"SELECT id, images FROM jobs WHERE {where}", params).fetchall()
+            self.conn.executemany("DELETE FROM job_items WHERE job_id = ?", [(row['id'],) for row in rows])
+            self.conn.executemany("DELETE FROM jobs WHERE id = ?", [(row['id'],) for row in rows])
+        self.blob_store.release([digest for row in rows if row['images'] for digest in json.loads(row['images'])])
+        return len(rows)
+    
+    def drop_images(self, digests):
+        """Forget evicted images so dismissing or pruning a job does not release them again"""
+        gone = set(digests)
+        with self.lock, self.conn:
+            rows = self.conn.execute("SELECT id, images FROM jobs WHERE images IS NOT NULL").fetchall()
+            for row in rows:
+                images = json.loads(row['images'])
+                kept = [digest for digest in images if digest not in gone]
+                if len(kept) < len(images):
+                    self.conn.execute("UPDATE jobs SET images = ? WHERE id = ?", (json.dumps(kept), row['id']))
+    
+    def dismiss(self, job_id):
+        """Delete a job and release the images its result held"""
+        self._delete("id = ?", (job_id,))
+    
+    def prune(self):
+        """Delete finished jobs not updated within JOB_RETENTION_SECONDS"""
+        cutoff = datetime.fromtimestamp(time.time() - JOB_RETENTION_SECONDS).strftime("%Y-%m-%d %H:%M:%S")
+        return self._delete("status NOT IN ('queued', 'running') AND updated_at < ?", (cutoff,))
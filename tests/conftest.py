@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_gemini import FakeClient, FakeGeminiBackend
+
+
+@pytest.fixture
+def backend():
+    return FakeGeminiBackend(latency_ms=1, latency_sigma=0, error_rate=0.0, stream_chunks=3)
+
+
+@pytest.fixture
+def client(backend):
+    return FakeClient(backend)
@@ -0,0 +1,39 @@
+from studio_engine import ImageCache, ModelGateway, RateLimiter, Studio, _generate_single_variant
+
+
+class CountingRateLimiter:
+    def __init__(self):
+        self.acquired = 0
+
+    def acquire(self):
+        self.acquired += 1
+
+
+def test_runs_every_prompt_and_variant(client, tmp_path):
+    studio = Studio(client, image_cache_dir=str(tmp_path))
+    progress = []
+    jobs = studio.run_generation_batch(["a red fox", "a blue whale"], 2, max_in_flight=3, on_progress=lambda done, total: progress.append((done, total)))
+    assert [(job['prompt_index'], job['variant']) for job in jobs] == [(0, 0), (0, 1), (1, 0), (1, 1)]
+    assert all(job['image'] is not None and job['error'] is None for job in jobs)
+    assert progress[-1] == (4, 4)
+
+
+def test_cache_hits_do_not_take_rate_limit_tokens(client, tmp_path):
+    gateway = ModelGateway(client)
+    cache = ImageCache(str(tmp_path), max_bytes=64 * 1024 * 1024)
+    limiter = CountingRateLimiter()
+    first = _generate_single_variant(gateway, "a red fox", cache=cache, rate_limiter=limiter)
+    second = _generate_single_variant(gateway, "a red fox", cache=cache, rate_limiter=limiter)
+    assert first.data == second.data
+    assert limiter.acquired == 1
+
+
+def test_batch_limiters_keep_their_own_rate_under_a_shared_ceiling():
+    ceiling = CountingRateLimiter()
+    slow = RateLimiter(1, burst=1, parent=ceiling)
+    fast = RateLimiter(6000, burst=1, parent=ceiling)
+    slow.acquire()
+    for _ in range(3):
+        fast.acquire()
+    assert ceiling.acquired == 4
+    assert slow.rate == 1 / 60.0
@@ -0,0 +1,112 @@
+import threading
+
+import pytest
+
+from studio_engine import EncodedImage
+from studio_store import BlobStore, HistoryStore, JobManager
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(str(tmp_path / 'blobs'), str(tmp_path / 'history.db'), max_bytes=1024, orphan_max_age=3600)
+
+
+def test_put_deduplicates_and_counts_references(store):
+    image = EncodedImage(b'x' * 100, 'image/png')
+    assert store.put(image) == store.put(image)
+    store.release([image.digest])
+    assert store.gc() == 0
+    assert store.get(image.digest).data == image.data
+
+
+def test_gc_removes_orphans_over_budget_but_keeps_recent_references(store):
+    kept = EncodedImage(b'k' * 800, 'image/png')
+    orphan = EncodedImage(b'o' * 800, 'image/png')
+    store.put(kept)
+    store.put(orphan)
+    store.release([orphan.digest])
+    assert store.gc() == 1
+    assert store.get(orphan.digest) is None
+    assert store.get(kept.digest).data == kept.data
+
+    # Still over budget, but the remaining blob was referenced too recently to evict
+    store.max_bytes = 1
+    assert store.gc() == 0
+    assert store.get(kept.digest) is not None
+
+
+def test_gc_removes_expired_orphans(store):
+    image = EncodedImage(b'e' * 10, 'image/png')
+    store.put(image)
+    store.release([image.digest])
+    store.orphan_max_age = -1
+    assert store.gc() == 1
+    assert store.get(image.digest) is None
+
+
+def test_put_racing_gc_never_loses_a_referenced_blob(store):
+    store.orphan_max_age = -1
+    image = EncodedImage(b'r' * 64, 'image/png')
+    stop = threading.Event()
+
+    def collect():
+        while not stop.is_set():
+            store.gc()
+
+    collector = threading.Thread(target=collect)
+    collector.start()
+    try:
+        for _ in range(200):
+            store.put(image)
+            assert store.get(image.digest) is not None
+            store.release([image.digest])
+    finally:
+        stop.set()
+        collector.join()
+
+
+def test_gc_evicts_old_referenced_blobs_and_their_history(tmp_path):
+    db_path = str(tmp_path / 'history.db')
+    history = HistoryStore(db_path)
+    store = BlobStore(str(tmp_path / 'blobs'), db_path, max_bytes=1000, evict_min_age=0)
+    store.add_evict_listener(history.drop_images)
+
+    old, shared, new = (EncodedImage(bytes([n]) * 400, 'image/png') for n in range(3))
+    history.add('user', 'generation', {'prompt': "old"}, [store.put(old)])
+    history.add('user', 'generation', {'prompt': "mixed"}, [store.put(shared), store.put(new)])
+    assert store.gc() == 1
+    assert store.get(old.digest) is None
+    assert [item['data']['prompt'] for item in history.list('user', 'generation')] == ["mixed"]
+
+    store.max_bytes = 500
+    assert store.gc() == 1
+    assert history.list('user', 'generation')[0]['images'] == [new.digest]
+    assert store.get(new.digest) is not None
+
+    # Clearing the history releases only the references it still holds
+    store.release(history.clear('user'))
+    store.max_bytes = 0
+    store.orphan_max_age = -1
+    assert store.gc() == 1
+
+
+def test_evicted_job_images_are_not_released_twice(tmp_path):
+    db_path = str(tmp_path / 'history.db')
+    store = BlobStore(str(tmp_path / 'blobs'), db_path, max_bytes=1000, evict_min_age=0)
+    jobs = JobManager(db_path, store)
+    image = EncodedImage(b'j' * 600, 'image/png')
+    job_id = jobs.submit('user', 'test', "Test job", lambda report: {'image': image})
+    jobs.executor.shutdown(wait=True)
+
+    store.max_bytes = 0
+    assert store.gc() == 1
+    assert jobs.result(job_id) == {'image': None}
+
+    # The same image stored again must keep its new reference when the old job goes
+    history = HistoryStore(db_path)
+    history.add('user', 'generation', {'prompt': "again"}, [store.put(image)])
+    jobs.dismiss(job_id)
+    store.orphan_max_age = -1
+    store.evict_min_age = 3600
+    store.gc()
+    assert store.get(image.digest) is not None
@@ -0,0 +1,17 @@
+from studio_engine import CallLog, ModelGateway, summarize_calls
+
+
+def test_calls_are_logged_with_operation_and_mode(client):
+    call_log = CallLog()
+    gateway = ModelGateway(client, call_log=call_log)
+    gateway.generate_content(model='m', contents="hello", operation='analyze', mode='pack')
+    list(gateway.generate_content_stream(model='m', contents="hello", operation='analyze'))
+    records = call_log.recent()
+    assert [(r['operation'], r['mode'], r['outcome']) for r in records] == [('analyze', 'pack', 'ok'), ('analyze', 'stream', 'ok')]
+    assert summarize_calls(records)['analyze']['calls'] == 2
+
+
+def test_persisted_calls_keep_their_mode(client, tmp_path):
+    call_log = CallLog(str(tmp_path / 'calls.db'))
+    ModelGateway(client, call_log=call_log).generate_content(model='m', contents="hello", operation='generate')
+    assert [(r['operation'], r['mode']) for r in call_log.since(60)] == [('generate', 'single')]
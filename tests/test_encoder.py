@@ -0,0 +1,39 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import PIL.Image
+
+from studio_engine import EncodedImage, ResultCache, encode_results
+
+
+def png_bytes():
+    buf = io.BytesIO()
+    PIL.Image.new('RGB', (32, 32), (0, 128, 0)).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def test_converts_and_caches_outputs():
+    images = [EncodedImage(png_bytes(), 'image/png')]
+    cache = ResultCache(60, 1024 * 1024)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        first = encode_results(images, "JPEG", 85, pool, cache)
+        second = encode_results(images, "JPEG", 85, pool, cache)
+    assert first[0].mime_type == 'image/jpeg'
+    assert second[0].data == first[0].data
+    assert cache.stats()['hits'] == 1
+
+
+def test_png_outputs_pass_through():
+    images = [EncodedImage(png_bytes(), 'image/png')]
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        assert encode_results(images, "PNG", 90, pool)[0] is images[0]
+
+
+def test_reports_failed_conversions():
+    images = [EncodedImage(png_bytes(), 'image/png'), EncodedImage(b'not an image', 'image/png')]
+    errors = {}
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = encode_results(images, "JPEG", 85, pool, errors=errors)
+    assert results[0].mime_type == 'image/jpeg'
+    assert results[1] is images[1]
+    assert list(errors) == [1]
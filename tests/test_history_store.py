@@ -0,0 +1,32 @@
+from studio_store import HistoryStore
+
+
+def test_lists_newest_first_per_user_and_type(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.db'))
+    store.add('a', 'generation', {'prompt': "red fox", 'style': "Photo"}, ["d1"])
+    store.add('a', 'generation', {'prompt': "blue whale"})
+    store.add('a', 'analysis', {'analysis_type': "complete"})
+    store.add('b', 'generation', {'prompt': "green frog"})
+
+    items = store.list('a', 'generation')
+    assert [item['data']['prompt'] for item in items] == ["blue whale", "red fox"]
+    assert items[1]['images'] == ["d1"]
+    assert store.counts_by_type('a') == {'generation': 2, 'analysis': 1}
+    assert sorted(store.counts_by_operation('a', 'generation')) == [("Photo", 1), ("Unknown", 1)]
+
+
+def test_search_and_paging(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.db'))
+    for i in range(5):
+        store.add('a', 'generation', {'prompt': f"fox number {i}" if i % 2 else f"whale {i}"})
+    assert store.count('a', 'generation', search="fox") == 2
+    assert [item['data']['prompt'] for item in store.list('a', 'generation', limit=2, offset=1)] == ["fox number 3", "whale 2"]
+
+
+def test_history_survives_reopening_and_clear_returns_digests(tmp_path):
+    path = str(tmp_path / 'history.db')
+    HistoryStore(path).add('a', 'edit', {'edit_type': "Background"}, ["d1", "d2"])
+    store = HistoryStore(path)
+    assert store.count('a') == 1
+    assert store.clear('a') == ["d1", "d2"]
+    assert store.count('a') == 0
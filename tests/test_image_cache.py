@@ -0,0 +1,38 @@
+from studio_engine import ImageCache
+
+
+def test_make_key_is_stable_and_order_sensitive():
+    assert ImageCache.make_key('generate', 'model', {'b': 1, 'a': 2}) == ImageCache.make_key('generate', 'model', {'a': 2, 'b': 1})
+    assert ImageCache.make_key('a', 'b') != ImageCache.make_key('b', 'a')
+
+
+def test_put_get_and_counters(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=1024)
+    assert cache.get('missing') is None
+    cache.put('key', b'data')
+    assert cache.get('key') == b'data'
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=10)
+    cache.put('a', b'aaaa')
+    cache.put('b', b'bbbb')
+    cache.get('a')
+    cache.put('c', b'cccc')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'aaaa'
+    assert cache.total_bytes <= 10
+    assert not (tmp_path / 'b').exists()
+
+
+def test_rebuilds_from_disk(tmp_path):
+    ImageCache(str(tmp_path), max_bytes=1024).put('key', b'data')
+    assert ImageCache(str(tmp_path), max_bytes=1024).get('key') == b'data'
+
+
+def test_skips_entries_over_budget(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=2)
+    cache.put('key', b'data')
+    assert cache.get('key') is None
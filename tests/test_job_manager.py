@@ -0,0 +1,57 @@
+import threading
+import time
+
+import pytest
+
+from studio_engine import EncodedImage
+from studio_store import BlobStore, JobManager
+
+
+@pytest.fixture
+def manager(tmp_path):
+    db_path = str(tmp_path / 'history.db')
+    return JobManager(db_path, BlobStore(str(tmp_path / 'blobs'), db_path))
+
+
+def wait_for(manager, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = manager.list('user', ['test'])[0]
+        if job['status'] not in ('queued', 'running'):
+            return job
+        time.sleep(0.01)
+    raise AssertionError("job did not finish")
+
+
+def test_results_keep_their_images_in_the_blob_store(manager):
+    image = EncodedImage(b'i' * 32, 'image/png')
+
+    def job(report):
+        report(1, 1)
+        return {'image': image, 'label': "done"}
+
+    job_id = manager.submit('user', 'test', "Test job", job)
+    assert wait_for(manager, job_id)['status'] == 'done'
+    result = manager.result(job_id)
+    assert result['label'] == "done"
+    assert result['image'].data == image.data
+
+    manager.dismiss(job_id)
+    assert manager.list('user', ['test']) == []
+
+
+def test_failed_jobs_keep_their_partial_items(manager):
+    release = threading.Event()
+
+    def job(report):
+        report(item={'filename': "a.png", 'analysis': "par"}, slot=0)
+        report(item={'filename': "a.png", 'analysis': "partial"}, slot=0)
+        release.wait(5)
+        raise RuntimeError("boom")
+
+    job_id = manager.submit('user', 'test', "Test job", job)
+    release.set()
+    job = wait_for(manager, job_id)
+    assert job['status'] == 'failed'
+    assert job['error'] == "boom"
+    assert manager.partial_results(job_id) == [{'filename': "a.png", 'analysis': "partial"}]
@@ -0,0 +1,67 @@
+import pytest
+
+import studio_engine
+from fake_gemini import FakeAPIError
+from studio_engine import CircuitBreaker, ModelGateway
+
+
+class FlakyModels:
+    """Fails the first `failures` calls with `code`, then answers from the fake backend"""
+
+    def __init__(self, client, failures, code):
+        self.inner = client.models
+        self.failures = failures
+        self.code = code
+        self.calls = 0
+
+    def generate_content(self, model, contents, config=None):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise FakeAPIError(self.code, "Injected")
+        return self.inner.generate_content(model=model, contents=contents, config=config)
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(studio_engine, 'RETRY_BASE_DELAY_SECONDS', 0.0)
+
+
+def test_retries_transient_errors(client):
+    client.models = FlakyModels(client, 2, 503)
+    gateway = ModelGateway(client)
+    response = gateway.generate_content(model='m', contents="hello")
+    assert response.text
+    assert client.models.calls == 3
+    assert gateway.stats()['retries'] == 2
+
+
+def test_rejected_requests_leave_the_breaker_alone(client):
+    client.models = FlakyModels(client, 10, 400)
+    gateway = ModelGateway(client)
+    with pytest.raises(FakeAPIError):
+        gateway.generate_content(model='m', contents="hello")
+    assert client.models.calls == 1
+    breaker = gateway.breakers['m']
+    assert breaker.failures == 0
+    assert breaker.state == "closed"
+
+
+def test_neutral_probe_keeps_an_open_breaker_open():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.0)
+    breaker.record_failure()
+    ticket = breaker.allow()
+    assert ticket
+    assert breaker.state == "half-open"
+    breaker.record_neutral(ticket)
+    assert breaker.state == "open"
+    assert breaker.allow()
+
+
+def test_neutral_call_that_is_not_the_probe_keeps_the_probe_slot():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.0)
+    ticket = breaker.allow()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_neutral(ticket)
+    assert breaker.state == "half-open"
+    assert not breaker.allow()
@@ -0,0 +1,40 @@
+import PIL.Image
+
+from studio_engine import Studio, pack_labels, plan_packs
+
+
+def test_pack_labels_suffixes_duplicates():
+    assert pack_labels(["a", "b", "a"]) == ["a", "b", "a (2)"]
+
+
+def test_pack_labels_avoids_real_filenames():
+    labels = pack_labels(["a", "a", "a (2)"])
+    assert len(set(labels)) == 3
+    assert labels[:2] == ["a", "a (2)"]
+
+    labels = pack_labels(["a (2)", "a", "a"])
+    assert labels == ["a (2)", "a", "a (3)"]
+
+
+def test_plan_packs_respects_every_limit():
+    assert plan_packs([(1, 1)] * 5, max_images=2) == [[0, 1], [2, 3], [4]]
+    assert plan_packs([(6, 1), (6, 1), (3, 1)], max_bytes=10) == [[0], [1, 2]]
+    assert plan_packs([(1, 600), (1, 600)], max_tokens=1000) == [[0], [1]]
+
+
+def test_plan_packs_keeps_oversized_images_alone():
+    assert plan_packs([(50, 1), (1, 1)], max_bytes=10) == [[0], [1]]
+
+
+def test_packed_answers_are_cached_apart_from_single_analyses(client, backend, tmp_path):
+    studio = Studio(client, image_cache_dir=str(tmp_path))
+    studio.prompt_cache = None
+    files = [(f"{i}.png", PIL.Image.new('RGB', (32, 32), (i * 40, 0, 0))) for i in range(3)]
+    results = studio.run_packed_analysis_batch(files, 'complete')
+    assert [result['filename'] for result in results] == ["0.png", "1.png", "2.png"]
+    calls = backend.counters['calls']
+
+    studio.run_packed_analysis_batch(files, 'complete')
+    assert backend.counters['calls'] == calls
+    studio.analyze_image_content(files[0][1], 'complete')
+    assert backend.counters['calls'] == calls + 1
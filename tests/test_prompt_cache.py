@@ -0,0 +1,139 @@
+import PIL.Image
+import pytest
+from google.genai import types
+
+import studio_engine
+from fake_gemini import FakeAPIError
+from studio_engine import PromptCache, Studio, analysis_system_instruction, is_cache_error, resolve_analysis_prompt
+
+
+@pytest.fixture
+def image():
+    return PIL.Image.new('RGB', (64, 64), (200, 40, 40))
+
+
+@pytest.fixture
+def studio(client, tmp_path):
+    studio = Studio(client, image_cache_dir=str(tmp_path / 'images'))
+    studio.prompt_cache = PromptCache(client)
+    return studio
+
+
+class RejectingModels:
+    """Fails every call with an invalid-input error unrelated to cached content"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def generate_content(self, model, contents, config=None):
+        self.calls += 1
+        raise FakeAPIError(400, "Unable to process input image")
+
+
+class FailingCaches:
+    def __init__(self):
+        self.creates = 0
+
+    def create(self, model, config=None):
+        self.creates += 1
+        raise FakeAPIError(403, "Caching is not enabled for this project")
+
+
+def test_is_cache_error():
+    assert is_cache_error(FakeAPIError(404, "CachedContent not found (or expired): cachedContents/abc"))
+    assert is_cache_error(FakeAPIError(400, "Cached content is too small. total_token_count=10"))
+    assert not is_cache_error(FakeAPIError(400, "Unable to process input image"))
+    assert not is_cache_error(FakeAPIError(503, "cached content unavailable"))
+    assert not is_cache_error(ValueError("cachedContent"))
+
+
+def test_short_prompts_are_sent_inline(client, backend):
+    assert PromptCache(client).get("Describe the image.") is None
+    assert backend.cached_contents == {}
+
+
+def test_fake_rejects_caches_below_the_minimum(client):
+    with pytest.raises(FakeAPIError) as error:
+        client.caches.create(model='m', config=types.CreateCachedContentConfig(system_instruction="too short", ttl="60s"))
+    assert error.value.code == 400
+    assert is_cache_error(error.value)
+
+
+def test_cached_and_inline_requests_give_the_same_instructions(studio, image):
+    cached_contents, cached_config = studio._analysis_request('complete', image)
+    inline_contents, inline_config = studio._analysis_request('complete', image, use_cache=False)
+    assert cached_config.cached_content
+    assert inline_config.system_instruction == analysis_system_instruction()
+    assert cached_contents == inline_contents
+
+
+def test_prompts_under_the_minimum_skip_the_prompt_cache(studio, backend, image, monkeypatch):
+    monkeypatch.setattr(studio_engine, 'PROMPT_CACHE_MIN_TOKENS', 10 ** 6)
+    contents, config = studio._analysis_request('text_extraction', image)
+    assert config is None
+    assert contents[0] == resolve_analysis_prompt('text_extraction')
+    assert not studio.analyze_image_content(image, 'text_extraction').startswith("Analysis error")
+    assert backend.cached_contents == {}
+
+
+def test_cache_is_created_once_and_reused(studio, backend, image):
+    first = studio.analyze_image_content(image, 'complete')
+    second = studio.analyze_image_content(image, 'technical_quality')
+    assert not first.startswith("Analysis error")
+    assert not second.startswith("Analysis error")
+    stats = studio.prompt_cache.stats()
+    assert stats['creates'] == 1
+    assert stats['hits'] >= 1
+    assert len(backend.cached_contents) == 1
+    assert backend.counters['cached_tokens'] > 0
+
+
+def test_evicted_cache_falls_back_inline(studio, backend, image):
+    studio.analyze_image_content(image, 'complete')
+    backend.cached_contents.clear()
+    calls = backend.counters['calls']
+
+    analysis = studio.analyze_image_content(image, 'technical_quality')
+    assert not analysis.startswith("Analysis error")
+    assert backend.counters['calls'] == calls + 1
+    # The stale name was dropped, so the next call registers the instruction again
+    studio.analyze_image_content(image, 'text_extraction')
+    assert studio.prompt_cache.stats()['creates'] == 2
+
+
+def test_other_errors_are_not_resent_inline(client, tmp_path, image):
+    client.models = RejectingModels()
+    studio = Studio(client, image_cache_dir=str(tmp_path / 'images'))
+    studio.prompt_cache = PromptCache(client)
+    analysis = studio.analyze_image_content(image, 'complete')
+    assert analysis.startswith("Analysis error")
+    assert client.models.calls == 1
+
+
+def test_creation_failure_backs_off_and_is_reported(client, tmp_path, image):
+    client.caches = FailingCaches()
+    studio = Studio(client, image_cache_dir=str(tmp_path / 'images'))
+    studio.prompt_cache = PromptCache(client)
+    assert not studio.analyze_image_content(image, 'complete').startswith("Analysis error")
+    assert not studio.analyze_image_content(image, 'technical_quality').startswith("Analysis error")
+    assert client.caches.creates == 1
+    stats = studio.prompt_cache.stats()
+    assert stats['failures'] == 1
+    assert "Caching is not enabled" in stats['last_error']
+
+
+def test_stream_uses_the_cached_instruction(studio, backend, image):
+    text = "".join(studio.analyze_image_content_stream(image, 'complete'))
+    assert text and not text.startswith("Analysis error")
+    assert backend.counters['cached_tokens'] > 0
+
+
+def test_evicted_cache_falls_back_inline_when_streaming(studio, backend, image):
+    "".join(studio.analyze_image_content_stream(image, 'complete'))
+    backend.cached_contents.clear()
+
+    text = "".join(studio.analyze_image_content_stream(image, 'technical_quality'))
+    assert text and not text.startswith("Analysis error")
+    assert studio.prompt_cache.stats()['entries'] == 0
+    "".join(studio.analyze_image_content_stream(image, 'text_extraction'))
+    assert studio.prompt_cache.stats()['creates'] == 2
@@ -0,0 +1,98 @@
+import threading
+
+import pytest
+
+from fake_gemini import FakeClient, FakeGeminiBackend
+from studio_engine import BulkJobStore, CallLog, ModelGateway, QuotaExceededError, QuotaManager, Studio, summarize_calls
+
+
+def test_settle_uses_reported_usage_times_price_factor():
+    quota = QuotaManager(global_budget=100.0, user_budget=100.0)
+    reservation = quota.admit('user', 1.0, price_factor=0.5)
+    cost = quota.settle(reservation, 1000, 2000)
+    assert cost == pytest.approx(QuotaManager.price(1000, 2000) * 0.5)
+    assert quota.usage('user')['user_spent'] == pytest.approx(cost)
+    assert quota.global_reserved == 0.0
+
+
+def test_settle_without_usage_charges_the_discounted_reservation_once():
+    quota = QuotaManager(global_budget=100.0, user_budget=100.0)
+    reservation = quota.admit('user', 4.0, price_factor=0.5)
+    assert quota.settle(reservation) == pytest.approx(2.0)
+    assert quota.usage('user')['user_spent'] == pytest.approx(2.0)
+
+
+def test_release_frees_the_reservation_without_spending():
+    quota = QuotaManager(global_budget=10.0, user_budget=10.0)
+    reservation = quota.admit('user', 8.0)
+    quota.release(reservation)
+    assert quota.usage('user')['user_spent'] == 0.0
+    quota.admit('user', 8.0)
+
+
+def test_admit_rejects_when_settled_spend_rules_the_call_out():
+    quota = QuotaManager(global_budget=100.0, user_budget=5.0)
+    quota.settle(quota.admit('user', 4.0))
+    with pytest.raises(QuotaExceededError):
+        quota.admit('user', 2.0, timeout=0)
+    quota.admit('other', 2.0, timeout=0)
+
+
+def test_admit_times_out_behind_in_flight_reservations():
+    quota = QuotaManager(global_budget=100.0, user_budget=5.0)
+    quota.admit('user', 4.0)
+    with pytest.raises(QuotaExceededError):
+        quota.admit('user', 2.0, timeout=0.05)
+
+
+def test_settled_spend_survives_a_restart(tmp_path):
+    db_path = str(tmp_path / 'quota.db')
+    QuotaManager(db_path).settle(('user', 3.0, 1.0))
+    assert QuotaManager(db_path).usage('user')['user_spent'] == pytest.approx(3.0)
+
+
+def test_quota_wait_is_kept_out_of_wall_time(client):
+    quota = QuotaManager(global_budget=1000.0, user_budget=1000.0)
+    amount = quota.estimate('analyze', "hello")
+    quota.user_budget = amount * 1.5
+    blocker = quota.admit('user', amount)
+    threading.Timer(0.2, quota.release, (blocker,)).start()
+
+    call_log = CallLog()
+    ModelGateway(client, call_log=call_log, quota=quota).generate_content(model='m', contents="hello", operation='analyze', user_id='user')
+    record = call_log.recent()[-1]
+    assert record['queue_wait'] >= 0.15
+    assert record['wall_time'] < record['queue_wait']
+    assert summarize_calls([record])['analyze']['queue_wait_p95'] == record['queue_wait']
+
+
+@pytest.fixture
+def bulk(tmp_path):
+    backend = FakeGeminiBackend(latency_ms=1, latency_sigma=0, batch_seconds=0)
+    quota = QuotaManager(global_budget=1000.0, user_budget=1000.0)
+    studio = Studio(FakeClient(backend), image_cache_dir=str(tmp_path / 'images'), quota=quota)
+    return backend, quota, studio, BulkJobStore(str(tmp_path / 'bulk.db'))
+
+
+def test_bulk_results_without_usage_are_billed_at_the_estimate(bulk):
+    backend, quota, studio, store = bulk
+    names, _ = studio.submit_bulk_generation(["a red fox"], 2, store, user_id='visitor-1', quota_id='anonymous')
+    reserved = quota.user_reserved['anonymous']
+    for response in backend.get_batch(names[0])['responses']:
+        response['usage'] = None
+
+    assert studio.poll_bulk_jobs(store) == names
+    assert reserved > 0
+    assert quota.usage('anonymous')['user_spent'] == pytest.approx(reserved)
+    assert quota.usage('visitor-1')['user_spent'] == 0
+    assert store.list_jobs('visitor-1')[0]['succeeded'] == 2
+
+
+def test_bulk_jobs_collected_after_a_restart_bill_their_quota_id(bulk, tmp_path):
+    backend, quota, studio, store = bulk
+    studio.submit_bulk_generation(["a red fox"], 1, store, user_id='visitor-1', quota_id='anonymous')
+
+    restarted = Studio(studio.client, image_cache_dir=str(tmp_path / 'images'), quota=QuotaManager(global_budget=1000.0, user_budget=1000.0))
+    restarted.poll_bulk_jobs(store)
+    assert restarted.quota.usage('anonymous')['user_spent'] > 0
+    assert restarted.quota.usage('visitor-1')['user_spent'] == 0
@@ -0,0 +1,62 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import PIL.Image
+
+from fake_gemini import FakeClient, FakeGeminiBackend
+from studio_engine import SingleFlight, Studio
+
+
+def test_concurrent_callers_share_one_call():
+    single_flight = SingleFlight()
+    calls = []
+
+    def slow(value):
+        calls.append(value)
+        time.sleep(0.2)
+        return value * 2
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: single_flight.do('key', slow, 21), range(4)))
+    assert results == [42] * 4
+    assert len(calls) == 1
+    assert single_flight.in_flight == {}
+
+
+def test_stream_followers_get_the_joined_text():
+    single_flight = SingleFlight()
+    started = threading.Event()
+
+    def chunks():
+        started.set()
+        for chunk in ("a", "b", "c"):
+            time.sleep(0.05)
+            yield chunk
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        leader = executor.submit(lambda: list(single_flight.do_stream('key', chunks)))
+        started.wait()
+        follower = list(single_flight.do_stream('key', chunks))
+    assert leader.result() == ["a", "b", "c"]
+    assert follower == ["abc"]
+
+
+def test_abandoned_stream_lets_the_next_caller_lead():
+    single_flight = SingleFlight()
+    stream = single_flight.do_stream('key', lambda: iter(["a", "b"]))
+    assert next(stream) == "a"
+    stream.close()
+    assert list(single_flight.do_stream('key', lambda: iter(["c"]))) == ["c"]
+
+
+def test_concurrent_identical_stream_analyses_make_one_call(tmp_path):
+    backend = FakeGeminiBackend(latency_ms=200, latency_sigma=0, stream_chunks=3)
+    studio = Studio(FakeClient(backend), image_cache_dir=str(tmp_path))
+    studio.prompt_cache = None
+    image = PIL.Image.new('RGB', (64, 64), (10, 120, 200))
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        texts = list(executor.map(lambda _: "".join(studio.analyze_image_content_stream(image, 'complete')), range(3)))
+    assert backend.counters['calls'] == 1
+    assert len(set(texts)) == 1